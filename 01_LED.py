@@ -13,6 +13,7 @@ import time
 from datetime import datetime
 from struct import pack, unpack
 import serial
+from jciebu_protocol import build_frame
 
 print('# serial', serial.__version__)
 
@@ -20,23 +21,6 @@ print('# serial', serial.__version__)
 SERIAL_PORT = "COM3"
 SERIAL_BAUDRATE = 115200
 
-def calc_crc(buf, length):
-    """
-    CRC-16 を計算する関数
-
-    """
-    crc = 0xFFFF
-    for i in range(length):
-        crc = crc ^ buf[i]
-        for i in range(8):
-            carrayFlag = crc & 1
-            crc = crc >> 1
-            if (carrayFlag == 1):
-                crc = crc ^ 0xA001
-    crcH = crc >> 8
-    crcL = crc & 0x00FF
-    return (bytearray([crcL, crcH]))
-
 def dump_packet(_packet):
     """
     パケットのダンプを表示する関数
@@ -53,8 +37,7 @@ def serial_write(_ser, _payload):
     環境センサにコマンドを送信する関数
     _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
     """
-    _command = b'\x52\x42' + pack('<H', len(_payload) + 2) + _payload
-    _command = _command + calc_crc(_command, len(_command))
+    _command = build_frame(_payload)
     _ser.write(_command)
     _ser.flush()
     dump_packet(_command)
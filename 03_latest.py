@@ -13,102 +13,49 @@ import time
 from datetime import datetime
 from struct import pack, unpack
 import serial
+from jciebu_protocol import decode_latest_data
+from jciebu_serial import serial_read
 
 # シリアルポートの設定
 SERIAL_PORT = "COM3"
 SERIAL_BAUDRATE = 115200
 
-def calc_crc(buf, length):
-    """
-    CRC-16 を計算する関数
-
-    """
-    crc = 0xFFFF
-    for i in range(length):
-        crc = crc ^ buf[i]
-        for i in range(8):
-            carrayFlag = crc & 1
-            crc = crc >> 1
-            if (carrayFlag == 1):
-                crc = crc ^ 0xA001
-    crcH = crc >> 8
-    crcL = crc & 0x00FF
-    return (bytearray([crcL, crcH]))
-
 def s16(value):
     return -(value & 0x8000) | (value & 0x7fff)
 
-def serial_write(_ser, _payload):
-    """
-    環境センサにコマンドを送信する関数
-    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
-    """
-    _command = b'\x52\x42' + pack('<H', len(_payload) + 2) + _payload
-    _command = _command + calc_crc(_command, len(_command))
-    _ser.write(_command)
-    _ser.flush()
-    return
-
-def serial_read(_ser, _payload):
-    """
-    環境センサにコマンドを送信し、レスポンスを取得する関数
-    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
-    レスポンスはシリアルポートから読み込み、そのまま返す
-    """
-    if len(_payload) > 0:
-        serial_write(_ser, _payload)
-    else:
-        return b''
-    
-    ret = b''
-    command_head_len = 4
-    while True:
-        _ser_len = _ser.inWaiting()
-        if _ser_len > 0:    
-            ret += ser.read(_ser_len)
-            if len(ret) >= (ret[2] | (ret[3] << 8)) + command_head_len:
-                break
-        else:
-            time.sleep(0.1)
-
-    if ret[0:2] != b'\x52\x42':
-        raise print("Invalid Header")
-    if ret[4] != 0 and ret[4] != 1:
-        raise print("Error Response", ret)
-    return ret
-
 def print_latest_data(data):
     """
     print measured latest value.
-    https://github.com/omron-devhub/2jciebu-usb-raspberrypi の sample_2jciebu.py からコピー
+    https://github.com/omron-devhub/2jciebu-usb-raspberrypi の sample_2jciebu.py を元に作成
+    (値の変換は jciebu_protocol の struct による変換)
     """
     time_measured = datetime.now().strftime("%Y/%m/%d %H:%M:%S.%f")
-    temperature = str( s16(int(hex(data[9]) + '{:02x}'.format(data[8], 'x'), 16)) / 100)
-    relative_humidity = str(int(hex(data[11]) + '{:02x}'.format(data[10], 'x'), 16) / 100)
-    ambient_light = str(int(hex(data[13]) + '{:02x}'.format(data[12], 'x'), 16))
-    barometric_pressure = str(int(hex(data[17]) + '{:02x}'.format(data[16], 'x')
-                                  + '{:02x}'.format(data[15], 'x') + '{:02x}'.format(data[14], 'x'), 16) / 1000)
-    sound_noise = str(int(hex(data[19]) + '{:02x}'.format(data[18], 'x'), 16) / 100)
-    eTVOC = str(int(hex(data[21]) + '{:02x}'.format(data[20], 'x'), 16))
-    eCO2 = str(int(hex(data[23]) + '{:02x}'.format(data[22], 'x'), 16))
-    discomfort_index = str(int(hex(data[25]) + '{:02x}'.format(data[24], 'x'), 16) / 100)
-    heat_stroke = str(s16(int(hex(data[27]) + '{:02x}'.format(data[26], 'x'), 16)) / 100)
-    vibration_information = str(int(hex(data[28]), 16))
-    si_value = str(int(hex(data[30]) + '{:02x}'.format(data[29], 'x'), 16) / 10)
-    pga = str(int(hex(data[32]) + '{:02x}'.format(data[31], 'x'), 16) / 10)
-    seismic_intensity = str(int(hex(data[34]) + '{:02x}'.format(data[33], 'x'), 16) / 1000)
-    temperature_flag = str(int(hex(data[36]) + '{:02x}'.format(data[35], 'x'), 16))
-    relative_humidity_flag = str(int(hex(data[38]) + '{:02x}'.format(data[37], 'x'), 16))
-    ambient_light_flag = str(int(hex(data[40]) + '{:02x}'.format(data[39], 'x'), 16))
-    barometric_pressure_flag = str(int(hex(data[42]) + '{:02x}'.format(data[41], 'x'), 16))
-    sound_noise_flag = str(int(hex(data[44]) + '{:02x}'.format(data[43], 'x'), 16))
-    etvoc_flag = str(int(hex(data[46]) + '{:02x}'.format(data[45], 'x'), 16))
-    eco2_flag = str(int(hex(data[48]) + '{:02x}'.format(data[47], 'x'), 16))
-    discomfort_index_flag = str(int(hex(data[50]) + '{:02x}'.format(data[49], 'x'), 16))
-    heat_stroke_flag = str(int(hex(data[52]) + '{:02x}'.format(data[51], 'x'), 16))
-    si_value_flag = str(int(hex(data[53]), 16))
-    pga_flag = str(int(hex(data[54]), 16))
-    seismic_intensity_flag = str(int(hex(data[55]), 16))
+    values = {k: str(v) for k, v in decode_latest_data(data).items()}
+    temperature = values['temperature']
+    relative_humidity = values['relative_humidity']
+    ambient_light = values['ambient_light']
+    barometric_pressure = values['barometric_pressure']
+    sound_noise = values['sound_noise']
+    eTVOC = values['eTVOC']
+    eCO2 = values['eCO2']
+    discomfort_index = values['discomfort_index']
+    heat_stroke = values['heat_stroke']
+    vibration_information = values['vibration_information']
+    si_value = values['si_value']
+    pga = values['pga']
+    seismic_intensity = values['seismic_intensity']
+    temperature_flag = values['temperature_flag']
+    relative_humidity_flag = values['relative_humidity_flag']
+    ambient_light_flag = values['ambient_light_flag']
+    barometric_pressure_flag = values['barometric_pressure_flag']
+    sound_noise_flag = values['sound_noise_flag']
+    etvoc_flag = values['eTVOC_flag']
+    eco2_flag = values['eCO2_flag']
+    discomfort_index_flag = values['discomfort_index_flag']
+    heat_stroke_flag = values['heat_stroke_flag']
+    si_value_flag = values['si_value_flag']
+    pga_flag = values['pga_flag']
+    seismic_intensity_flag = values['seismic_intensity_flag']
     print("")
     print("Time measured:" + time_measured)
     print("Temperature:" + temperature)
@@ -148,6 +95,8 @@ try:
         payload = bytearray([0x01, # Read 0x01, Write 0x02
                              0x21, 0x50]) # 最新データを取得 (0x5021 をリトルエンディアンで送信)
         ret = serial_read(ser, payload)
+        if len(ret) == 0:
+            continue
         print_latest_data(ret)
         time.sleep(1)
         i = i + 1
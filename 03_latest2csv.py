@@ -6,6 +6,9 @@
 # 
 # 使い方: python 03_latest2csv.py
 #
+# 取得したデータは一旦ディスクのスプール (jciebu_spool.py) に追記し、CSVファイルへの出力は別スレッドで行う
+# (CSVファイルへの書き込みが遅れても取得の間隔は変わらず、再起動後はまだ出力していないデータから出力する)
+#
 
 import os
 import sys
@@ -13,6 +16,11 @@ import time
 from datetime import datetime
 from struct import pack, unpack
 import serial
+from jciebu_csv import CsvWriter
+from jciebu_protocol import unpack_latest_data
+from jciebu_record import LATEST_DATA_SCHEMA, SensorRecord
+from jciebu_serial import serial_read
+from jciebu_spool import Spool, SpoolDrainer
 
 # シリアルポートの設定
 SERIAL_PORT = "COM3"
@@ -21,124 +29,28 @@ SERIAL_BAUDRATE = 115200
 # データの記録間隔
 INTERVAL = 60
 
-def calc_crc(buf, length):
-    """
-    CRC-16 を計算する関数
-
-    """
-    crc = 0xFFFF
-    for i in range(length):
-        crc = crc ^ buf[i]
-        for i in range(8):
-            carrayFlag = crc & 1
-            crc = crc >> 1
-            if (carrayFlag == 1):
-                crc = crc ^ 0xA001
-    crcH = crc >> 8
-    crcL = crc & 0x00FF
-    return (bytearray([crcL, crcH]))
+# スプールのフォルダ (シリアルポートごと)
+SPOOL_FOLDER = os.path.join('spool_files', 'latest_' + os.path.basename(SERIAL_PORT))
 
 def s16(value):
     return -(value & 0x8000) | (value & 0x7fff)
 
-def serial_write(_ser, _payload):
-    """
-    環境センサにコマンドを送信する関数
-    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
-    """
-    _command = b'\x52\x42' + pack('<H', len(_payload) + 2) + _payload
-    _command = _command + calc_crc(_command, len(_command))
-    _ser.write(_command)
-    _ser.flush()
-    return
-
-def serial_read(_ser, _payload):
+def get_latest_data(data):
     """
-    環境センサにコマンドを送信し、レスポンスを取得する関数
-    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
-    レスポンスはシリアルポートから読み込み、そのまま返す
+    最新データ(0x5021)のレスポンスを、取得時刻と変換前の整数の SensorRecord に変換する関数
+    jciebu_protocol の struct による変換で、全フィールドをまとめて読み込む
     """
-    if len(_payload) > 0:
-        serial_write(_ser, _payload)
-    else:
-        return b''
-    
-    ret = b''
-    command_head_len = 4
-    while True:
-        _ser_len = _ser.inWaiting()
-        if _ser_len > 0:    
-            ret += ser.read(_ser_len)
-            if len(ret) >= (ret[2] | (ret[3] << 8)) + command_head_len:
-                break
-        else:
-            time.sleep(0.1)
-
-    if ret[0:2] != b'\x52\x42':
-        raise print("Invalid Header")
-    if ret[4] != 0 and ret[4] != 1:
-        raise print("Error Response", ret)
-    return ret
+    return SensorRecord(LATEST_DATA_SCHEMA, unpack_latest_data(data), time.time(), SERIAL_PORT)
 
-def get_latest_data(data):
+def write_csv(records):
     """
-    print measured latest value.
-    https://github.com/omron-devhub/2jciebu-usb-raspberrypi の sample_2jciebu.py からコピー
+    スプールから読み込んだレコードをCSVファイルに出力する関数 (SpoolDrainer のスレッドで実行)
+    1列目は取得時刻、sequence_number は出力しない
     """
-    time_measured = datetime.now().strftime("%Y/%m/%d %H:%M:%S.%f")
-    temperature = str( s16(int(hex(data[9]) + '{:02x}'.format(data[8], 'x'), 16)) / 100)
-    relative_humidity = str(int(hex(data[11]) + '{:02x}'.format(data[10], 'x'), 16) / 100)
-    ambient_light = str(int(hex(data[13]) + '{:02x}'.format(data[12], 'x'), 16))
-    barometric_pressure = str(int(hex(data[17]) + '{:02x}'.format(data[16], 'x')
-                                  + '{:02x}'.format(data[15], 'x') + '{:02x}'.format(data[14], 'x'), 16) / 1000)
-    sound_noise = str(int(hex(data[19]) + '{:02x}'.format(data[18], 'x'), 16) / 100)
-    eTVOC = str(int(hex(data[21]) + '{:02x}'.format(data[20], 'x'), 16))
-    eCO2 = str(int(hex(data[23]) + '{:02x}'.format(data[22], 'x'), 16))
-    discomfort_index = str(int(hex(data[25]) + '{:02x}'.format(data[24], 'x'), 16) / 100)
-    heat_stroke = str(s16(int(hex(data[27]) + '{:02x}'.format(data[26], 'x'), 16)) / 100)
-    vibration_information = str(int(hex(data[28]), 16))
-    si_value = str(int(hex(data[30]) + '{:02x}'.format(data[29], 'x'), 16) / 10)
-    pga = str(int(hex(data[32]) + '{:02x}'.format(data[31], 'x'), 16) / 10)
-    seismic_intensity = str(int(hex(data[34]) + '{:02x}'.format(data[33], 'x'), 16) / 1000)
-    temperature_flag = str(int(hex(data[36]) + '{:02x}'.format(data[35], 'x'), 16))
-    relative_humidity_flag = str(int(hex(data[38]) + '{:02x}'.format(data[37], 'x'), 16))
-    ambient_light_flag = str(int(hex(data[40]) + '{:02x}'.format(data[39], 'x'), 16))
-    barometric_pressure_flag = str(int(hex(data[42]) + '{:02x}'.format(data[41], 'x'), 16))
-    sound_noise_flag = str(int(hex(data[44]) + '{:02x}'.format(data[43], 'x'), 16))
-    etvoc_flag = str(int(hex(data[46]) + '{:02x}'.format(data[45], 'x'), 16))
-    eco2_flag = str(int(hex(data[48]) + '{:02x}'.format(data[47], 'x'), 16))
-    discomfort_index_flag = str(int(hex(data[50]) + '{:02x}'.format(data[49], 'x'), 16))
-    heat_stroke_flag = str(int(hex(data[52]) + '{:02x}'.format(data[51], 'x'), 16))
-    si_value_flag = str(int(hex(data[53]), 16))
-    pga_flag = str(int(hex(data[54]), 16))
-    seismic_intensity_flag = str(int(hex(data[55]), 16))
-
-    return {'time_measured': time_measured,
-            'temperature': temperature,
-            'relative_humidity': relative_humidity,
-            'ambient_light': ambient_light,
-            'barometric_pressure': barometric_pressure,
-            'sound_noise': sound_noise,
-            'eTVOC': eTVOC,
-            'eCO2': eCO2,
-            'discomfort_index': discomfort_index,
-            'heat_stroke': heat_stroke,
-            'vibration_information': vibration_information,
-            'si_value': si_value,
-            'pga': pga,
-            'seismic_intensity': seismic_intensity,
-            'temperature_flag': temperature_flag,
-            'relative_humidity_flag': relative_humidity_flag,
-            'ambient_light_flag': ambient_light_flag,
-            'barometric_pressure_flag': barometric_pressure_flag,
-            'sound_noise_flag': sound_noise_flag,
-            'eTVOC_flag': etvoc_flag,
-            'eCO2_flag': eco2_flag,
-            'discomfort_index_flag': discomfort_index_flag,
-            'heat_stroke_flag': heat_stroke_flag,
-            'si_value_flag': si_value_flag,
-            'pga_flag': pga_flag,
-            'seismic_intensity_flag': seismic_intensity_flag}
+    for record in records:
+        _output = [datetime.fromtimestamp(record.time).strftime("%Y/%m/%d %H:%M:%S.%f")]
+        _output.extend(record.csv_values()[1:])
+        csv_writer.write(_output_file, _header, _output)
 
 # シリアルポートをオープン
 ser = serial.Serial(SERIAL_PORT, SERIAL_BAUDRATE, serial.EIGHTBITS, serial.PARITY_NONE, write_timeout=1, timeout=1)
@@ -149,7 +61,15 @@ if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
 # CSVファイルのファイル名
-_output_file = os.path.join(output_folder + '/' + 'iot_2jciebu_all_' + SERIAL_PORT + '.csv')
+_output_file = os.path.join(output_folder + '/' + 'iot_2jciebu_all_' + os.path.basename(SERIAL_PORT) + '.csv')
+# CSVのヘッダー (新しいファイルの場合に出力)
+_header = ('time_measured',) + LATEST_DATA_SCHEMA.fields[1:]
+
+# 1 行ごとに書き出す (書き込みは SpoolDrainer のスレッドで行うので、取得の間隔には影響しない)
+csv_writer = CsvWriter(flush_rows=1)
+spool = Spool(SPOOL_FOLDER)
+drainer = SpoolDrainer(spool, write_csv, idle=csv_writer.flush_due, flush=csv_writer.flush)
+drainer.start()
 
 # try-except文を使って、Ctrl+C でプログラムを終了することができるようにする
 try: 
@@ -161,22 +81,17 @@ try:
         payload = bytearray([0x01, # Read 0x01, Write 0x02
                              0x21, 0x50]) # 最新データを取得 (0x5021 をリトルエンディアンで送信)
         ret = serial_read(ser, payload)
-        data = get_latest_data(ret)
-
-        if not os.path.exists(_output_file):
-            # _data_dictのキーをCSVのヘッダーとして出力
-            _header = ','.join(data.keys())
-        else:
-            _header = ''
-        _output = ','.join(map(str, data.values()))
-
-        with open(_output_file, 'a') as f:
-            if len(_header) > 0:
-                f.write(_header + '\n')
-            f.write(_output + '\n')
+        if len(ret) == 0:
+            continue
+        # スプールに追記するだけ (CSVファイルへの出力は SpoolDrainer のスレッドで行う)
+        spool.append_record(get_latest_data(ret))
 
         time.sleep(INTERVAL)
 
 except KeyboardInterrupt:
+    # スプールに残っているデータをCSVファイルに出力してクローズ
+    drainer.stop()
+    spool.close()
+    csv_writer.close()
     # シリアルポートをクローズ
     ser.close()
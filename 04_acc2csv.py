@@ -13,28 +13,12 @@ import time
 from datetime import datetime
 from struct import pack, unpack
 import serial
+from jciebu_protocol import calc_crc, verify_crc
 
 # シリアルポートの設定
 SERIAL_PORT = "COM3"
 SERIAL_BAUDRATE = 115200
 
-def calc_crc(buf, length):
-    """
-    CRC-16 を計算する関数
-
-    """
-    crc = 0xFFFF
-    for i in range(length):
-        crc = crc ^ buf[i]
-        for i in range(8):
-            carrayFlag = crc & 1
-            crc = crc >> 1
-            if (carrayFlag == 1):
-                crc = crc ^ 0xA001
-    crcH = crc >> 8
-    crcL = crc & 0x00FF
-    return (bytearray([crcL, crcH]))
-
 def s16(value):
     return -(value & 0x8000) | (value & 0x7fff)
 
@@ -69,6 +53,12 @@ try:
             _ser_len = ser.inWaiting()
         ret = ser.read(_ser_len)
 
+        # CRC-16 を確認し、不正なレスポンスは読み飛ばす
+        if not verify_crc(ret):
+            print('CRC Error', ret)
+            time.sleep(0.1)
+            continue
+
         # 取得したデータを加速度(gal)に変換して表示
         x = s16(ret[19] | (ret[20] << 8)) * 0.1 # 加速度の単位は gal
         y = s16(ret[21] | (ret[22] << 8)) * 0.1
@@ -13,6 +13,10 @@ import time
 from datetime import datetime
 from struct import pack, unpack
 import serial
+from jciebu_acc import AccDownloader, acc_rows
+from jciebu_csv import CsvWriter
+from jciebu_protocol import decode_latest_data
+from jciebu_serial import CommandQueue, serial_read
 
 # シリアルポートの設定
 SERIAL_PORT = "COM3"
@@ -25,82 +29,23 @@ INTERVAL = 60
 OUTPUT_FOLDER = 'csv_files'
 
 # CSVファイルのファイル名 (data2csv関数で、センサーデータ全部の場合、加速度データの場合のファイル名を追加)
-_output_file_head = os.path.join(OUTPUT_FOLDER + '/' + 'iot_2jciebu_all_' + SERIAL_PORT)
-
-
-def calc_crc(buf, length):
-    """
-    CRC-16 を計算する関数
-
-    """
-    crc = 0xFFFF
-    for i in range(length):
-        crc = crc ^ buf[i]
-        for i in range(8):
-            carrayFlag = crc & 1
-            crc = crc >> 1
-            if (carrayFlag == 1):
-                crc = crc ^ 0xA001
-    crcH = crc >> 8
-    crcL = crc & 0x00FF
-    return (bytearray([crcL, crcH]))
+_output_file_head = os.path.join(OUTPUT_FOLDER + '/' + 'iot_2jciebu_all_' + os.path.basename(SERIAL_PORT))
 
-def s16(value):
-    return -(value & 0x8000) | (value & 0x7fff)
+# 加速度データの読み込みの途中経過を保存するファイル (中断した場合は次回、続きから読み込む)
+ACC_CHECKPOINT_FILE = _output_file_head + '_acc_checkpoint.json'
 
-def serial_write(_ser, _payload):
-    """
-    シリアルポートにコマンドを送信する関数
-    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
-    """
-    _command = b'\x52\x42' + pack('<H', len(_payload) + 2) + _payload
-    _command = _command + calc_crc(_command, len(_command))
-    _ser.write(_command)
-    _ser.flush()
-    # time.sleep(0.1)
-    return
+# CSVファイルへの書き出しの設定 (CSV_FLUSH_ROWS 行ごと、または CSV_FLUSH_INTERVAL 秒ごとにまとめて書き出す)
+# CSV_FSYNC を True にすると書き出しのたびに SD カードなどへの書き込み完了を待つ
+CSV_FLUSH_ROWS = 10
+CSV_FLUSH_INTERVAL = 300
+CSV_FSYNC = False
+# CSVファイルを日ごと ('daily')・時間ごと ('hourly') に分ける設定 (None の場合は 1 つのファイルに追記)
+# 分けたファイル (iot_2jciebu_all_COM3_20240701.csv など) の期間と行数は csv_files/catalog.json に記録
+CSV_PARTITION = None
 
-def serial_read(_ser, _payload, timeout=0.0):
-    """
-    環境センサにコマンドを送信し、レスポンスを取得する関数
-    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
-    レスポンスはシリアルポートから読み込み、そのまま返す
-    """
-    if len(_payload) > 0:
-        serial_write(_ser, _payload)
-    else:
-        return b''
 
-    ret = b''
-    command_head_len = 4
-    i = 0
-    while True:
-        _ser_len = _ser.inWaiting()
-        if _ser_len > 0:
-            ret += _ser.read(_ser_len)
-            if _ser_len > 3 and len(ret) >= (ret[2] | (ret[3] << 8)) + command_head_len:
-                break
-        else:
-            i = i + 1
-            if i >= 10:
-                print('serial port timeout')
-                return b''
-            time.sleep(0.1)
-
-    if ret[0:2] != b'\x52\x42':
-        print("Invalid Header", ret)
-        ret = b''
-    elif ret[4] != 1 and ret[4] != 2:
-        for i in range(len(ret)):
-            print(f'({i}) {ret[i]:02x}', end=' ')
-        print()
-        print("Error Response", hex(ret[4]))
-        ret = b''
-
-    _ser.reset_input_buffer()
-    _ser.reset_output_buffer()
-
-    return ret
+def s16(value):
+    return -(value & 0x8000) | (value & 0x7fff)
 
 def dump_data(_ret):
     for i in range(len(_ret)):
@@ -122,9 +67,9 @@ def get_current_data(_ser):
                         ])
     ret = serial_read(_ser, payload)
     if len(ret) > 0:
-        values = unpack('<hHHLHHHHhBHHH', ret[8:35])
-        units = [0.01, 0.01, 1, 0.001, 0.01, 1, 1, 0.01, 0.01, 1, 0.1, 0.1, 0.001]
-        retval = dict([ [k, v * u] for k, v, u in zip(fields, values, units)])
+        # フラグを含む全フィールドをまとめて変換し、CSVに出力する測定値を取り出す
+        values = decode_latest_data(ret)
+        retval = dict([ [k, values[k]] for k in fields])
         # retval = {"time_measured": datetime.now()} | retval # python 3.9 以降
         retval = {**{"time_measured": datetime.now()}, **retval}  # python 3.8 以前も含めた書き方
         return [retval]
@@ -161,26 +106,15 @@ def setup_sensor(_ser):
         storage_interval  = int.from_bytes(ret[7:9], 'little')
         print('storage_interval (w)', storage_interval)
 
-def read_acc_data_pages(_acc_data, _page, _time):
-    # print(len(_acc_data))
-    retval = []
-    for i in range(0, len(_acc_data)-1, 6):
-        if i+5 >= len(_acc_data):
-            break
-        x = s16(_acc_data[i+1] << 8 | _acc_data[i]) * 0.1
-        y = s16(_acc_data[i+3] << 8 | _acc_data[i+2]) * 0.1
-        z = s16(_acc_data[i+5] << 8 | _acc_data[i+4]) * 0.1
-        # _timestamp = _time + (_page*32+i/6) * 0.01
-        _timestamp = datetime.fromtimestamp(_time + (_page*32+i/6) * 0.01)
-        # print(f'{_page} {i/6} x={x:.2f} y={y:.2f} z={z:.2f}', _timestamp, datetime.fromtimestamp(_timestamp), _timestamp)
-        retval.append({"time_measured": _timestamp, 'acc_x': x, 'acc_y': y, 'acc_z': z})
-    return retval
-
 # CSVファイルを保存するフォルダを作成
 output_folder = OUTPUT_FOLDER
 if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
+# CSVファイルごとにファイルを開いたままにして追記
+csv_writer = CsvWriter(flush_rows=CSV_FLUSH_ROWS, flush_interval=CSV_FLUSH_INTERVAL, fsync=CSV_FSYNC,
+                       partition=CSV_PARTITION)
+
 # センサデータをCSVファイルに保存するための関数
 def data2csv(_data, _output_file_head):
     # 出力するデータが気温等か加速度データかを判定し、ファイル名を設定
@@ -191,36 +125,59 @@ def data2csv(_data, _output_file_head):
     else: # 加速度データの場合
         _output_file = _output_file_head + '_acc' + datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
 
-    # _dataのキーをCSVのヘッダーとして出力
-    if not os.path.exists(_output_file):
-        _header = ''
-        for key in _data[0].keys():
-            if len(_header) == 0:
-                _header = key
-            else:
-                _header = _header + ',' + key
-        with open(_output_file, 'a') as f:
-            f.write(_header + '\n')
-
-    # _dataの値をCSVファイルに出力
-    with open(_output_file, 'a') as f:
-        for _row in _data:
-            _output = ''
-            for key in _row.keys():
-                if len(_output) == 0:
-                    _output = str(_row[key])
-                else:
-                    _output = _output + ',' + str(_row[key])
-            f.write(_output + '\n')
+    # _dataの値をCSVファイルに出力 (新しいファイルの場合は_dataのキーをヘッダーとして出力)
+    # 測定時刻のパーティションのファイルに書き込む
+    csv_writer.write_rows(_output_file, _data[0].keys(), [map(str, _row.values()) for _row in _data],
+                          [_row['time_measured'].timestamp() for _row in _data], SERIAL_PORT)
+
+    return
+
+# 加速度データ (decode_acc_pages の結果) をCSVファイルに保存するための関数
+def acc2csv(_acc, _output_file):
+    if len(_acc['acc_x']) == 0:
+        return
+
+    csv_writer.write_rows(_output_file, _acc.keys(), [map(str, _row) for _row in acc_rows(_acc)])
+    # 読み込みが終わったページ番号を保存する前に、CSVファイルに書き出しておく
+    csv_writer.flush(_output_file)
 
     return
 
+# 加速度メモリのデータを少しずつ読み込み、CSVファイルに追記する関数 (中断した場合は False を返す)
+def download_acc(_downloader):
+    ok = _downloader.run(lambda acc: acc2csv(acc, _downloader.output_file))
+    if ok:
+        csv_writer.close_file(_downloader.output_file)
+    pages_per_sec, bytes_per_sec = _downloader.throughput()
+    print(f'acceleration data: {_downloader.last_page}/{_downloader.end_page} pages',
+          f'({pages_per_sec:.1f} pages/s, {bytes_per_sec:.0f} bytes/s)', _downloader.output_file)
+    return ok
+
 # シリアルポートをオープン
 ser = serial.Serial(SERIAL_PORT, SERIAL_BAUDRATE, serial.EIGHTBITS, serial.PARITY_NONE, write_timeout=1, timeout=1)
 
 # センサの初期設定(加速度データの記録を開始するために timecounter をリセット)
 setup_sensor(ser)
 
+# 複数のコマンドをまとめて送信するためのキュー
+command_queue = CommandQueue(ser)
+
+# 前回中断した加速度データの読み込みがあれば、記録が上書きされていないか確認して再開
+acc_downloader = AccDownloader.resume(ser, ACC_CHECKPOINT_FILE)
+if acc_downloader is not None:
+    payload = bytearray([0x01, # Read 0x01, Write 0x02
+                        0x3E, 0x50, # Acceleration memory data [Header] (Address: 0x503E をリトルエンディアンで送信)
+                        acc_downloader.data_type, # Acceleration data type 0x00: Earthquake data (Normal mode) 0x01: Vibration data (Normal mode)
+                        0x01, # Request acceleration memory index (Range: 0x01 to 0x0A (1 to 10) *0x01: Latest data <---> 0x0A: Last data)
+                        ])
+    ret = serial_read(ser, payload)
+    if len(ret) > 0 and int.from_bytes(ret[13:21], 'little') == acc_downloader.timecounter:
+        print('# resume acceleration data', acc_downloader.output_file)
+        download_acc(acc_downloader)
+    else:
+        os.remove(ACC_CHECKPOINT_FILE)
+        acc_downloader = None
+
 # センサの初期設定完了後、一度、センサからデータを取得して表示
 ret = None
 while ret is None:
@@ -231,6 +188,8 @@ print('# start sensing data', datetime.now(), ret)
 # 地震・振動によって記録された加速度データを確認し、InfluxDBに格納するためのフラグ
 earthquake_flag = False
 vibration_flag = False
+# 振動終了の行を書き出したかどうか (ヘッダの読み込みに失敗して再試行する間に重ねて書かないため)
+vibration_end_written = False
 vibration_start_time = 0
 vibration_end_time = 0
 vibration_start_datetime = datetime.now().timestamp()
@@ -240,6 +199,10 @@ try:
     i = 0
     # while ser.isOpen() and i < 10:
     while ser.isOpen():
+        # 中断した加速度データの読み込みがあれば、続きから読み込む
+        if acc_downloader is not None and not acc_downloader.done():
+            download_acc(acc_downloader)
+
         # 最新センサデータを取得
         ret = get_current_data(ser)
         if ret is None:
@@ -262,90 +225,78 @@ try:
 
 
         if vibration_flag == True and ret[0]["vibration_information"] == 0:
-            data2csv(ret, _output_file_head)
-            # Read the current timecounter
+            if not vibration_end_written:
+                data2csv(ret, _output_file_head)
+                vibration_end_written = True
+            # Read the current timecounter and the accelleration memory header.
+            # 2つのコマンドをまとめて送信し、レスポンスはアドレスで対応付ける
             payload = bytearray([0x01, # Read 0x01, Write 0x02
                                 0x01, 0x52, # Latest time counter (Address: 0x5201 をリトルエンディアンで送信)
                                 ])
-            ret = serial_read(ser, payload)
-            current_timecounter = int.from_bytes(ret[7:15], 'little')
-            print(f'current_timecounter: {current_timecounter} (0x{current_timecounter:016x})')
-            print(f'({i})', ret[0])
-
-            if earthquake_flag:
-                # Read the accelleration memory header.
-                payload = bytearray([0x01, # Read 0x01, Write 0x02
-                                    0x3E, 0x50, # Acceleration memory data [Header] (Address: 0x503E をリトルエンディアンで送信)
-                                    0x00, # Acceleration data type 0x00: Earthquake data (Normal mode) 0x01: Vibration data (Normal mode)
-                                    0x01, # Request acceleration memory index (Range: 0x01 to 0x0A (1 to 10) *0x01: Latest data <---> 0x0A: Last data)
-                                    ])
-                ret = serial_read(ser, payload)
-                data_timecounter = int.from_bytes(ret[13:21], 'little')
-                print(f'Earthquake end timecounter: {data_timecounter} (0x{data_timecounter:016x})')
-
-                if data_timecounter != 0:
-                    # Calculate time of vibration end.
-                    vibration_end_time = vibration_start_datetime + (current_timecounter - data_timecounter)
-                    print('current_timecounter', current_timecounter, 'data_timecounter', data_timecounter, 'diff', (current_timecounter - data_timecounter))
-                    print(f'vibration_start_time: {vibration_start_time}') # ({datetime.fromtimestamp(vibration_start_time)})')
-                    print(f'vibration_end_time: {vibration_end_time} ({datetime.fromtimestamp(vibration_end_time)})')
-
-                    _start_page = 0x0001
-                    _end_page = ret[7] | ret[8]<<8            
-                    _payload = bytearray([0x01, # Read 0x01, Write 0x02
-                                        0x3F, 0x50, # Acceleration memory data [Data] (Address: 0x503F)
-                                        0x00, # Acceleration data type (0x00: Earthquake data 0x01: Vibration data)
-                                        0x01, # Request acceleration memory index UInt8 0x01: Fixed value
-                                        0x01, 0x00, # Request page (Start page)
-                                        ret[7], ret[8]]) # Request page (End page)
-                                        # ])+ pack('<H', _end_page - 1) # Request page (End page)
-                    ret = serial_read(ser, _payload, timeout=1.0)
-                    acc_data = []
-                    for i in range(_end_page):
-                        acc_data = acc_data + read_acc_data_pages(ret[i*237+43:(i+1)*237-2], i, vibration_start_timestamp)
-                    data2csv(acc_data, _output_file_head)
-
-                earthquake_flag = False
-
+            header_payload = bytearray([0x01, # Read 0x01, Write 0x02
+                                       0x3E, 0x50, # Acceleration memory data [Header] (Address: 0x503E をリトルエンディアンで送信)
+                                       0x00 if earthquake_flag else 0x01, # Acceleration data type 0x00: Earthquake data (Normal mode) 0x01: Vibration data (Normal mode)
+                                       0x01, # Request acceleration memory index (Range: 0x01 to 0x0A (1 to 10) *0x01: Latest data <---> 0x0A: Last data)
+                                       ])
+            ret, header_ret = command_queue.request(payload, header_payload)
+            if len(ret) == 0 or len(header_ret) == 0:
+                # レスポンスがない場合は 1 秒後にもう一度読み込む (振動終了の行は書き出し済みなので重ねて書かない)
+                print('# no response for timecounter / acceleration header, retry')
             else:
-                # Read the accelleration memory header.
-                payload = bytearray([0x01, # Read 0x01, Write 0x02
-                                    0x3E, 0x50, # Acceleration memory data [Header] (Address: 0x503E をリトルエンディアンで送信)
-                                    0x01, # Acceleration data type 0x00: Earthquake data (Normal mode) 0x01: Vibration data (Normal mode)
-                                    0x01, # Request acceleration memory index (Range: 0x01 to 0x0A (1 to 10) *0x01: Latest data <---> 0x0A: Last data)
-                                    ])
-                ret = serial_read(ser, payload)
-                data_timecounter = int.from_bytes(ret[13:21], 'little')
-                print(f'Vibration end timecounter: {data_timecounter} (0x{data_timecounter:016x})')
-
-                if data_timecounter != 0:
-                    # Calculate time of vibration end.
-                    vibration_end_time = vibration_start_datetime + (current_timecounter - data_timecounter)
-                    print('current_timecounter', current_timecounter, 'data_timecounter', data_timecounter, 'diff', (current_timecounter - data_timecounter))
-                    print(f'vibration_start_time: {vibration_start_time}') # ({datetime.fromtimestamp(vibration_start_time)})')
-                    print(f'vibration_end_time: {vibration_end_time} ({datetime.fromtimestamp(vibration_end_time)})')
-                    print()
-
-                    _start_page = 0x0001
-                    _end_page = ret[7] | ret[8]<<8            
-                    _payload = bytearray([0x01, # Read 0x01, Write 0x02
-                                        0x3F, 0x50, # Acceleration memory data [Data] (Address: 0x503F)
-                                        0x01, # Acceleration data type (0x00: Earthquake data 0x01: Vibration data)
-                                        0x01, # Request acceleration memory index UInt8 0x01: Fixed value
-                                        0x01, 0x00, # Request page (Start page)
-                                        ret[7], ret[8]]) # Request page (End page)
-                                        # ])+ pack('<H', _end_page - 1) # Request page (End page)
-                    ret = serial_read(ser, _payload, timeout=1.0)
-                    acc_data = []
-                    for i in range(_end_page):
-                        acc_data = acc_data + read_acc_data_pages(ret[i*237+43:(i+1)*237-2], i, vibration_start_timestamp)
-                    data2csv(acc_data, _output_file_head)
-
-            vibration_flag = False
+                current_timecounter = int.from_bytes(ret[7:15], 'little')
+                print(f'current_timecounter: {current_timecounter} (0x{current_timecounter:016x})')
+                print(f'({i})', ret[0])
+
+                if earthquake_flag:
+                    ret = header_ret
+                    data_timecounter = int.from_bytes(ret[13:21], 'little')
+                    print(f'Earthquake end timecounter: {data_timecounter} (0x{data_timecounter:016x})')
+
+                    if data_timecounter != 0:
+                        # Calculate time of vibration end.
+                        vibration_end_time = vibration_start_datetime + (current_timecounter - data_timecounter)
+                        print('current_timecounter', current_timecounter, 'data_timecounter', data_timecounter, 'diff', (current_timecounter - data_timecounter))
+                        print(f'vibration_start_time: {vibration_start_time}') # ({datetime.fromtimestamp(vibration_start_time)})')
+                        print(f'vibration_end_time: {vibration_end_time} ({datetime.fromtimestamp(vibration_end_time)})')
+
+                        _end_page = ret[7] | ret[8]<<8
+                        _output_file = _output_file_head + '_acc' + datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
+                        acc_downloader = AccDownloader(ser, 0x00, _end_page, vibration_start_timestamp,
+                                                       checkpoint_file=ACC_CHECKPOINT_FILE,
+                                                       timecounter=data_timecounter, output_file=_output_file)
+                        download_acc(acc_downloader)
+
+                    earthquake_flag = False
 
+                else:
+                    ret = header_ret
+                    data_timecounter = int.from_bytes(ret[13:21], 'little')
+                    print(f'Vibration end timecounter: {data_timecounter} (0x{data_timecounter:016x})')
+
+                    if data_timecounter != 0:
+                        # Calculate time of vibration end.
+                        vibration_end_time = vibration_start_datetime + (current_timecounter - data_timecounter)
+                        print('current_timecounter', current_timecounter, 'data_timecounter', data_timecounter, 'diff', (current_timecounter - data_timecounter))
+                        print(f'vibration_start_time: {vibration_start_time}') # ({datetime.fromtimestamp(vibration_start_time)})')
+                        print(f'vibration_end_time: {vibration_end_time} ({datetime.fromtimestamp(vibration_end_time)})')
+                        print()
+
+                        _end_page = ret[7] | ret[8]<<8
+                        _output_file = _output_file_head + '_acc' + datetime.now().strftime('%Y%m%d%H%M%S') + '.csv'
+                        acc_downloader = AccDownloader(ser, 0x01, _end_page, vibration_start_timestamp,
+                                                       checkpoint_file=ACC_CHECKPOINT_FILE,
+                                                       timecounter=data_timecounter, output_file=_output_file)
+                        download_acc(acc_downloader)
+
+                vibration_flag = False
+                vibration_end_written = False
+
+        csv_writer.flush_due()
         time.sleep(1) # 1秒スリープ
         i = i + 1
 
 except KeyboardInterrupt:
+    # CSVファイルに残りの行を書き出してクローズ
+    csv_writer.close()
     # シリアルポートをクローズ
     ser.close()
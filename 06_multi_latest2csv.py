@@ -0,0 +1,151 @@
+# 埼玉大学データサイエンス技術研究会
+# サンプルコード
+#
+# 06_multi_latest2csv.py: 複数の環境センサから最新のセンサデータを取得し、CSVファイルに保存するプログラム #
+#
+# 使い方: python 06_multi_latest2csv.py [シリアルポート ...] [-i 記録間隔(秒)] [-b バイナリ形式の保存先フォルダ]
+#                                       [-p daily|hourly] [--influx URL --bucket BUCKET]
+#   シリアルポートを省略した場合は、接続されている環境センサ(2JCIE-BU)を自動で検出
+#
+# センサごとの読み込みは asyncio のタスクで並行して行い (シリアルポートの読み込みはスレッドで実行)、
+# 受信したデータは 1 つのキューから 1 つのCSVファイルに保存する
+# -b を指定した場合は、バイナリ形式のセグメントファイル (jciebu_binlog.py) にも保存する
+# -p を指定した場合は、日ごと・時間ごとのファイルに分けて保存し、フォルダのカタログ (catalog.json) に記録する
+# --influx を指定した場合は InfluxDB にも保存する (org とトークンは環境変数 INFLUX_ORG, INFLUX_TOKEN)
+#
+
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import serial
+from jciebu_binlog import BinlogWriter
+from jciebu_csv import CsvWriter
+from jciebu_influx import InfluxSink
+from jciebu_protocol import unpack_latest_data
+from jciebu_record import LATEST_DATA_SCHEMA, SensorRecord
+from jciebu_serial import find_ports, serial_read
+
+SERIAL_BAUDRATE = 115200
+
+# データの記録間隔
+INTERVAL = 60
+
+# CSVファイルを保存するフォルダ
+OUTPUT_FOLDER = 'csv_files'
+
+def get_latest_data(_port, ret):
+    """
+    最新データ(0x5021)のレスポンスを SensorRecord に変換する関数 (全センサ共通)
+    測定値は整数のまま格納し、CSVファイルに出力するときに変換する
+    """
+    return SensorRecord(LATEST_DATA_SCHEMA, unpack_latest_data(ret), time.time(), _port)
+
+async def poll_sensor(_port, _interval, _queue, _executor, _counter):
+    """
+    1 台の環境センサから _interval 秒ごとに最新データを読み込み、_queue に入れるタスク
+    読み込みにかかった時間を含めて _interval 秒ごとになるように待ち時間を調整
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        ser = await loop.run_in_executor(_executor, lambda: serial.Serial(
+            _port, SERIAL_BAUDRATE, serial.EIGHTBITS, serial.PARITY_NONE, write_timeout=1, timeout=1))
+    except serial.SerialException as e:
+        print('シリアルポートを開けません', _port, e)
+        return
+
+    print('Start recording sensor data:', _port)
+    payload = bytearray([0x01, # Read 0x01, Write 0x02
+                         0x21, 0x50]) # 最新データを取得 (0x5021 をリトルエンディアンで送信)
+    next_time = loop.time()
+    try:
+        while True:
+            ret = await loop.run_in_executor(_executor, serial_read, ser, payload)
+            if len(ret) > 0:
+                await _queue.put(get_latest_data(_port, ret))
+                _counter[_port] = _counter.get(_port, 0) + 1
+            next_time += _interval
+            await asyncio.sleep(max(next_time - loop.time(), 0))
+    except serial.SerialException as e:
+        print('シリアルポートのエラー', _port, e)
+    finally:
+        ser.close()
+
+async def write_csv(_queue, _output_file, _csv_writer, _binlog=None, _influx=None):
+    """
+    全センサのデータを _queue から取り出し、1 つのCSVファイルに保存するタスク
+    _binlog (BinlogWriter)、_influx (InfluxSink) を指定した場合は、セグメントファイル、InfluxDB にも保存
+    (InfluxSink.write は送信を待たないので、InfluxDB が応答しない間もセンサの読み込みは止まらない)
+    """
+    while True:
+        record = await _queue.get()
+        # レコードのフィールド名をCSVのヘッダーとして出力 (新しいファイルの場合)
+        _csv_writer.write(_output_file, ('time_measured', 'port') + record.schema.fields,
+                          [str(datetime.fromtimestamp(record.time)), record.device] + record.csv_values(),
+                          record.time, record.device)
+        if _binlog is not None:
+            _binlog.write(record)
+        if _influx is not None:
+            _influx.write(record)
+
+async def collect(_ports, _interval, _output_file, _counter, _csv_writer, _binlog=None, _influx=None):
+    """
+    全センサの読み込みタスクとCSVファイルへの保存タスクを 1 つのイベントループで実行する関数
+    """
+    queue = asyncio.Queue()
+    # シリアルポートの読み込みはセンサごとに 1 スレッド
+    executor = ThreadPoolExecutor(max_workers=len(_ports))
+    writer = asyncio.ensure_future(write_csv(queue, _output_file, _csv_writer, _binlog, _influx))
+    try:
+        await asyncio.gather(*[poll_sensor(port, _interval, queue, executor, _counter) for port in _ports])
+    finally:
+        writer.cancel()
+        executor.shutdown(wait=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ports', nargs='*', help='シリアルポート (省略時は自動で検出)')
+    parser.add_argument('-i', '--interval', type=float, default=INTERVAL, help='記録間隔 (秒)')
+    parser.add_argument('-b', '--binlog', help='バイナリ形式のセグメントファイルの保存先フォルダ')
+    parser.add_argument('-p', '--partition', choices=['daily', 'hourly'], help='ファイルを日ごと・時間ごとに分ける')
+    parser.add_argument('--influx', help='InfluxDB の URL (http://localhost:8086 など)')
+    parser.add_argument('--bucket', default='iot_2jciebu', help='InfluxDB のバケット')
+    args = parser.parse_args()
+
+    ports = args.ports if len(args.ports) > 0 else find_ports()
+    if len(ports) == 0:
+        print('環境センサ(2JCIE-BU)が見つかりません')
+        raise SystemExit(1)
+
+    # CSVファイルを保存するフォルダを作成
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+    _output_file = os.path.join(OUTPUT_FOLDER, 'iot_2jciebu_multi.csv')
+    print('出力先:', _output_file, ports)
+    print("Press Ctrl+C to stop recording")
+
+    # CSVファイルは開いたままにして、全センサの 1 回分ごとに書き出す
+    csv_writer = CsvWriter(flush_rows=len(ports), partition=args.partition)
+    binlog = BinlogWriter(args.binlog, partition=args.partition) if args.binlog else None
+    # InfluxDB には記録間隔より長く待たずに送信
+    influx = InfluxSink(args.influx, args.bucket, org=os.environ.get('INFLUX_ORG', ''),
+                        token=os.environ.get('INFLUX_TOKEN', ''), batch_size=len(ports)) if args.influx else None
+
+    counter = {}
+    start_time = datetime.now()
+    # try-except文を使って、Ctrl+C でプログラムを終了することができるようにする
+    try:
+        asyncio.run(collect(ports, args.interval, _output_file, counter, csv_writer, binlog, influx))
+    except KeyboardInterrupt:
+        pass
+    csv_writer.close()
+    if binlog is not None:
+        binlog.close()
+    if influx is not None:
+        influx.close()
+        print(f'InfluxDB: {influx.points} points sent, {influx.dropped} requests dropped, {influx.failed} failed')
+    elapsed = (datetime.now() - start_time).total_seconds()
+    for port in ports:
+        print(f'{port}: {counter.get(port, 0)} samples ({counter.get(port, 0) / elapsed:.2f} samples/s)')
@@ -5,27 +5,39 @@
 # Created: 2024/06/26
 # Last modified: 2024/06/27
 # 
-# 使い方: python 21_csv2stat.py (CSVファイル名)
+# 使い方: python 21_csv2stat.py (CSVファイル名 または セグメントファイル名(.jbl) または フォルダ名)
+#           [--start 開始日時] [--end 終了日時] [--device デバイス]
+#   フォルダを指定した場合は、カタログ (catalog.json) から期間と重なる日ごと・時間ごとのファイルだけを読み込む
+#   日時は 'YYYY-MM-DD' または 'YYYY-MM-DD HH:MM' (ローカル時刻、--end に日付だけを指定した場合はその日の終わりまで)
 #
 
 import pandas as pd
+import argparse
 import sys
 import os
+from jciebu_binlog import SEGMENT_EXT
+from jciebu_partition import read_dataframe
 
-args = sys.argv
+parser = argparse.ArgumentParser()
+parser.add_argument('file', help='CSVファイル、セグメントファイル(' + SEGMENT_EXT + ')、またはカタログのあるフォルダ')
+parser.add_argument('--start', help='開始日時 (YYYY-MM-DD [HH:MM])')
+parser.add_argument('--end', help='終了日時 (YYYY-MM-DD [HH:MM], 日付だけの場合はその日の終わりまで)')
+parser.add_argument('--device', help='デバイス (シリアルポート名、BLE のアドレス)')
+args = parser.parse_args()
 
-if not os.path.exists(args[1]):
-    print("指定されたファイルが見つかりません", args[1])
+if not os.path.exists(args.file):
+    print("指定されたファイルが見つかりません", args.file)
     sys.exit()
-elif not args[1].endswith(".csv"):
-    print("CSVファイルを指定してください")
+elif not os.path.isdir(args.file) and not args.file.endswith(".csv") and not args.file.endswith(SEGMENT_EXT):
+    print("CSVファイル、セグメントファイル(" + SEGMENT_EXT + ")、またはフォルダを指定してください")
     sys.exit()
 else:
-    # CSV形式で保存したセンサーデータをデータフレームに読み込む（index_col=0で1列目をインデックスに指定）
-    df = pd.read_csv(args[1], index_col=0)
+    # 保存したセンサーデータをデータフレームに読み込む（1列目の日時をインデックスに指定）
+    # セグメントファイルは文字列の解析なし、フォルダは期間と重なるファイルだけを読み込む
+    df = read_dataframe(args.file, args.start, args.end, args.device)
 
     # 読み込んだデータの統計情報を表示
     for column in df.columns:
-        if column not in ['timestamp', 'data_mode', 'sequence_number']:
+        if column not in ['timestamp', 'device', 'port', 'data_mode', 'sequence_number']:
             print('\n##', column)
             print(df[column].describe())
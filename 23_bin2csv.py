@@ -0,0 +1,37 @@
+# 埼玉大学データサイエンス技術研究会
+# サンプルコード
+# Description: バイナリ形式で保存したセンサーデータ (セグメントファイル .jbl) をCSVファイルに変換する
+#
+# 使い方: python 23_bin2csv.py (セグメントファイル名) [-o 出力するCSVファイル名] [-d デバイス]
+#   -o を省略した場合は、セグメントファイルの拡張子を .csv に変えたファイルに出力
+#   -d を指定した場合は、そのデバイス (シリアルポート名、BLE のアドレス) のデータだけを出力
+#   -l を指定した場合は、セグメントファイルのスキーマとデバイスの一覧を表示
+#
+
+import argparse
+import os
+import sys
+from jciebu_binlog import SEGMENT_EXT, read_segment, segment_to_csv
+
+parser = argparse.ArgumentParser()
+parser.add_argument('segment', help='セグメントファイル (' + SEGMENT_EXT + ')')
+parser.add_argument('-o', '--output', help='出力するCSVファイル')
+parser.add_argument('-d', '--device', help='出力するデバイス')
+parser.add_argument('-l', '--list', action='store_true', help='スキーマとデバイスの一覧を表示')
+args = parser.parse_args()
+
+if not os.path.exists(args.segment):
+    print("指定されたファイルが見つかりません", args.segment)
+    sys.exit()
+
+if args.list:
+    header, rows = read_segment(args.segment)
+    print('schema:', header['schema'], 'data_mode:', header['mode'], 'rows:', len(rows))
+    print('fields:', ','.join(header['fields']))
+    for i, device in enumerate(header['devices']):
+        print(f'device {i}: {device} ({int((rows["device"] == i).sum())} rows)')
+    sys.exit()
+
+output_file = args.output if args.output else os.path.splitext(args.segment)[0] + '.csv'
+rows = segment_to_csv(args.segment, output_file, args.device)
+print(f'{rows} rows ->', output_file)
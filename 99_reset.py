@@ -13,28 +13,12 @@ import time
 from datetime import datetime
 from struct import pack, unpack
 import serial
+from jciebu_protocol import build_frame, frame_length, verify_crc
 
 # シリアルポートの設定
 SERIAL_PORT = "COM3"
 SERIAL_BAUDRATE = 115200
 
-def calc_crc(buf, length):
-    """
-    CRC-16 を計算する関数
-
-    """
-    crc = 0xFFFF
-    for i in range(length):
-        crc = crc ^ buf[i]
-        for i in range(8):
-            carrayFlag = crc & 1
-            crc = crc >> 1
-            if (carrayFlag == 1):
-                crc = crc ^ 0xA001
-    crcH = crc >> 8
-    crcL = crc & 0x00FF
-    return (bytearray([crcL, crcH]))
-
 def s16(value):
     return -(value & 0x8000) | (value & 0x7fff)
 
@@ -43,8 +27,7 @@ def serial_write(_ser, _payload):
     シリアルポートにコマンドを送信する関数
     _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
     """
-    _command = b'\x52\x42' + pack('<H', len(_payload) + 2) + _payload
-    _command = _command + calc_crc(_command, len(_command))
+    _command = build_frame(_payload)
     _ser.write(_command)
     _ser.flush()
     time.sleep(0.1)
@@ -64,6 +47,8 @@ def serial_read(_ser, _payload):
     ret = _ser.read(ser.inWaiting())
     if ret[0:2] != b'\x52\x42':
         raise print("Invalid Header", ret)
+    if not verify_crc(ret[:frame_length(ret)]):
+        raise print("CRC Error", ret)
     if ret[4] != 1 and ret[4] != 2:
         for i in range(len(ret)):
             print(f'({i}) {ret[i]:02x}', end=' ')
@@ -0,0 +1,754 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュールのベンチマーク
+#
+# bench_2jciebu.py: 共通モジュールの処理時間を従来のコードと比較するプログラム #
+#
+# 使い方: python bench_2jciebu.py crc
+#         python bench_2jciebu.py frame
+#         python bench_2jciebu.py latency [--port PORT]  (PORT 省略時は jciebu_emulator の疑似端末で計測, Linux のみ)
+#         python bench_2jciebu.py pipeline [--port PORT]
+#         python bench_2jciebu.py acc
+#         python bench_2jciebu.py download [--port PORT] [--pages PAGES] [--drop-rate RATE] [--crc-rate RATE]
+#         python bench_2jciebu.py latest
+#         python bench_2jciebu.py record [--csv CSV]
+#         python bench_2jciebu.py csv [--rows ROWS] [--fsync]
+#         python bench_2jciebu.py binlog [--csv CSV]
+#         python bench_2jciebu.py influx [--points POINTS] [--devices N ...] [--fail-rate RATE]
+#         python bench_2jciebu.py spool [--records RECORDS] [--sink-delay MS] [--outage SEC]
+#         python bench_2jciebu.py adv
+#
+
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+from datetime import datetime
+
+from jciebu_protocol import FrameDecoder, build_frame, calc_crc, verify_crc
+
+def calc_crc_bitwise(buf, length):
+    """
+    従来の各プログラムにあった CRC-16 の計算 (1ビットずつシフト)
+    """
+    crc = 0xFFFF
+    for i in range(length):
+        crc = crc ^ buf[i]
+        for i in range(8):
+            carrayFlag = crc & 1
+            crc = crc >> 1
+            if (carrayFlag == 1):
+                crc = crc ^ 0xA001
+    crcH = crc >> 8
+    crcL = crc & 0x00FF
+    return (bytearray([crcL, crcH]))
+
+def report(name, number, sec_old, sec_new):
+    """
+    従来版と新版の 1 回あたりの処理時間と速度比を表示する関数
+    """
+    old_us = sec_old / number * 1e6
+    new_us = sec_new / number * 1e6
+    print(f'{name:<32} old={old_us:10.2f} us  new={new_us:10.2f} us  x{old_us / new_us:.1f}')
+
+def bench_crc(args):
+    """
+    CRC-16: ビットループ版とテーブル版の比較
+    5 バイトのコマンドフレーム (Length=5 の読み出しコマンド) と 2KB のフレームで計測
+    """
+    rnd = random.Random(0)
+    command = build_frame(bytearray([0x01, 0x21, 0x50]))[:-2]
+    page = rnd.randbytes(2048)
+    frame = build_frame(page)
+    for b in (command, page):
+        assert calc_crc(b) == calc_crc_bitwise(b, len(b))
+
+    for name, buf, number in (('command frame (7 byte)', command, args.number * 100),
+                              ('acceleration frame (2 KB)', page, args.number)):
+        sec_old = timeit.timeit(lambda: calc_crc_bitwise(buf, len(buf)), number=number)
+        sec_new = timeit.timeit(lambda: calc_crc(buf, len(buf)), number=number)
+        report('calc_crc ' + name, number, sec_old, sec_new)
+
+    # memoryview を使ったフレーム検証 (コピーなし)
+    _mv = memoryview(frame)
+    number = args.number
+    sec_old = timeit.timeit(lambda: calc_crc_bitwise(frame, len(frame) - 2) == frame[-2:], number=number)
+    sec_new = timeit.timeit(lambda: verify_crc(_mv), number=number)
+    report('verify acceleration frame', number, sec_old, sec_new)
+
+def acc_page_stream(pages, seed=0):
+    """
+    加速度データ(0x503F)のレスポンスを模した 237 バイト/ページのフレーム列を返す関数
+    """
+    rnd = random.Random(seed)
+    return b''.join(build_frame(bytearray([0x01, 0x3F, 0x50]) + rnd.randbytes(228)) for i in range(pages))
+
+def bench_frame(args):
+    """
+    フレームの受信: bytes の連結 (ret += ser.read(n)) と FrameDecoder の比較
+    どちらも各ページの CRC-16 を検証する
+    複数ページの加速度データを 64 バイトずつ受信した場合と、1 フレームをまとめて受信した場合で計測
+    """
+    chunk = 64
+    for pages in (1, 100, 1000):
+        stream = acc_page_stream(pages)
+        chunks = [stream[i:i+chunk] for i in range(0, len(stream), chunk)]
+
+        def concat():
+            ret = b''
+            for c in chunks:
+                ret += c
+            frames = [ret[i*237:(i+1)*237] for i in range(pages)]
+            return [frame for frame in frames if verify_crc(frame)]
+
+        def decode():
+            decoder = FrameDecoder()
+            frames = []
+            for c in chunks:
+                decoder.feed(c)
+                frames.extend(decoder)
+            return frames
+
+        assert len(decode()) == pages
+        number = max(1, args.number // pages)
+        sec_old = timeit.timeit(concat, number=number)
+        sec_new = timeit.timeit(decode, number=number)
+        report(f'receive {pages} pages', number, sec_old, sec_new)
+
+    # 1 回のコマンドのレスポンス (1 フレームをまとめて受信した場合, FrameDecoder の 1 フレームの高速化)
+    frame = acc_page_stream(1)
+
+    def concat_one():
+        ret = b''
+        ret += frame
+        return verify_crc(ret)
+
+    def decode_one():
+        decoder = FrameDecoder()
+        decoder.feed(frame)
+        return decoder.next_frame() is not None
+
+    assert decode_one()
+    sec_old = timeit.timeit(concat_one, number=args.number)
+    sec_new = timeit.timeit(decode_one, number=args.number)
+    report('receive 1 response', args.number, sec_old, sec_new)
+
+def serial_read_polling(_ser, _payload):
+    """
+    従来の serial_read (inWaiting() と sleep(0.1) によるポーリング)
+    """
+    _ser.write(build_frame(_payload))
+    _ser.flush()
+    ret = b''
+    command_head_len = 4
+    while True:
+        _ser_len = _ser.inWaiting()
+        if _ser_len > 0:
+            ret += _ser.read(_ser_len)
+            if len(ret) >= (ret[2] | (ret[3] << 8)) + command_head_len:
+                break
+        else:
+            time.sleep(0.1)
+    return ret
+
+def emulator_port(args, **faults):
+    """
+    --port を省略した場合に、疑似端末の環境センサ (jciebu_emulator.SensorEmulator) を起動してデバイス名を返す関数
+    """
+    from jciebu_emulator import SensorEmulator
+
+    if args.port is not None:
+        return args.port
+    return SensorEmulator(delay=args.delay / 1000, **faults).start()
+
+def bench_latency(args):
+    """
+    0x5021 (最新データ) の往復時間: ポーリング版と、長さを指定したブロッキング読み込みの比較
+    """
+    import serial
+    from jciebu_serial import serial_read
+
+    port = emulator_port(args)
+    ser = serial.Serial(port, 115200, serial.EIGHTBITS, serial.PARITY_NONE, write_timeout=1, timeout=1)
+    payload = bytearray([0x01, 0x21, 0x50])
+    number = max(1, args.number // 10)
+    for name, func in (('polling (inWaiting/sleep)', serial_read_polling),
+                       ('blocking (length-driven)', serial_read)):
+        ser.reset_input_buffer()
+        func(ser, payload)
+        rtt = []
+        for i in range(number):
+            t = time.perf_counter()
+            ret = func(ser, payload)
+            rtt.append((time.perf_counter() - t) * 1000)
+            assert len(ret) == 58
+        rtt.sort()
+        print(f'{name:<28} n={number}  median={rtt[len(rtt) // 2]:8.2f} ms  max={rtt[-1]:8.2f} ms')
+    ser.close()
+
+def bench_pipeline(args):
+    """
+    1 回の読み込みで 0x5021 (最新データ) と 0x5201 (時刻カウンタ) を取得する時間:
+    1 コマンドずつ送受信する場合と CommandQueue でまとめて送信する場合の比較
+    """
+    import serial
+    from jciebu_serial import CommandQueue, serial_read
+
+    port = emulator_port(args)
+    ser = serial.Serial(port, 115200, serial.EIGHTBITS, serial.PARITY_NONE, write_timeout=1, timeout=1)
+    payloads = [bytearray([0x01, 0x21, 0x50]), bytearray([0x01, 0x01, 0x52])]
+    command_queue = CommandQueue(ser)
+
+    def sequential():
+        return [serial_read(ser, p) for p in payloads]
+
+    def pipelined():
+        return command_queue.request(*payloads)
+
+    number = max(1, args.number // 10)
+    for name, func in (('sequential', sequential), ('pipelined (CommandQueue)', pipelined)):
+        func()
+        tick = []
+        for i in range(number):
+            t = time.perf_counter()
+            ret = func()
+            tick.append((time.perf_counter() - t) * 1000)
+            assert [len(r) for r in ret] == [58, 17]
+        tick.sort()
+        print(f'{name:<28} n={number}  median={tick[len(tick) // 2]:8.2f} ms  max={tick[-1]:8.2f} ms')
+    ser.close()
+
+def s16(value):
+    return -(value & 0x8000) | (value & 0x7fff)
+
+def read_acc_data_pages(_acc_data, _page, _time):
+    """
+    従来の 05_latestWacc2csv.py の加速度データの変換 (1 サンプルずつ辞書に変換)
+    """
+    retval = []
+    for i in range(0, len(_acc_data)-1, 6):
+        if i+5 >= len(_acc_data):
+            break
+        x = s16(_acc_data[i+1] << 8 | _acc_data[i]) * 0.1
+        y = s16(_acc_data[i+3] << 8 | _acc_data[i+2]) * 0.1
+        z = s16(_acc_data[i+5] << 8 | _acc_data[i+4]) * 0.1
+        _timestamp = datetime.fromtimestamp(_time + (_page*32+i/6) * 0.01)
+        retval.append({"time_measured": _timestamp, 'acc_x': x, 'acc_y': y, 'acc_z': z})
+    return retval
+
+def bench_acc(args):
+    """
+    加速度データ(0x503F)の変換: ページごとの辞書のリストの連結と decode_acc_pages (NumPy) の比較
+    """
+    from jciebu_acc import decode_acc_pages
+
+    start = time.time()
+    for pages in (10, 100, 1000):
+        stream = acc_page_stream(pages)
+
+        def old():
+            acc_data = []
+            for i in range(pages):
+                acc_data = acc_data + read_acc_data_pages(stream[i*237+43:(i+1)*237-2], i, start)
+            return acc_data
+
+        def new():
+            return decode_acc_pages(stream, start)
+
+        assert len(old()) == len(new()['acc_x']) == pages * 32
+        number = max(1, args.number // pages)
+        sec_old = timeit.timeit(old, number=number)
+        sec_new = timeit.timeit(new, number=number)
+        report(f'decode {pages} pages ({pages * 32} samples)', number, sec_old, sec_new)
+
+def bench_download(args):
+    """
+    加速度メモリのデータの読み込み: AccDownloader の chunk_pages ごとの転送速度
+    """
+    import serial
+    from jciebu_acc import AccDownloader
+
+    port = emulator_port(args, acc_pages=args.pages, drop_rate=args.drop_rate, crc_rate=args.crc_rate)
+    ser = serial.Serial(port, 115200, serial.EIGHTBITS, serial.PARITY_NONE, write_timeout=1, timeout=1)
+    for chunk_pages in (1, 8, 32, args.pages):
+        samples = []
+        downloader = AccDownloader(ser, 0x00, args.pages, time.time(), chunk_pages=chunk_pages)
+        assert downloader.run(lambda acc: samples.append(len(acc['acc_x'])), retries=10)
+        assert sum(samples) == args.pages * 32
+        pages_per_sec, bytes_per_sec = downloader.throughput()
+        print(f'chunk_pages={chunk_pages:<5} {pages_per_sec:8.1f} pages/s  {bytes_per_sec:10.0f} bytes/s')
+    ser.close()
+
+def get_latest_data_hex(data):
+    """
+    従来の 03_latest2csv.py の get_latest_data (16進数の文字列を経由して変換)
+    """
+    time_measured = datetime.now().strftime("%Y/%m/%d %H:%M:%S.%f")
+    temperature = str( s16(int(hex(data[9]) + '{:02x}'.format(data[8], 'x'), 16)) / 100)
+    relative_humidity = str(int(hex(data[11]) + '{:02x}'.format(data[10], 'x'), 16) / 100)
+    ambient_light = str(int(hex(data[13]) + '{:02x}'.format(data[12], 'x'), 16))
+    barometric_pressure = str(int(hex(data[17]) + '{:02x}'.format(data[16], 'x')
+                                  + '{:02x}'.format(data[15], 'x') + '{:02x}'.format(data[14], 'x'), 16) / 1000)
+    sound_noise = str(int(hex(data[19]) + '{:02x}'.format(data[18], 'x'), 16) / 100)
+    eTVOC = str(int(hex(data[21]) + '{:02x}'.format(data[20], 'x'), 16))
+    eCO2 = str(int(hex(data[23]) + '{:02x}'.format(data[22], 'x'), 16))
+    discomfort_index = str(int(hex(data[25]) + '{:02x}'.format(data[24], 'x'), 16) / 100)
+    heat_stroke = str(s16(int(hex(data[27]) + '{:02x}'.format(data[26], 'x'), 16)) / 100)
+    vibration_information = str(int(hex(data[28]), 16))
+    si_value = str(int(hex(data[30]) + '{:02x}'.format(data[29], 'x'), 16) / 10)
+    pga = str(int(hex(data[32]) + '{:02x}'.format(data[31], 'x'), 16) / 10)
+    seismic_intensity = str(int(hex(data[34]) + '{:02x}'.format(data[33], 'x'), 16) / 1000)
+    temperature_flag = str(int(hex(data[36]) + '{:02x}'.format(data[35], 'x'), 16))
+    relative_humidity_flag = str(int(hex(data[38]) + '{:02x}'.format(data[37], 'x'), 16))
+    ambient_light_flag = str(int(hex(data[40]) + '{:02x}'.format(data[39], 'x'), 16))
+    barometric_pressure_flag = str(int(hex(data[42]) + '{:02x}'.format(data[41], 'x'), 16))
+    sound_noise_flag = str(int(hex(data[44]) + '{:02x}'.format(data[43], 'x'), 16))
+    etvoc_flag = str(int(hex(data[46]) + '{:02x}'.format(data[45], 'x'), 16))
+    eco2_flag = str(int(hex(data[48]) + '{:02x}'.format(data[47], 'x'), 16))
+    discomfort_index_flag = str(int(hex(data[50]) + '{:02x}'.format(data[49], 'x'), 16))
+    heat_stroke_flag = str(int(hex(data[52]) + '{:02x}'.format(data[51], 'x'), 16))
+    si_value_flag = str(int(hex(data[53]), 16))
+    pga_flag = str(int(hex(data[54]), 16))
+    seismic_intensity_flag = str(int(hex(data[55]), 16))
+
+    return {'time_measured': time_measured,
+            'temperature': temperature,
+            'relative_humidity': relative_humidity,
+            'ambient_light': ambient_light,
+            'barometric_pressure': barometric_pressure,
+            'sound_noise': sound_noise,
+            'eTVOC': eTVOC,
+            'eCO2': eCO2,
+            'discomfort_index': discomfort_index,
+            'heat_stroke': heat_stroke,
+            'vibration_information': vibration_information,
+            'si_value': si_value,
+            'pga': pga,
+            'seismic_intensity': seismic_intensity,
+            'temperature_flag': temperature_flag,
+            'relative_humidity_flag': relative_humidity_flag,
+            'ambient_light_flag': ambient_light_flag,
+            'barometric_pressure_flag': barometric_pressure_flag,
+            'sound_noise_flag': sound_noise_flag,
+            'eTVOC_flag': etvoc_flag,
+            'eCO2_flag': eco2_flag,
+            'discomfort_index_flag': discomfort_index_flag,
+            'heat_stroke_flag': heat_stroke_flag,
+            'si_value_flag': si_value_flag,
+            'pga_flag': pga_flag,
+            'seismic_intensity_flag': seismic_intensity_flag}
+
+def latest_frames(count, seed=0):
+    """
+    最新データ(0x5021)のレスポンスを模した 58 バイトのフレームのリストを返す関数
+    """
+    rnd = random.Random(seed)
+    return [build_frame(bytearray([0x01, 0x21, 0x50]) + rnd.randbytes(49)) for i in range(count)]
+
+def bench_latest(args):
+    """
+    最新データ(0x5021)の変換: 16進数の文字列を経由する従来版と struct による変換の比較
+    """
+    from jciebu_protocol import decode_latest_data, unpack_latest_data, unpack_latest_data_batch
+
+    frames = latest_frames(1000)
+    for frame in frames[:100]:
+        old = get_latest_data_hex(frame)
+        new = decode_latest_data(frame)
+        assert all(old[k] == str(new[k]) for k in old if k != 'time_measured')
+
+    number = max(1, args.number // 20)
+    sec_old = timeit.timeit(lambda: [get_latest_data_hex(f) for f in frames], number=number)
+    for name, func in (('decode_latest_data (dict)', lambda: [decode_latest_data(f) for f in frames]),
+                       ('unpack_latest_data (tuple)', lambda: [unpack_latest_data(f) for f in frames]),
+                       ('unpack_latest_data_batch', lambda: unpack_latest_data_batch(frames))):
+        sec_new = timeit.timeit(func, number=number)
+        report(name + ' x1000', number, sec_old, sec_new)
+
+def measure_memory(func):
+    """
+    func() の戻り値が保持しているメモリ (バイト) を tracemalloc で計測する関数
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+def write_adv_csv_file(_file, modes, rows, seed=0):
+    """
+    ble_2jcie-bu_adv2csv.py と同じ形式の CSV ファイル (ヘッダーは最初のレコードのデータモード) を作成し、
+    書き出したレコードのリストを返す関数 (modes のデータモードを順に繰り返す)
+    """
+    from jciebu_record import ADV_SCHEMAS, SensorRecord, adv_csv_timestamp
+
+    limits = {'b': (-0x80, 0x7F), 'B': (0, 0xFF), 'h': (-0x8000, 0x7FFF), 'H': (0, 0xFFFF),
+              'l': (-0x80000000, 0x7FFFFFFF), 'L': (0, 0xFFFFFFFF)}
+    rnd = random.Random(seed)
+    records = []
+    with open(_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i in range(rows):
+            schema = ADV_SCHEMAS[modes[i % len(modes)]]
+            values = tuple([bytes(rnd.choice(b'0123456789,"\'') for _ in range(10)) if t.endswith('s')
+                            else rnd.randint(*limits[t]) for t in schema.types])
+            record = SensorRecord(schema, values, 1714747763.94 + i * 60.0 + rnd.random(), 'CA43F0B62495')
+            if i == 0:
+                writer.writerow(('datetime', 'timestamp', 'data_mode') + schema.fields)
+            writer.writerow([datetime.fromtimestamp(record.time).strftime('%Y-%m-%d %H:%M:%S'),
+                             str(adv_csv_timestamp(record.time)), str(schema.mode)] + record.csv_values())
+            records.append(record)
+    return records
+
+def bench_record(args):
+    """
+    受信データの保持形式: 文字列の辞書 (従来版) と SensorRecord (整数のタプル) の 1 行あたりのメモリと処理時間
+    """
+    from jciebu_protocol import unpack_latest_data
+    from jciebu_record import LATEST_DATA_SCHEMA, SensorRecord, read_adv_csv
+
+    frames = latest_frames(10000)
+    rows_old, mem_old = measure_memory(lambda: [get_latest_data_hex(f) for f in frames])
+    rows_new, mem_new = measure_memory(lambda: [SensorRecord(LATEST_DATA_SCHEMA, unpack_latest_data(f))
+                                                for f in frames])
+    assert all(list(o.values())[1:] == n.csv_values()[1:] for o, n in zip(rows_old[:100], rows_new[:100]))
+    print(f'{"0x5021 rows (memory/row)":<32} old={mem_old / len(frames):10.0f} B   new={mem_new / len(frames):10.0f} B   x{mem_old / mem_new:.1f}')
+
+    # 受信から CSV の 1 行を作るまでの処理時間
+    frames = frames[:1000]
+    number = max(1, args.number // 20)
+    sec_old = timeit.timeit(lambda: [','.join(get_latest_data_hex(f).values()) for f in frames], number=number)
+    sec_new = timeit.timeit(lambda: [','.join(SensorRecord(LATEST_DATA_SCHEMA, unpack_latest_data(f)).csv_values()[1:])
+                                     for f in frames], number=number)
+    report('0x5021 decode + csv line x1000', number, sec_old, sec_new)
+
+    # データモード 1 - 5 だけの CSV、混在した CSV、空の CSV を一時フォルダに作成し、
+    # read_adv_csv で書き出したとおりのレコードに戻ることを確認
+    from jciebu_record import adv_csv_timestamp
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, modes, rows in [(f'mode{m}', (m,), 500) for m in range(1, 6)] + \
+                                 [('mixed', (1, 2, 3, 4, 5, 3, 1), 700), ('empty', (1,), 0)]:
+            _file = os.path.join(tmp, 'CA43F0B62495.csv')
+            records = write_adv_csv_file(_file, modes, rows)
+            loaded = read_adv_csv(_file)
+            assert [(r.schema, r.values, r.device) for r in loaded] == \
+                [(r.schema, r.values, r.device) for r in records], name
+            assert [r.time for r in loaded] == [float(str(adv_csv_timestamp(r.time))) for r in records], name
+    print(f'{"csv round trip (mode 1-5, mixed, empty)":<32} ok')
+
+    # 保存済みの CSV ファイルの読み込み (csv.DictReader の辞書と SensorRecord)
+    if os.path.exists(args.csv):
+        def load_dict():
+            with open(args.csv) as f:
+                return list(csv.DictReader(f))
+        rows_old, mem_old = measure_memory(load_dict)
+        rows_new, mem_new = measure_memory(lambda: read_adv_csv(args.csv))
+        assert len(rows_old) == len(rows_new)
+        print(f'{"csv rows (memory/row)":<32} old={mem_old / len(rows_old):10.0f} B   new={mem_new / len(rows_new):10.0f} B   x{mem_old / mem_new:.1f}  ({len(rows_new)} rows)')
+        sec_old = timeit.timeit(load_dict, number=1)
+        sec_new = timeit.timeit(lambda: read_adv_csv(args.csv), number=1)
+        report(f'csv load x{len(rows_new)}', 1, sec_old, sec_new)
+
+def data2csv_open(_data, _output_file):
+    """
+    従来の data2csv (ファイルの存在確認とオープンを毎回行い、文字列を連結して 1 行を作成)
+    """
+    if not os.path.exists(_output_file):
+        _header = ''
+        for key in _data[0].keys():
+            if len(_header) == 0:
+                _header = key
+            else:
+                _header = _header + ',' + key
+        with open(_output_file, 'a') as f:
+            f.write(_header + '\n')
+    with open(_output_file, 'a') as f:
+        for _row in _data:
+            _output = ''
+            for key in _row.keys():
+                if len(_output) == 0:
+                    _output = str(_row[key])
+                else:
+                    _output = _output + ',' + str(_row[key])
+            f.write(_output + '\n')
+
+def bench_csv(args):
+    """
+    CSVファイルへの 1 行ずつの追記: 毎回オープンする従来版と CsvWriter (ファイルを開いたまま、まとめて flush) の比較
+    4 台のセンサのファイルに交互に書き込む
+    """
+    from jciebu_csv import CsvWriter
+    from jciebu_protocol import decode_latest_data
+
+    rows = [{'time_measured': datetime.now(), **decode_latest_data(f)} for f in latest_frames(args.rows)]
+    with tempfile.TemporaryDirectory() as tmp:
+        def old():
+            for i, row in enumerate(rows):
+                data2csv_open([row], os.path.join(tmp, f'old{i % 4}.csv'))
+                if args.fsync:
+                    with open(os.path.join(tmp, f'old{i % 4}.csv'), 'a') as f:
+                        os.fsync(f.fileno())
+
+        writer = CsvWriter(flush_rows=100, flush_interval=10.0, fsync=args.fsync)
+        def new():
+            for i, row in enumerate(rows):
+                writer.write(os.path.join(tmp, f'new{i % 4}.csv'), row.keys(), map(str, row.values()))
+            writer.close()
+
+        sec_old = timeit.timeit(old, number=1)
+        sec_new = timeit.timeit(new, number=1)
+        for i in range(4):
+            with open(os.path.join(tmp, f'old{i}.csv')) as f_old, open(os.path.join(tmp, f'new{i}.csv')) as f_new:
+                assert f_old.read() == f_new.read()
+        report(f'csv append x{args.rows}' + (' (fsync)' if args.fsync else ''), args.rows, sec_old, sec_new)
+        print(f'flush: old={args.rows} new={writer.flushes}')
+
+def bench_binlog(args):
+    """
+    保存済みのデータの読み込み: CSV ファイルの解析とセグメントファイル (np.memmap) の比較
+    """
+    import numpy as np
+    from jciebu_binlog import BinlogWriter, read_segment, segment_arrays
+    from jciebu_record import read_adv_csv
+
+    records = read_adv_csv(args.csv)
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = BinlogWriter(tmp)
+        for record in records:
+            writer.write(record)
+        writer.close()
+        segment = writer.segment_path(records[0])
+
+        def load_csv():
+            with open(args.csv) as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                columns = list(zip(*reader))
+            return {k: np.array(v, dtype=float) for k, v in zip(header[1:], columns[1:])}
+
+        def load_segment():
+            header, rows = read_segment(segment)
+            return segment_arrays(header, rows)
+
+        old = load_csv()
+        new = load_segment()
+        assert np.allclose(old['temparature'], new['temparature'])
+        rows = len(records)
+        print(f'{"file size (bytes/row)":<32} old={os.path.getsize(args.csv) / rows:10.1f} B   new={(os.path.getsize(segment)) / rows:10.1f} B   ({rows} rows)')
+        number = max(1, args.number // 20)
+        report(f'load columns x{rows} (csv)', number, timeit.timeit(load_csv, number=number),
+               timeit.timeit(load_segment, number=number))
+        try:
+            import pandas as pd
+            from jciebu_binlog import segment_dataframe
+            report(f'load dataframe x{rows} (pandas)', number,
+                   timeit.timeit(lambda: pd.read_csv(args.csv, index_col=0), number=number),
+                   timeit.timeit(lambda: segment_dataframe(segment), number=number))
+        except ImportError:
+            pass
+
+def bench_influx(args):
+    """
+    InfluxDB への送信: 1 点ごとのリクエスト (従来の書き方) と InfluxSink (まとめて gzip で並行送信) の点/秒
+    送信先は LocalInfluxServer (受信したリクエストを記録するだけ)
+    """
+    from urllib.request import Request, urlopen
+    from jciebu_influx import InfluxSink, LineEncoder, LocalInfluxServer
+    from jciebu_protocol import unpack_latest_data
+    from jciebu_record import LATEST_DATA_SCHEMA, SensorRecord
+
+    values = [unpack_latest_data(f) for f in latest_frames(1000)]
+    t0 = time.time()
+
+    def records(count, devices):
+        return [SensorRecord(LATEST_DATA_SCHEMA, values[i % len(values)], t0 + i * 0.001, f'sensor{i % devices:03d}')
+                for i in range(count)]
+
+    # 1 点ごとに POST (圧縮なし)
+    server = LocalInfluxServer()
+    encoder = LineEncoder()
+    single = records(min(args.points, 500), 1)
+    t = time.perf_counter()
+    for record in single:
+        with urlopen(Request(server.url + '/api/v2/write?bucket=b&precision=ns',
+                             data=encoder.encode(record).encode(), method='POST')) as res:
+            res.read()
+    sec = time.perf_counter() - t
+    assert len(server.lines()) == len(single)
+    server.close()
+    print(f'{"one request per point":<32} {len(single) / sec:12.0f} points/s')
+
+    for devices in args.devices:
+        server = LocalInfluxServer(fail_rate=args.fail_rate)
+        points = records(args.points, devices)
+        # write は待たないので、送信中のリクエストが多すぎる分は保持して close (flush) で送る
+        sink = InfluxSink(server.url, 'bucket', batch_size=5000, workers=4, backoff=0.01, keep_failed=True)
+        t = time.perf_counter()
+        for record in points:
+            sink.write(record)
+        sink.close()
+        sec = time.perf_counter() - t
+        received = server.lines()
+        assert len(received) == len(points) and sink.failed == 0
+        server.close()
+        print(f'{"InfluxSink devices=" + str(devices):<32} {len(points) / sec:12.0f} points/s'
+              f'  ({sink.batches} batches, {sink.bytes_sent / len(points):.1f} bytes/point gzip, {sink.retried} retries)')
+
+def bench_spool(args):
+    """
+    受信側の 1 件あたりの処理時間: 出力先に直接書く場合 (従来の書き方) とスプールに追記する場合
+    出力先は 1 回の呼び出しに sink_delay ミリ秒かかる関数 (ネットワークや SD カードの遅延を想定)、
+    outage 秒の間は例外を送出する (出力先の停止を想定)
+    """
+    from jciebu_protocol import unpack_latest_data
+    from jciebu_record import LATEST_DATA_SCHEMA, SensorRecord
+    from jciebu_spool import Spool, SpoolDrainer
+
+    values = [unpack_latest_data(f) for f in latest_frames(1000)]
+    records = [SensorRecord(LATEST_DATA_SCHEMA, values[i % len(values)], time.time(), 'COM3')
+               for i in range(args.records)]
+    delay = args.sink_delay / 1000
+    received = []
+    down_until = [0.0]
+
+    def sink(batch):
+        time.sleep(delay)
+        if time.monotonic() < down_until[0]:
+            raise OSError('sink is down')
+        received.extend(r.values for r in batch)
+
+    def percentiles(name, latencies):
+        latencies.sort()
+        us = [latencies[int(len(latencies) * p)] * 1e6 for p in (0.5, 0.99)] + [latencies[-1] * 1e6]
+        print(f'{name:<32} p50={us[0]:10.1f} us  p99={us[1]:10.1f} us  max={us[2]:10.1f} us')
+
+    # 受信のたびに出力先に書く (出力先が止まっている間は受信も止まる)
+    direct = records[:min(len(records), 200)]
+    latencies = []
+    for record in direct:
+        t = time.perf_counter()
+        sink([record])
+        latencies.append(time.perf_counter() - t)
+    percentiles('direct sink', latencies)
+
+    # スプールに追記し、出力は SpoolDrainer のスレッドで行う
+    received.clear()
+    with tempfile.TemporaryDirectory() as folder:
+        spool = Spool(folder)
+        drainer = SpoolDrainer(spool, sink, interval=0.01, retry_interval=0.1)
+        drainer.start()
+        down_until[0] = time.monotonic() + args.outage
+        latencies = []
+        for record in records:
+            t = time.perf_counter()
+            spool.append_record(record)
+            latencies.append(time.perf_counter() - t)
+        backlog = spool.backlog()
+        t = time.perf_counter()
+        while time.monotonic() < down_until[0] or spool.backlog() > 0:
+            time.sleep(0.01)
+        drainer.stop()
+        sec = time.perf_counter() - t
+        spool.close()
+        assert received == [r.values for r in records]
+        percentiles('Spool.append_record', latencies)
+        print(f'{"backlog after receiving":<32} {backlog:10d} bytes  drained in {sec:.2f} s'
+              f'  ({drainer.errors} sink errors, {len(records)} records)')
+
+def bytetoint(buf, sig):
+    return int.from_bytes(buf, byteorder='little', signed=sig)
+
+def unpack_adv_slices(data):
+    """
+    従来の ble_2jcie-bu_adv2csv.py の advtype01 - advtype05 (フィールドごとにスライスを作って int.from_bytes)
+    """
+    mode = data[0]
+    if mode == 1 or (mode == 3 and len(data) == 19):
+        return (bytetoint(data[1:2], False), bytetoint(data[2:4], True), bytetoint(data[4:6], False),
+                bytetoint(data[6:8], False), bytetoint(data[8:12], False), bytetoint(data[12:14], False),
+                bytetoint(data[14:16], False), bytetoint(data[16:18], False))
+    if mode == 2 or (mode == 3 and len(data) == 27):
+        return (bytetoint(data[1:2], False), bytetoint(data[2:4], False), bytetoint(data[4:6], True),
+                bytetoint(data[6:7], False), bytetoint(data[7:9], False), bytetoint(data[9:11], False),
+                bytetoint(data[11:13], False), bytetoint(data[13:15], True), bytetoint(data[15:17], True),
+                bytetoint(data[17:19], True))
+    if mode == 4 and len(data) == 19:
+        return tuple([bytetoint(data[1:2], False)] + [bytetoint(data[i:i + 2], False) for i in range(2, 16, 2)])
+    if mode == 4 and len(data) == 27:
+        return (bytetoint(data[1:2], False), bytetoint(data[2:4], False), bytetoint(data[4:6], False),
+                data[6], data[7], data[8])
+    if mode == 5:
+        return (bytes(data[1:11]), bytetoint(data[11:15], False))
+
+def adv_packets(count, seed=0):
+    """
+    各データモードの manufacturer_data[0x02D5] を模したパケットのリストを返す関数
+    (データモード 1, 2, 5 は 20 バイト、データモード 3, 4 は 19 バイトと 27 バイト)
+    """
+    rnd = random.Random(seed)
+    shapes = ((1, 20), (2, 20), (3, 19), (3, 27), (4, 19), (4, 27), (5, 20))
+    return [bytes([mode]) + rnd.randbytes(length - 1) for mode, length in (rnd.choice(shapes) for i in range(count))]
+
+def bench_adv(args):
+    """
+    advertising packet の変換: フィールドごとのスライスと int.from_bytes (従来版) と unpack_adv (struct) の比較
+    """
+    from jciebu_record import unpack_adv
+
+    packets = adv_packets(1000)
+    assert all(unpack_adv(p)[2] == unpack_adv_slices(p) for p in packets)
+    number = max(1, args.number // 20)
+    sec_old = timeit.timeit(lambda: [unpack_adv_slices(p) for p in packets], number=number)
+    sec_new = timeit.timeit(lambda: [unpack_adv(p) for p in packets], number=number)
+    report('advertising packet x1000', number, sec_old, sec_new)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=200, help='繰り返し回数')
+    subparsers = parser.add_subparsers(dest='target', required=True)
+    subparsers.add_parser('crc', help='CRC-16 の計算').set_defaults(func=bench_crc)
+    subparsers.add_parser('frame', help='フレームの受信・切り出し').set_defaults(func=bench_frame)
+    latency = subparsers.add_parser('latency', help='0x5021 の往復時間')
+    latency.add_argument('--port', help='環境センサのシリアルポート (省略時は疑似端末)')
+    latency.add_argument('--delay', type=float, default=5.0, help='疑似端末の応答遅延 (ミリ秒)')
+    latency.set_defaults(func=bench_latency)
+    pipeline = subparsers.add_parser('pipeline', help='0x5021 と 0x5201 をまとめて取得する時間')
+    pipeline.add_argument('--port', help='環境センサのシリアルポート (省略時は疑似端末)')
+    pipeline.add_argument('--delay', type=float, default=5.0, help='疑似端末の応答遅延 (ミリ秒)')
+    pipeline.set_defaults(func=bench_pipeline)
+    subparsers.add_parser('acc', help='加速度データの変換').set_defaults(func=bench_acc)
+    download = subparsers.add_parser('download', help='加速度メモリのデータの読み込み')
+    download.add_argument('--port', help='環境センサのシリアルポート (省略時は疑似端末)')
+    download.add_argument('--delay', type=float, default=5.0, help='疑似端末の応答遅延 (ミリ秒)')
+    download.add_argument('--pages', type=int, default=128, help='読み込むページ数')
+    download.add_argument('--drop-rate', type=float, default=0.0, help='疑似端末が応答しない割合')
+    download.add_argument('--crc-rate', type=float, default=0.0, help='疑似端末のレスポンスの CRC-16 を誤らせる割合')
+    download.set_defaults(func=bench_download)
+    subparsers.add_parser('latest', help='最新データの変換').set_defaults(func=bench_latest)
+    record = subparsers.add_parser('record', help='受信データの保持形式 (メモリと処理時間)')
+    record.add_argument('--csv', default='CA43F0B62495_interval_60.csv', help='読み込む CSV ファイル')
+    record.set_defaults(func=bench_record)
+    csv_append = subparsers.add_parser('csv', help='CSVファイルへの追記')
+    csv_append.add_argument('--rows', type=int, default=10000, help='書き込む行数')
+    csv_append.add_argument('--fsync', action='store_true', help='flush のたびに fsync する')
+    csv_append.set_defaults(func=bench_csv)
+    binlog = subparsers.add_parser('binlog', help='保存済みのデータの読み込み (CSV とセグメントファイル)')
+    binlog.add_argument('--csv', default='CA43F0B62495_interval_60.csv', help='読み込む CSV ファイル')
+    binlog.set_defaults(func=bench_binlog)
+    influx = subparsers.add_parser('influx', help='InfluxDB への送信 (疑似サーバ)')
+    influx.add_argument('--points', type=int, default=100000, help='送信する点の数')
+    influx.add_argument('--devices', type=int, nargs='+', default=[1, 100], help='デバイスの数')
+    influx.add_argument('--fail-rate', type=float, default=0.0, help='疑似サーバがエラーを返す割合')
+    influx.set_defaults(func=bench_influx)
+    spool = subparsers.add_parser('spool', help='スプールへの追記と出力 (遅い出力先)')
+    spool.add_argument('--records', type=int, default=5000, help='受信するレコードの数')
+    spool.add_argument('--sink-delay', type=float, default=5.0, help='出力先の 1 回の呼び出しの時間 (ミリ秒)')
+    spool.add_argument('--outage', type=float, default=0.0, help='出力先が止まっている時間 (秒)')
+    spool.set_defaults(func=bench_spool)
+    subparsers.add_parser('adv', help='advertising packet の変換').set_defaults(func=bench_adv)
+    args = parser.parse_args()
+    args.func(args)
@@ -12,8 +12,8 @@
 import sys
 import time
 import asyncio
-from bleak import BleakScanner
 import bleak
+from jciebu_scanner import ScannerService
 print('# bleak author:', bleak.__author__)
 
 def bytetoint(buf, sig):
@@ -195,13 +195,6 @@ def advcallback(dev, advdata):
             print("... Press Ctrl-C to exit ...")
 
 
-async def run():
-    """
-    scan bluetooth devices
-    """
-    devices = await BleakScanner.discover(timeout=1.0, scanning_mode='active', detection_callback=advcallback)
-
-
 if __name__ == '__main__':
     """
     read advertising packet from 2JCIE-BU01 and display until press Ctrl-C
@@ -210,10 +203,12 @@ if __name__ == '__main__':
     advtype03.type2seq_no = None
     advtype04.type1seq_no = None
     advtype04.type2seq_no = None
+    # BleakScanner を起動したままにして受信を続ける (jciebu_scanner.py)
+    service = ScannerService(advcallback)
     try:
         loop = asyncio.new_event_loop()
-        while True:
-            loop.run_until_complete(run())
+        loop.run_until_complete(service.run())
     except KeyboardInterrupt:
+        service.report()
         sys.exit()
 
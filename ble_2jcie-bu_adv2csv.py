@@ -8,15 +8,30 @@
 #  'python -m pip install break'
 #
 # This sample tested python 3.11.
+#
+# 使い方: python ble_2jcie-bu_adv2csv.py [--capture capture.jcap] [--scan-window 1.0] [--adapters hci0 hci1]
+#         python ble_2jcie-bu_adv2csv.py --replay capture.jcap [--speed 1.0]
+#   --capture: 受信したパケット (時刻, アドレス, 名前, manufacturer_data) をそのまま記録 (jciebu_capture.py)
+#   --replay: 受信する代わりに記録したパケットを advcallback に渡し、処理速度 (packets/s) を表示
+#   受信は 1 つの BleakScanner で続け (jciebu_scanner.py)、60 秒ごとと終了時に受信の速さ (packets/s) を表示
+#   --scan-window: 指定した秒数ごとにスキャンを止めて再開する (以前の discover(timeout=1.0) の繰り返しとの比較用)
+#   --adapters: 複数のアダプタ (hci0 hci1 ..., all の場合はすべて) でスキャンし、受信したパケットをまとめてデコードする
+#               (USB の Bluetooth ドングルを追加すると、受信できる環境センサの数を増やせる)
 
 import sys
 import os
-import re
 import time
+import argparse
 import asyncio
-from bleak import BleakScanner
 import bleak
 from datetime import datetime
+from jciebu_binlog import BinlogWriter
+from jciebu_capture import CAPTURE_EXT, COMPANY_ID, CaptureWriter, replay
+from jciebu_csv import CsvWriter
+from jciebu_influx import InfluxSink
+from jciebu_record import ADV_SCHEMAS, AdvDeviceTable, SensorRecord, adv_csv_timestamp, unpack_adv
+from jciebu_scanner import MultiScannerService, PacketQueue, ScannerService, list_adapters
+from jciebu_spool import Spool, SpoolDrainer
 
 print('# bleak author:', bleak.__author__)
 
@@ -28,338 +43,313 @@ counter = 0
 
 # 受信したデータモード1のデータを格納する変数
 data_mode = 0
-prev_data_mode = 0
-prev_seq_no = 0
 
 # 受信したデータをCSV形式でユニットごとに出力するフォルダ
 output_folder = 'csv_files'
 if not os.path.exists(output_folder):
     os.makedirs(output_folder)
-output_files = []
+
+# CSVファイルへの書き出しの設定 (ファイルは開いたままにして、CSV_FLUSH_ROWS 行ごと、
+# または CSV_FLUSH_INTERVAL 秒ごとにまとめて書き出す。CSV_FSYNC を True にすると書き込み完了を待つ)
+CSV_FLUSH_ROWS = 10
+CSV_FLUSH_INTERVAL = 300
+CSV_FSYNC = False
+# CSVファイルを日ごと ('daily')・時間ごと ('hourly') に分ける設定 (None の場合はユニットごとに 1 つのファイルに追記)
+# 分けたファイル (CA43F0B62495_20240504.csv など) の期間と行数は output_folder/catalog.json に記録
+CSV_PARTITION = None
+csv_writer = CsvWriter(flush_rows=CSV_FLUSH_ROWS, flush_interval=CSV_FLUSH_INTERVAL, fsync=CSV_FSYNC,
+                       partition=CSV_PARTITION)
+
+# 受信したデータを一旦ディスクのスプール (jciebu_spool.py) に追記し、CSV などへの出力は別スレッドで行う設定
+# (出力先の遅延や停止の影響を受けずに受信を続け、再起動後はまだ出力していないデータから出力する)
+# None の場合はスプールを使わずに受信した時に出力する
+SPOOL_FOLDER = 'spool_files'
+spool = Spool(SPOOL_FOLDER) if SPOOL_FOLDER is not None else None
+# スプールの送り終わった位置は、SPOOL_COMMIT_INTERVAL 秒ごとに出力先をすべて書き出して (CSV_FSYNC の場合は fsync、
+# InfluxDB は送信の完了を確認して) から保存する (それまでのデータはスプールに残るので、異常終了しても失われない)
+SPOOL_COMMIT_INTERVAL = 60
+
+# 受信したデータをバイナリ形式のセグメントファイル (jciebu_binlog.py) にも保存するフォルダ (None の場合は保存しない)
+BINLOG_FOLDER = None
+binlog_writer = BinlogWriter(BINLOG_FOLDER, partition=CSV_PARTITION, flush_rows=CSV_FLUSH_ROWS,
+                             flush_interval=CSV_FLUSH_INTERVAL, fsync=CSV_FSYNC) if BINLOG_FOLDER is not None else None
+
+# 受信したデータを InfluxDB にも保存する設定 (INFLUX_URL が None の場合は保存しない)
+# org とトークンは環境変数 INFLUX_ORG, INFLUX_TOKEN で指定
+INFLUX_URL = None           # 'http://localhost:8086' など
+INFLUX_BUCKET = 'iot_2jciebu'
+influx_sink = InfluxSink(INFLUX_URL, INFLUX_BUCKET, org=os.environ.get('INFLUX_ORG', ''),
+                         token=os.environ.get('INFLUX_TOKEN', ''), batch_age=10.0,
+                         keep_failed=spool is not None) if INFLUX_URL is not None else None
 
 # データを記録する間隔の設定 (advertising packet の受信なので正確な設定にはなりません)
 record_interval = 60
-last_record_time = {}
+
+# 環境センサごとの状態 (アドレス -> デバイス名、データモード 3, 4 の組み立て中の値、最後に出力したシーケンス番号と時刻)
+# DEVICE_STATES_MAX 台を超えた場合は、最も長い間受信していない環境センサの状態を削除する
+DEVICE_STATES_MAX = 256
+device_states = AdvDeviceTable(DEVICE_STATES_MAX)
 
 
 # 以下、プログラム・関数定義の本体
 
-def bytetoint(buf, sig):
+# DEBUG のときに表示する各フィールドの名前
+ADV_LABELS = {'sequence_number': 'Sequence number',
+              'temparature': 'Temparature [degreeC]',
+              'relative_humidity': 'Relative humidity [%RH]',
+              'ambient_light': 'Ambient light [lx]',
+              'barometric_pressure': 'Barometric pressure [hPa]',
+              'sound_noise': 'Sound noise (LA) [dB]',
+              'eTVOC': 'eTVOC [ppb]',
+              'eCO2': 'eCO2 [ppm]',
+              'discomfort_index': 'Discomfort index',
+              'heat_stroke': 'Heat stroke [degreeC]',
+              'vibration_inform': 'Vibration information',
+              'SI_value': 'SI value [kine]',
+              'PGA': 'PGA [gal]',
+              'Seismic_intensity': 'Seismic intensity',
+              'acceleration_x': 'Acceleration X-dir. [gal]',
+              'acceleration_y': 'Acceleration Y-dir. [gal]',
+              'acceleration_z': 'Acceleration Z-dir. [gal]',
+              'temperature_flag': 'Temperature flag',
+              'relative_humidity_flag': 'Relative humidity flag',
+              'ambient_light_flag': 'Ambient light flag',
+              'barometric_pressure_flag': 'Barometric pressure flag',
+              'sound_noise_flag': 'Sound noise flag',
+              'etvoc_flag': 'eTVOC flag',
+              'eco2_flag': 'eCO2 flag',
+              'discomfort_index_flag': 'Discomfort index flag',
+              'heat_stroke_flag': 'Heat stroke flag',
+              'si_value_flag': 'SI value flag',
+              'pga_flag': 'PGA flag',
+              'seismic_intensity_flag': 'Seismic intensity flag',
+              'serial_number': 'Serial number',
+              'memory_index_latest': 'Memory index(Latest)'}
+
+def print_record(record):
     """
-    bytes data retrieved from 2JCIE-BU01 to integer.
+    print decoded record (DEBUG)
     """
-    return int.from_bytes(buf, byteorder='little', signed=sig)
+    print("Data Type: " + format(record.schema.mode, '02d'))
+    for field, text in zip(record.schema.fields, record.csv_values()):
+        print(ADV_LABELS[field] + ": " + text)
 
-
-def advtype01( data ):
+def csv_row(record):
     """
-    print advertising packet : data type 1 (= sensor data)
+    レコードの CSV のヘッダーと行 (受信時刻、data_mode、レコードの値) を返す関数
     """
-    sequence_number     = str(bytetoint(data[1:2], False))
-    temparature         = str(bytetoint(data[2:4], True) / 100)
-    relative_humidity   = str(bytetoint(data[4:6], False) / 100)
-    ambient_light       = str(bytetoint(data[6:8], False))
-    barometric_pressure = str(bytetoint(data[8:12], False) / 1000)
-    sound_noise         = str(bytetoint(data[12:14], False) / 100)
-    eTVOC               = str(bytetoint(data[14:16], False))
-    eCO2                = str(bytetoint(data[16:18], False))
-
-    if DEBUG:
-        print("Data Type: 01")
-        print("Sequence number: " + sequence_number)
-        print("Temparature [degreeC]: " + temparature)
-        print("Relative humidity [%RH]: " + relative_humidity)
-        print("Ambient light [lx]: " + ambient_light)
-        print("Barometric pressure [hPa]: " + barometric_pressure)
-        print("Sound noise (LA) [dB]: " + sound_noise)
-        print("eTVOC [ppb]: " + eTVOC)
-        print("eCO2 [ppm]: " + eCO2)
-
-    return_data = {'sequence_number': sequence_number, 
-                   'temparature': temparature, 
-                   'relative_humidity': relative_humidity, 
-                   'ambient_light': ambient_light, 
-                   'barometric_pressure': barometric_pressure, 
-                   'sound_noise': sound_noise, 
-                   'eTVOC': eTVOC, 
-                   'eCO2': eCO2}
-    return return_data
-
-def advtype02( data ):
+    # レコードのフィールド名をCSVのヘッダーとして出力 (新しいファイルの場合)
+    _header = ('datetime', 'timestamp', 'data_mode') + record.schema.fields
+    # データ受信時刻とデータモードとレコードの値を出力 (文字列への変換はここで行う)
+    # timestamp は datetime.utcnow().timestamp() と同じ値 (adv_csv_timestamp)
+    _output = [datetime.fromtimestamp(record.time).strftime('%Y-%m-%d %H:%M:%S'),
+               str(adv_csv_timestamp(record.time)), str(record.schema.mode)]
+    _output.extend(record.csv_values())
+    return _header, _output
+
+def output_records(records):
     """
-    print advertising packet : data type 2 (= calcuration data)
+    レコードを CSV ファイル (設定した場合はセグメントファイル、InfluxDB にも) に出力する関数
+    スプールを使う場合は SpoolDrainer のスレッドから呼び出す
     """
-    sequence_number     = str(bytetoint(data[1:2], False))
-    discomfort_index    = str(bytetoint(data[2:4], False) / 100)
-    heat_stroke         = str(bytetoint(data[4:6], True) / 100)
-    vibration_inform    = str(bytetoint(data[6:7], False))
-    SI_value            = str(bytetoint(data[7:9], False) / 10)
-    PGA                 = str(bytetoint(data[9:11], False) / 10)
-    Seismic_intensity   = str(bytetoint(data[11:13], False) / 1000)
-    acceleration_x      = str(bytetoint(data[13:15], True) / 10)
-    acceleration_y      = str(bytetoint(data[15:17], True) / 10)
-    acceleration_z      = str(bytetoint(data[17:19], True) / 10)
-
-    if DEBUG:
-        print("Data Type: 02")
-        print("Sequence number: " + sequence_number)
-        print("Discomfort index: " + discomfort_index)
-        print("Heat stroke [degreeC]: " + heat_stroke)
-        print("Vibration information: " + vibration_inform)
-        print("SI value [kine]: " + SI_value)
-        print("PGA [gal]: " + PGA)
-        print("Seismic intensity: " + Seismic_intensity)
-        print("Acceleration X-dir. [gal]: " + acceleration_x)
-        print("Acceleration Y-dir. [gal]: " + acceleration_y)
-        print("Acceleration Z-dir. [gal]: " + acceleration_z)
-
-    return_data = {'sequence_number': sequence_number,
-                     'discomfort_index': discomfort_index,
-                     'heat_stroke': heat_stroke,
-                     'vibration_inform': vibration_inform,
-                     'SI_value': SI_value,
-                     'PGA': PGA,
-                     'Seismic_intensity': Seismic_intensity,
-                     'acceleration_x': acceleration_x,
-                     'acceleration_y': acceleration_y,
-                     'acceleration_z': acceleration_z}
-    return return_data
-
-def advtype03( data ):
+    for record in records:
+        _output_file = os.path.join(output_folder + '/' + record.device + '.csv')
+        _header, _output = csv_row(record)
+        csv_writer.write(_output_file, _header, _output, record.time, record.device)
+        if binlog_writer is not None:
+            binlog_writer.write(record)
+        if influx_sink is not None:
+            influx_sink.write(record)
+
+def flush_outputs():
     """
-    print advertising packet : data type 3 (= sensor & calculation data)
+    一定時間以上書き出していない出力をまとめて書き出す関数
     """
-    if len(data) == 19:     # packet type 1:
-        advtype03.type1seq_no         = str(bytetoint(data[1:2], False))
-        advtype03.temparature         = str(bytetoint(data[2:4], True) / 100)
-        advtype03.relative_humidity   = str(bytetoint(data[4:6], False) / 100)
-        advtype03.ambient_light       = str(bytetoint(data[6:8], False))
-        advtype03.barometric_pressure = str(bytetoint(data[8:12], False) / 1000)
-        advtype03.sound_noise         = str(bytetoint(data[12:14], False) / 100)
-        advtype03.eTVOC               = str(bytetoint(data[14:16], False))
-        advtype03.eCO2                = str(bytetoint(data[16:18], False))
-    elif len(data) == 27:   # packet type 2:
-        advtype03.type2seq_no         = str(bytetoint(data[1:2], False))
-        advtype03.discomfort_index    = str(bytetoint(data[2:4], False) / 100)
-        advtype03.heat_stroke         = str(bytetoint(data[4:6], True) / 100)
-        advtype03.vibration_inform    = str(bytetoint(data[6:7], False))
-        advtype03.SI_value            = str(bytetoint(data[7:9], False) / 10)
-        advtype03.PGA                 = str(bytetoint(data[9:11], False) / 10)
-        advtype03.Seismic_intensity   = str(bytetoint(data[11:13], False) /1000)
-        advtype03.acceleration_x      = str(bytetoint(data[13:15], True) / 10)
-        advtype03.acceleration_y      = str(bytetoint(data[15:17], True) / 10)
-        advtype03.acceleration_z      = str(bytetoint(data[17:19], True) / 10)
-
-    # when both packet type 1 and 2 are recieved, display data.
-    if advtype03.type1seq_no != None and advtype03.type1seq_no == advtype03.type2seq_no: 
-        if DEBUG:
-            print("Data Type: 03")
-            print("Sequence number: " + advtype03.type1seq_no)
-            print("Temparature [degreeC]: " + advtype03.temparature)
-            print("Relative humidity [%RH]: " + advtype03.relative_humidity)
-            print("Ambient light [lx]: " + advtype03.ambient_light)
-            print("Barometric pressure [hPa]: " + advtype03.barometric_pressure)
-            print("Sound noise (LA) [dB]: " + advtype03.sound_noise)
-            print("eTVOC [ppb]: " + advtype03.eTVOC)
-            print("eCO2 [ppm]: " + advtype03.eCO2)
-            print("Discomfort index: " + advtype03.discomfort_index)
-            print("Heat stroke [degreeC]: " + advtype03.heat_stroke)
-            print("Vibration information: " + advtype03.vibration_inform)
-            print("SI value [kine]: " + advtype03.SI_value)
-            print("PGA [gal]: " + advtype03.PGA)
-            print("Seismic intensity: " + advtype03.Seismic_intensity)
-            print("Acceleration X-dir. [gal]: " + advtype03.acceleration_x)
-            print("Acceleration Y-dir. [gal]: " + advtype03.acceleration_y)
-            print("Acceleration Z-dir. [gal]: " + advtype03.acceleration_z)
-
-        return_data = {'sequence_number': advtype03.type1seq_no,
-                     'temparature': advtype03.temparature,
-                     'relative_humidity': advtype03.relative_humidity,
-                     'ambient_light': advtype03.ambient_light,
-                     'barometric_pressure': advtype03.barometric_pressure,
-                     'sound_noise': advtype03.sound_noise,
-                     'eTVOC': advtype03.eTVOC,
-                     'eCO2': advtype03.eCO2,
-                     'discomfort_index': advtype03.discomfort_index,
-                     'heat_stroke': advtype03.heat_stroke,
-                     'vibration_inform': advtype03.vibration_inform,
-                     'SI_value': advtype03.SI_value,
-                     'PGA': advtype03.PGA,
-                     'Seismic_intensity': advtype03.Seismic_intensity,
-                     'acceleration_x': advtype03.acceleration_x,
-                     'acceleration_y': advtype03.acceleration_y,
-                     'acceleration_z': advtype03.acceleration_z}
-        
-        return return_data
-
-def advtype04( data ):
+    csv_writer.flush_due()
+    if binlog_writer is not None:
+        binlog_writer.flush_due()
+    if influx_sink is not None:
+        influx_sink.flush_due()
+
+def flush_all():
     """
-    print advertising packet : data type 4 (= sensor & calculation flags)
+    すべての出力を書き出す関数 (SpoolDrainer がスプールの cursor を保存する前に呼び出す)
+    InfluxDB に送信できなかった場合は IOError を送出し、cursor を保存しない
     """
-    if len(data) == 19:     # packet type 1:
-        advtype04.type1seq_no              = str(bytetoint(data[1:2], False))
-        advtype04.temperature_flag         = format(bytetoint(data[2:4], False), '#018b')
-        advtype04.relative_humidity_flag   = format(bytetoint(data[4:6], False), '#018b')
-        advtype04.ambient_light_flag       = format(bytetoint(data[6:8], False), '#018b')
-        advtype04.barometric_pressure_flag = format(bytetoint(data[8:10], False), '#018b')
-        advtype04.sound_noise_flag         = format(bytetoint(data[10:12], False), '#018b')
-        advtype04.etvoc_flag               = format(bytetoint(data[12:14], False), '#018b')
-        advtype04.eco2_flag                = format(bytetoint(data[14:16], False), '#018b')
-    elif len(data) == 27:   # packet type 2:
-        advtype04.type2seq_no              = str(bytetoint(data[1:2], False))
-        advtype04.discomfort_index_flag    = format(bytetoint(data[2:4], False), '#018b')
-        advtype04.heat_stroke_flag         = format(bytetoint(data[4:6], False), '#018b')
-        advtype04.si_value_flag            = format(data[6], '#010b')
-        advtype04.pga_flag                 = format(data[7], '#010b')
-        advtype04.seismic_intensity_flag   = format(data[8], '#010b')
-
-    # when both packet type 1 and 2 are recieved, display data.
-    if advtype04.type1seq_no != None and advtype04.type1seq_no == advtype04.type2seq_no: 
-        if DEBUG:
-            print("Data Type: 04")
-            print("Sequence number: " + advtype04.type1seq_no)
-            print("Temperature flag: " + advtype04.temperature_flag)
-            print("Relative humidity flag: " + advtype04.relative_humidity_flag)
-            print("Ambient light flag: " + advtype04.ambient_light_flag)
-            print("Barometric pressure flag: " + advtype04.barometric_pressure_flag)
-            print("Sound noise flag: " + advtype04.sound_noise_flag)
-            print("eTVOC flag: " + advtype04.etvoc_flag)
-            print("eCO2 flag: " + advtype04.eco2_flag)
-            print("Discomfort index flag: " + advtype04.discomfort_index_flag)
-            print("Heat stroke flag: " + advtype04.heat_stroke_flag)
-            print("SI value flag: " + advtype04.si_value_flag)
-            print("PGA flag: " + advtype04.pga_flag)
-            print("Seismic intensity flag: " + advtype04.seismic_intensity_flag)
-
-        return_data = {'sequence_number': advtype04.type1seq_no,
-                     'temperature_flag': advtype04.temperature_flag,
-                     'relative_humidity_flag': advtype04.relative_humidity_flag,
-                     'ambient_light_flag': advtype04.ambient_light_flag,
-                     'barometric_pressure_flag': advtype04.barometric_pressure_flag,
-                     'sound_noise_flag': advtype04.sound_noise_flag,
-                     'etvoc_flag': advtype04.etvoc_flag,
-                     'eco2_flag': advtype04.eco2_flag,
-                     'discomfort_index_flag': advtype04.discomfort_index_flag,
-                     'heat_stroke_flag': advtype04.heat_stroke_flag,
-                     'si_value_flag': advtype04.si_value_flag,
-                     'pga_flag': advtype04.pga_flag,
-                     'seismic_intensity_flag': advtype04.seismic_intensity_flag}
-        
-        return return_data
- 
-def advtype05( data ):
+    csv_writer.flush()
+    if binlog_writer is not None:
+        binlog_writer.flush()
+    if influx_sink is not None:
+        influx_sink.flush()
+
+# --capture で指定したファイルに受信したパケットをそのまま記録する (jciebu_capture.py)
+capture_writer = None
+# 受信したパケットを入れるキュー (デコードと出力は PacketQueue のスレッドで行う)
+packet_queue = None
+
+def advcallback(dev, advdata, _time=None):
     """
-    print advertising packet : data type 5 (= serial number)
+    detection_callback: 受信したパケット (受信時刻, アドレス, 名前, データ) をキューに入れるだけの関数
+    (ファイルの書き込みなどでイベントループを止めないように、デコードと出力は process_packets で行う)
+    _time: 受信時刻 (--replay で再生する場合は記録した時刻、省略時は現在時刻)
     """
-    serial_number       = str(data[1:11])
-    memory_index_latest = str(bytetoint(data[11:15], False))
-    
-    if DEBUG:
-        print("Data Type: 05")
-        print("Serial number: " + serial_number)
-        print("Memory index(Latest): " + memory_index_latest)
-
-    return_data = {'serial_number': serial_number, 'memory_index_latest': memory_index_latest}
+    started = time.perf_counter()
+    data = advdata.manufacturer_data.get(COMPANY_ID)
+    if data is not None:
+        packet_queue.put((time.time() if _time is None else _time, dev.address, dev.name, data), started)
 
-    return return_data
-
-def advcallback(dev, advdata):
+def decode_packet(_now, address, name, data):
     """
     discrimination of advertising mode  
+    出力するレコードを返す (記録の間隔の前、同じシーケンス番号の場合などは None)
+    データモード 3, 4 の組み立てと重複の確認は環境センサごとの状態 (device_states) で行う
     """
-    global counter, data_mode, prev_data_mode, prev_seq_no, output_files, record_interval, last_record_time
+    global counter
 
-    if ( dev.name == 'Rbt' ) :
-        if ( 0x02D5 in advdata.manufacturer_data.keys() ): #0x02D5=companyID
+    if ( name == 'Rbt' ) :
+        if DEBUG:
+            print("")
+            print("Address: " + address)
+
+        unpacked = unpack_adv(data)
+        if unpacked is None:
+            print("unknown: " + str(data))
+            return None
+        _data_mode, part, values = unpacked
+
+        state = device_states.get(address)
+        if state is None:
+            state = device_states.add(address)
+            print(f'出力先({device_states.added}):', os.path.join(output_folder + '/' + state.device + '.csv'))
+
+        # データモード 3, 4 は packet type 1, 2 がそろったときにレコードにする
+        values = state.assemble(_data_mode, part, values)
+        output = None
+        if values is not None:
+            record = SensorRecord(ADV_SCHEMAS[_data_mode], values)
             if DEBUG:
-                print("")
-                print("Address: " + dev.address)
-
-            data = advdata.manufacturer_data[0x02D5]
-            _data_dict = {}
-            if data[0] == 0x01: # mode 1
-                _data_dict = advtype01( data )
-                _data_mode = 1
-            elif data[0] == 0x02: # mode 2
-                _data_dict = advtype02( data )
-                _data_mode = 2
-            elif data[0] == 0x03: # mode 3
-                _data_dict = advtype03( data )
-                _data_mode = 3
-            elif data[0] == 0x04: # mode 4
-                _data_dict = advtype04( data )
-                _data_mode = 4
-            elif data[0] == 0x05: # mode 5
-                _data_dict = advtype05( data )
-                _data_mode = 5
-            else:
-                print("unknown: " + str(data))
-                _data_mode = 0
-
-            if len(_data_dict) > 0:
-
-                # 出力先ファイル名を生成
-                device_address = re.sub(':', '', dev.address)
-                if device_address not in last_record_time.keys() or (datetime.utcnow().timestamp() - last_record_time[device_address]) > record_interval:
-                    last_record_time[device_address] = datetime.utcnow().timestamp()
-
-                    _output_file = os.path.join(output_folder + '/' + device_address + '.csv')
-                    if _output_file not in output_files:
-                        output_files.append(_output_file)
-                        print(f'出力先({len(output_files)}):', _output_file)
-
-                    if not os.path.exists(_output_file):
-                        # _data_dictのキーをCSVのヘッダーとして出力
-                        _header = 'datetime,timestamp,data_mode,'+','.join(_data_dict.keys())
+                print_record(record)
+
+            if state.last_record_time is None or (_now - state.last_record_time) > record_interval:
+                state.last_record_time = _now
+
+                record.time = _now
+                record.device = state.device
+
+                if state.is_new(_data_mode, values[0]):
+                    if DEBUG:
+                        _output_file = os.path.join(output_folder + '/' + state.device + '.csv')
+                        _header, _output = csv_row(record)
+                        if not os.path.exists(_output_file):
+                            print(_output_file, '>', ','.join(_header))
+                        print(_output_file, '>', ','.join(_output))
                     else:
-                        _header = ''
-
-                    # データ受信時刻とデバイスのアドレスと_data_dictの値を出力
-                    _output = datetime.now().strftime('%Y-%m-%d %H:%M:%S')+','+str(datetime.utcnow().timestamp())+','+str(_data_mode)+','
-                    _output = _output + ','.join(map(str, _data_dict.values()))
-
-                    if prev_data_mode != _data_mode or prev_seq_no != _data_dict['sequence_number']:
-                        if DEBUG:
-                            if len(_header) > 0:
-                                print(_output_file, '>', _header)
-                            print(_output_file, '>', _output)
-                        else:
-                            with open(_output_file, 'a') as f:
-                                if len(_header) > 0:
-                                    f.write(_header + '\n')
-                                f.write(_output + '\n')
-
-                    prev_data_mode = _data_mode
-                    prev_seq_no = _data_dict['sequence_number']
-                    counter = counter + 1
-
-    
-            if DEBUG:
-                print("... Press Ctrl-C to exit ...")
+                        output = record
+                counter = counter + 1
+
 
+        if DEBUG:
+            print("... Press Ctrl-C to exit ...")
+        return output
 
-async def run():
+def process_packets(packets):
+    """
+    キューから取り出したパケットをまとめてデコードし、出力する関数 (PacketQueue のスレッドで実行)
+    """
+    records = []
+    for packet in packets:
+        if capture_writer is not None:
+            capture_writer.write(*packet)
+        record = decode_packet(*packet)
+        if record is not None:
+            records.append(record)
+    if len(records) == 0:
+        return
+    if spool is not None:
+        # スプールにまとめて追記するだけ (CSV などへの出力は SpoolDrainer のスレッドで行う)
+        spool.append_records(records)
+    else:
+        output_records(records)
+
+
+def close_outputs(drainer):
     """
-    scan bluetooth devices
+    キューとスプールに残っているデータを出力し、出力先をクローズする関数
     """
-    devices = await BleakScanner.discover(timeout=1.0, scanning_mode='active', detection_callback=advcallback)
+    packet_queue.stop()
+    if drainer is not None:
+        drainer.stop()
+        spool.close()
+    # CSVファイルに残りの行を書き出してクローズ
+    csv_writer.close()
+    if binlog_writer is not None:
+        binlog_writer.close()
+    if influx_sink is not None:
+        influx_sink.close()
+    if capture_writer is not None:
+        capture_writer.close()
 
 
 if __name__ == '__main__':
     """
     read advertising packet from 2JCIE-BU01 and display until press Ctrl-C
     """
-    advtype03.type1seq_no = None
-    advtype03.type2seq_no = None
-    advtype04.type1seq_no = None
-    advtype04.type2seq_no = None
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capture', help='受信したパケットをそのまま記録するファイル (' + CAPTURE_EXT + ')')
+    parser.add_argument('--replay', help='受信する代わりに、記録したパケットを再生するファイル')
+    parser.add_argument('--speed', type=float, default=0, help='再生の速さ (1.0: 受信した間隔, 0: 待たずに再生)')
+    parser.add_argument('--scan-window', type=float,
+                        help='この秒数ごとにスキャンを止めて再開する (従来の動作、受信数の比較用)')
+    parser.add_argument('--adapters', nargs='+',
+                        help='スキャンに使うアダプタ (hci0 hci1 など、all の場合はすべて。省略時は既定のアダプタ)')
+    args = parser.parse_args()
+
+    if args.capture is not None:
+        capture_writer = CaptureWriter(args.capture)
+
+    drainer = None
+    if spool is not None and not DEBUG:
+        # 前回の実行で出力していないデータがあれば、そこから出力
+        drainer = SpoolDrainer(spool, output_records, idle=flush_outputs, flush=flush_all,
+                               commit_interval=SPOOL_COMMIT_INTERVAL)
+        drainer.start()
+
+    # 再生する場合はキューがいっぱいのときに捨てずに待つ
+    packet_queue = PacketQueue(process_packets, block=args.replay is not None,
+                               idle=flush_outputs if drainer is None else None)
+    packet_queue.start()
+
+    if args.replay is not None:
+        # 記録したパケットを advcallback に渡し、デコードと出力の処理速度を表示
+        print('記録したパケットを再生...', args.replay)
+        t = time.perf_counter()
+        packets, seconds = replay(args.replay, advcallback, args.speed)
+        close_outputs(drainer)
+        total = time.perf_counter() - t
+        print(f'{packets} packets, {counter} records: advcallback {seconds:.3f} s ({packets / seconds:.0f} packets/s),'
+              f' including output {total:.3f} s ({packets / total:.0f} packets/s)')
+        packet_queue.report()
+        sys.exit()
 
     print('環境センサ(2JCIE-BU01)からのデータの受信を開始... (終了は Ctrl-C を押下)')
 
+    # BleakScanner を起動したままにして受信を続ける (アダプタのエラーの場合はスキャンを再開)
+    if args.adapters is None:
+        service = ScannerService(advcallback, window=args.scan_window)
+    else:
+        # アダプタごとに BleakScanner を起動し、受信したパケットは同じキューに入れる
+        # (複数のアダプタで受信した同じパケットは、環境センサごとのシーケンス番号の確認で 1 行だけ出力)
+        adapters = list_adapters() if args.adapters == ['all'] else args.adapters
+        if len(adapters) == 0:
+            print('Bluetooth のアダプタが見つかりません')
+            sys.exit(1)
+        print('アダプタ:', ' '.join(adapters))
+        service = MultiScannerService(advcallback, adapters, window=args.scan_window)
     try:
         loop = asyncio.new_event_loop()
-        while True:
-            loop.run_until_complete(run())
+        loop.run_until_complete(service.run())
     except KeyboardInterrupt:
+        service.report()
+        packet_queue.report()
+        close_outputs(drainer)
         sys.exit()
-
@@ -12,8 +12,8 @@
 import sys
 import time
 import asyncio
-from bleak import BleakScanner
 import bleak
+from jciebu_scanner import ScannerService
 # print('# bleak author:', bleak.__author__)
 
 #SENSOR_MAC_NAME = {'CA:43:F0:B6:24:95': 'SU01'} # SU01
@@ -206,13 +206,6 @@ def advcallback(dev, advdata):
 
 
 
-async def run():
-    """
-    scan bluetooth devices
-    """
-    devices = await BleakScanner.discover(timeout=1.0, scanning_mode='active', detection_callback=advcallback)
-
-
 if __name__ == '__main__':
     """
     read advertising packet from 2JCIE-BU01 and display until press Ctrl-C
@@ -221,10 +214,12 @@ if __name__ == '__main__':
     advtype03.type2seq_no = None
     advtype04.type1seq_no = None
     advtype04.type2seq_no = None
+    # BleakScanner を起動したままにして受信を続ける (jciebu_scanner.py)
+    service = ScannerService(advcallback)
     try:
         loop = asyncio.new_event_loop()
-        while True:
-            loop.run_until_complete(run())
+        loop.run_until_complete(service.run())
     except KeyboardInterrupt:
+        service.report()
         sys.exit()
 
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+#
+# 2JCIE-BU01 environment sensor Bluetooth I/F sample
+# * This program sets candidate advertising intervals and measures the reception of advertising packets
+#
+# This sample needs bleak module.
+#  'python -m pip install break'
+#
+# 使い方: python ble_2jcie-bu_advtune.py --file addresses.txt --intervals 100 500 1000 2000 [--duration 120]
+#         python ble_2jcie-bu_advtune.py CA:43:F0:B6:24:95 F9:E9:A4:FB:96:C9 --measure-only
+#   アドバタイズの設定 (0x5115) の advertising interval を候補の値ごとにすべての環境センサに書き込み、
+#   --duration 秒の間スキャンして、環境センサごとの受信の速さ (packets/s) と、シーケンス番号の飛び
+#   (受信できなかった測定の数) を計測する
+#   packets/s の合計は電波の使用量 (電池の消費) の目安、completeness は受信できた測定の割合
+#   最後に候補の値ごとの結果と、completeness が --target 以上の最も長い間隔を表示し、
+#   元の設定に戻す (--keep を指定した場合は最後の値のまま)
+#   --output: 結果を CSV ファイルにも保存する
+#
+
+import sys
+import csv
+import asyncio
+import argparse
+from jciebu_capture import COMPANY_ID
+from jciebu_gatt import GattConnectionPool, read_advertise_setting, write_advertise_setting, adv_interval_value
+from jciebu_scanner import ReceptionStats, ScannerService
+
+# 設定を書き込んでから計測を始めるまでの秒数 (環境センサが新しい間隔でアドバタイズを始めるまで)
+SETTLE_SECONDS = 5.0
+# 接続のタイムアウト (秒)
+CONNECT_TIMEOUT = 10.0
+
+
+async def for_each_device(pool, addresses, func):
+    """
+    すべての環境センサに (最大 pool.max_connections 台同時に) 接続して func(address, client) を実行し、
+    アドレス -> 結果 (失敗した場合は None) を返す関数
+    環境センサは接続している間アドバタイズしないため、最後にすべて切断する
+    """
+    semaphore = asyncio.Semaphore(pool.max_connections)
+    results = {}
+
+    async def one(address):
+        async with semaphore:
+            try:
+                async with pool.connection(address) as client:
+                    results[address] = await func(address, client)
+            except Exception as e:
+                print(f'{address}: error', repr(e))
+                results[address] = None
+
+    await asyncio.gather(*[one(address) for address in addresses])
+    await pool.close()
+    return results
+
+
+async def measure(addresses, seconds):
+    """
+    seconds 秒の間スキャンして、環境センサごとの受信の統計 (ReceptionStats.summary) を返す関数
+    """
+    stats = ReceptionStats()
+    wanted = {address.upper() for address in addresses}
+
+    def callback(dev, advdata):
+        data = advdata.manufacturer_data.get(COMPANY_ID)
+        if data is not None and dev.address.upper() in wanted:
+            stats.add(dev.address.upper(), data)
+
+    service = ScannerService(callback, report_interval=0)
+    task = asyncio.ensure_future(service.run())
+    await asyncio.sleep(seconds)
+    service.stop()
+    await task
+    summary = stats.summary(service.scanning if service.scanning > 0 else seconds)
+    # 受信できなかった環境センサ
+    for address in wanted - set(summary):
+        summary[address] = {'packets': 0, 'rate': 0.0, 'sequences': 0, 'lost': 0, 'reordered': 0,
+                            'completeness': None}
+    return summary
+
+
+def print_measurement(label, summary):
+    """
+    1 つの間隔の計測結果を環境センサごとに表示し、(packets/s の合計, completeness の平均, 最小) を返す関数
+    """
+    print(f'{label}:')
+    print(f"  {'address':<20} {'packets/s':>9} {'sequences':>9} {'lost':>5} {'late/dup':>8} {'completeness':>12}")
+    for address in sorted(summary):
+        s = summary[address]
+        completeness = '-' if s['completeness'] is None else f"{s['completeness'] * 100:.1f} %"
+        print(f"  {address:<20} {s['rate']:9.2f} {s['sequences']:9d} {s['lost']:5d} {s['reordered']:8d}"
+              f" {completeness:>12}")
+    values = [s['completeness'] if s['completeness'] is not None else 0.0 for s in summary.values()]
+    total = sum(s['rate'] for s in summary.values())
+    mean = sum(values) / len(values) if len(values) > 0 else 0.0
+    worst = min(values) if len(values) > 0 else 0.0
+    print(f'  total {total:.2f} packets/s, completeness mean {mean * 100:.1f} % min {worst * 100:.1f} %')
+    return total, mean, worst
+
+
+async def run():
+    pool = GattConnectionPool(args.concurrency, timeout=CONNECT_TIMEOUT)
+
+    # 現在の設定を読み込み (最後に元に戻すため)
+    print(f'reading advertise setting of {len(args.address)} devices ...')
+    originals = await for_each_device(pool, args.address, lambda address, client: read_advertise_setting(client))
+    for address in args.address:
+        if originals[address] is not None:
+            print(f'  {address}: interval {originals[address][0]:.1f} ms, advertising mode {originals[address][1]}')
+
+    rows = []
+    candidates = [None] if args.measure_only else args.intervals
+    try:
+        for interval_ms in candidates:
+            if interval_ms is None:
+                label = 'current setting'
+                written = len([o for o in originals.values() if o is not None])
+            else:
+                print(f'setting advertising interval {interval_ms} ms ...')
+                results = await for_each_device(pool, args.address,
+                                                lambda address, client: write_advertise_setting(client, interval_ms))
+                written = sum(1 for ok in results.values() if ok)
+                label = f'interval {interval_ms} ms (set {written}/{len(args.address)})'
+                await asyncio.sleep(SETTLE_SECONDS)
+            print(f'measuring {args.duration} s ...')
+            summary = await measure(args.address, args.duration)
+            total, mean, worst = print_measurement(label, summary)
+            rows.append((interval_ms, written, total, mean, worst, summary))
+    finally:
+        if not args.measure_only and not args.keep:
+            # 元の設定に戻す
+            print('restoring advertise setting ...')
+            restore = [address for address in args.address if originals[address] is not None]
+            results = await for_each_device(pool, restore, lambda address, client:
+                                            write_advertise_setting(client, originals[address][0]))
+            for address, ok in results.items():
+                if not ok:
+                    print(f'{address}: restore failed')
+
+    # 候補の値ごとの比較
+    print('')
+    print(f"{'interval ms':>11} {'set':>5} {'packets/s':>9} {'per device':>10} {'mean %':>7} {'min %':>7}")
+    for interval_ms, written, total, mean, worst, summary in rows:
+        print(f"{'current' if interval_ms is None else interval_ms:>11} {written:5d} {total:9.2f}"
+              f" {total / max(len(summary), 1):10.2f} {mean * 100:7.1f} {worst * 100:7.1f}")
+    good = [row for row in rows if row[0] is not None and row[4] >= args.target]
+    if len(good) > 0:
+        best = max(good, key=lambda row: row[0])
+        print(f'longest interval with completeness >= {args.target * 100:.0f} % on every device:'
+              f' {best[0]} ms ({best[2]:.2f} packets/s)')
+    elif not args.measure_only:
+        print(f'no interval reached completeness {args.target * 100:.0f} % on every device')
+
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('interval_ms', 'address', 'packets', 'packets_per_second', 'sequences', 'lost',
+                             'reordered', 'completeness'))
+            for interval_ms, written, total, mean, worst, summary in rows:
+                for address in sorted(summary):
+                    s = summary[address]
+                    writer.writerow((interval_ms if interval_ms is not None else '', address, s['packets'],
+                                     f"{s['rate']:.3f}", s['sequences'], s['lost'], s['reordered'],
+                                     '' if s['completeness'] is None else f"{s['completeness']:.4f}"))
+        print('saved:', args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('address', nargs='*', help='環境センサのアドレス "xx:xx:xx:xx:xx:xx" (複数指定可)')
+    parser.add_argument('--file', help='アドレスを 1 行に 1 つ書いたファイル (# 以降はコメント)')
+    parser.add_argument('--intervals', type=float, nargs='+', default=[100, 500, 1000, 2000],
+                        help='試す advertising interval (ミリ秒, 100 - 10240)')
+    parser.add_argument('--duration', type=float, default=120.0, help='1 つの間隔の計測の秒数')
+    parser.add_argument('--concurrency', type=int, default=4, help='設定するときに同時に接続する環境センサの数')
+    parser.add_argument('--target', type=float, default=0.99, help='必要な completeness (受信できた測定の割合)')
+    parser.add_argument('--measure-only', action='store_true', help='設定を変えずに現在の設定で計測する')
+    parser.add_argument('--keep', action='store_true', help='最後の間隔のままにする (元の設定に戻さない)')
+    parser.add_argument('--output', help='結果を保存する CSV ファイル')
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file) as f:
+            args.address += [line.split('#')[0].strip() for line in f if line.split('#')[0].strip() != '']
+    if len(args.address) == 0:
+        parser.error('address or --file is required')
+    try:
+        for interval_ms in args.intervals:
+            adv_interval_value(interval_ms)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        sys.exit()
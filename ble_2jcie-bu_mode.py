@@ -7,140 +7,200 @@
 #  'python -m pip install break'
 #
 # This sample tested python 3.9.13.
+#
+# 使い方: python ble_2jcie-bu_mode.py CD:C7:28:85:D3:AB [-m MODE] [-a ADV]
+#         python ble_2jcie-bu_mode.py CD:C7:28:85:D3:AB CA:43:F0:B6:24:95 ... [-m MODE] [-a ADV] [--concurrency 4]
+#         python ble_2jcie-bu_mode.py --file addresses.txt [-m MODE] [-a ADV]
+#   アドレスを複数指定した場合 (フリートモード) は、最初に 1 回だけスキャンして各環境センサを探し、
+#   最大 --concurrency 台に同時に接続して設定し、環境センサごとの結果と時間を表示する
+#   (フラッシュメモリの書き込み完了は asyncio.sleep で待つので、待っている間も他の環境センサの設定を進める)
+#   接続は jciebu_gatt.GattConnectionPool で行い、モデル名 (2JCIE-BU01) の確認は最初の接続のときだけ行う
+#   (接続に失敗して接続しなおす場合は確認しない)
 
 import sys
 import time
 import asyncio
-from bleak import BleakClient
+from bleak import BleakScanner
 import argparse
+from jciebu_gatt import (ADVERTISE_SETTING_UUID, MODE_CHANGE_UUID, GattConnectionPool,
+                         wait_flash_write, write_advertise_setting)
 
 # 2JCIE-BU01 address
 #ADDRESS = "CD:C7:28:85:D3:AB"
 
-# 2JCIE-BU01 GATT UUIDs
-model_number_string_UUID = "00002A24-0000-1000-8000-00805F9B34FB"
-mode_change_UUID         = "AB705117-0A3A-11E8-BA89-0ED5F89F718B"
-advertise_setting_UUID   = "AB705115-0A3A-11E8-BA89-0ED5F89F718B"
-flash_memory_status_UUID = "AB705403-0A3A-11E8-BA89-0ED5F89F718B"
+# 表示するモードと advertising mode の名前
+MODE_NAMES = {0x00: "0 [mormal mode]",
+              0x01: "1 [acceleration logger mode]"}
+ADV_NAMES = {0x01: "1 [sensor data]",
+             0x02: "2 [calcuration data]",
+             0x03: "3 [sensor & calcuration data]",
+             0x04: "4 [sensor & calcuration flags]",
+             0x05: "5 [serial number]",
+             0x06: "6 (reserve for future use)",
+             0x07: "7 (reserve for future use)",
+             0x08: "8 (reserve for future use)"}
+
 
-async def waitforwrite(client):
+async def configure(pool, address, mode, adv, log, device=None):
     """
-    wait for flash memory write end.
+    1 台の環境センサのモードを表示・設定する関数
+    pool: GattConnectionPool (モデル名の確認は pool が行い、2JCIE-BU01 でない場合は ValueError)
+    address: アドレス、device: BleakScanner で見つけた BLEDevice (None の場合は接続するときにスキャン)
+    mode, adv: 設定するモードと advertising mode (None の場合は表示のみ)
+    log: メッセージを表示する関数
+    (成功したかどうか, メッセージ) を返す
     """
-    ret = bytearray([0x01])  # initial
-    while ret[0] == 0x01 or ret[0] == 0x04: # loop while memory write/erase.
-        time.sleep(0.5)
-        ret = await client.read_gatt_char(flash_memory_status_UUID)
-
-    if ret[0] == 0x03:  # flash memory write error
-        print("error: mode set error. (flash memory write error)")
+    # open bluetooth client
+    async with pool.connection( address, device ) as client :
+        # if no argument, display current mode.
+        if mode == None and adv == None :
+            # check mode (UUID 0x5117)
+            ret = await client.read_gatt_char(MODE_CHANGE_UUID)
+            if ret[0] in MODE_NAMES:
+                log(" mode: " + MODE_NAMES[ret[0]])
+            else:
+                log(" error: unknown mode " + str(ret[0]))
+
+            # check advertise setting (UUID 0x5115)
+            ret = await client.read_gatt_char(ADVERTISE_SETTING_UUID)
+            if ret[2] in ADV_NAMES:
+                log(" advertising mode: " + ADV_NAMES[ret[2]])
+            else:
+                log(" error: unknown advertise setting " + str(ret[2]))
+            return True, "read"
+
+        # if adv is not 'None', change to new advertising mode (UUID 0x5115)
+        if adv != None:
+            # advertising interval はそのままで advertising mode だけを書き込み、フラッシュメモリの書き込み完了を待つ
+            if not await write_advertise_setting( client, mode=adv ):
+                log("error: advertising mode set error. (flash memory write error or timeout)")
+                return False, "advertising mode write error"
+
+        # if mode is not 'None', change to new mode (UUID 0x5117)
+        if mode != None:
+            await client.write_gatt_char(MODE_CHANGE_UUID, bytearray([mode]))
+            log("... resetting 2JCIE-BU01 internal memory, please wait until blue LED turns off.")
+            if not await wait_flash_write( client ):
+                log("error: mode set error. (flash memory write error or timeout)")
+                return False, "mode write error"
+
+        return True, "set"
 
 
 async def run():
     """
     mode read/set.
     """
+    pool = GattConnectionPool(1, timeout=args.timeout)
     try:
-        # open bluetooth client
-        async with BleakClient( args.address ) as client :
-            # device check
-            ret = await client.read_gatt_char(model_number_string_UUID)
-            if ret != b'2JCIE-BU01':
-                print("Device with address " + args.address + " is not 2JCIE-BU01.")
-                sys.exit()
-
-            # if no argument, display current mode.
-            if args.mode == None and args.adv == None :
-                print("Address: " + args.address )
-	        # check mode (UUID 0x5117)
-                ret = await client.read_gatt_char(mode_change_UUID)
-                if ret[0] == 0x00:
-                    print(" mode: 0 [mormal mode]")
-                elif ret[0] == 0x01:
-                    print(" mode: 1 [acceleration logger mode]")
-                else:
-                    print(" error: unknown mode " + str(ret[0]))
-
-	        # check advertise setting (UUID 0x5115)
-                ret = await client.read_gatt_char(advertise_setting_UUID)
-                if ret[2] == 0x01:
-                    print(" advertising mode: 1 [sensor data]")
-                elif ret[2] == 0x02:
-                    print(" advertising mode: 2 [calcuration data]")
-                elif ret[2] == 0x03:
-                    print(" advertising mode: 3 [sensor & calcuration data]")
-                elif ret[2] == 0x04:
-                    print(" advertising mode: 4 [sensor & calcuration flags]")
-                elif ret[2] == 0x05:
-                    print(" advertising mode: 5 [serial number]")
-                elif ret[2] == 0x06:
-                    print(" advertising mode: 6 (reserve for future use)")
-                elif ret[2] == 0x07:
-                    print(" advertising mode: 7 (reserve for future use)")
-                elif ret[2] == 0x08:
-                    print(" advertising mode: 8 (reserve for future use)")
-                else:
-                    print(" error: unknown advertise setting " + str(ret[2]))
-
-            # if args.adv is not 'None', change to new advertising mode (UUID 0x5115)
-            if args.adv != None:
-	            # read current advertise setting (UUID 0x5115)
-                ret = await client.read_gatt_char(advertise_setting_UUID)
-                # ret[0],ret[1] are current 'advertising interval'.
-
-                # set new advertising mode 
-                if args.adv[0] == 1:    # set sensor data mode
-                    ret[2] = 0x01
-                elif args.adv[0] == 2:  # set calcuration data mode
-                    ret[2] = 0x02
-                elif args.adv[0] == 3:  # set sensor & calcuration data mode
-                    ret[2] = 0x03
-                elif args.adv[0] == 4:  # set sensor & calcuration flags mode
-                    ret[2] = 0x04
-                elif args.adv[0] == 5:  # set serial number mode
-                    ret[2] = 0x05
-#               elif args.adv[0] == 6:      # for future use
-#                   ret[2] = 0x06
-#               elif args.adv[0] == 7:      # for future use
-#                   ret[2] = 0x07
-#               elif args.adv[0] == 8:      # for future use
-#                   ret[2] = 0x08
-                else:
-                    print( "error: advertising mode needs 1 to 5." )
-                    sys.exit()
-
-                await client.write_gatt_char(advertise_setting_UUID, ret)
-                await waitforwrite( client )
-
-            # if args.mode is not 'None', change to new mode (UUID 0x5117)
-            if args.mode != None:
-                if args.mode[0] == 0:   # set to normal mode
-                    setform = bytearray([0x00]) 
-                elif args.mode[0] == 1: # set to acceleration logger mode
-                    setform = bytearray([0x01]) 
-                else:
-                    print( "error: mode needs 0(=sensor mode) or 1(=acceleration logger mode)" )
-                    sys.exit()
-
-                await client.write_gatt_char(mode_change_UUID, setform)
-                print("... resetting 2JCIE-BU01 internal memory, please wait until blue LED turns off.")
-                await waitforwrite( client )
-
+        await configure( pool, args.address[0], mode, adv, print )
+    except ValueError:
+        # device check
+        print("Device with address " + args.address[0] + " is not 2JCIE-BU01.")
     except Exception as e:
         # bluetooth client can not open
-        print("Device with address " + args.address + " was not found.")
+        print("Device with address " + args.address[0] + " was not found.")
         print(e)
         sys.exit()
+    finally:
+        await pool.close()
+
+
+async def run_fleet(addresses):
+    """
+    複数の環境センサのモードを表示・設定する関数 (フリートモード)
+    最初に 1 回だけスキャンして各環境センサの BLEDevice を探し、最大 args.concurrency 台に同時に接続する
+    """
+    started = time.monotonic()
+    print(f"scanning for {len(addresses)} devices ({args.scan_timeout} s) ...")
+    found = {dev.address.upper(): dev for dev in await BleakScanner.discover(timeout=args.scan_timeout)}
+    scanned = time.monotonic() - started
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    pool = GattConnectionPool(args.concurrency, timeout=args.timeout)
+    results = {}
+
+    async def configure_one(address):
+        def log(text):
+            print(address + ": " + text.strip())
+
+        if address.upper() not in found:
+            results[address] = (False, "not found", 0.0, 0)
+            log("not found")
+            return
+        async with semaphore:
+            t = time.monotonic()
+            for attempt in range(1 + args.retries):
+                try:
+                    ok, message = await configure( pool, address, mode, adv, log, found[address.upper()] )
+                    break
+                except ValueError:
+                    # 2JCIE-BU01 でない場合は接続しなおさない
+                    ok, message = False, "not 2JCIE-BU01"
+                    break
+                except Exception as e:
+                    # 接続の失敗などは args.retries 回まで接続しなおす
+                    ok, message = False, repr(e)
+                    log("error: " + message)
+            results[address] = (ok, message, time.monotonic() - t, attempt + 1)
+            log(f"{'ok' if ok else 'failed'} ({message}, {time.monotonic() - t:.1f} s)")
+
+    try:
+        await asyncio.gather(*[configure_one(address) for address in addresses])
+    finally:
+        await pool.close()
+    total = time.monotonic() - started
+
+    # 環境センサごとの結果と時間
+    print("")
+    print(f"{'address':<20} {'result':<8} {'seconds':>8} {'tries':>5}  message")
+    for address in addresses:
+        ok, message, seconds, tries = results[address]
+        print(f"{address:<20} {'ok' if ok else 'failed':<8} {seconds:8.1f} {tries:5d}  {message}")
+    succeeded = sum(1 for r in results.values() if r[0])
+    slowest = max([r[2] for r in results.values()] + [0.0])
+    print(f"{succeeded}/{len(addresses)} devices ok: total {total:.1f} s (scan {scanned:.1f} s),"
+          f" slowest device {slowest:.1f} s, sum of devices {sum(r[2] for r in results.values()):.1f} s")
+    print(f"connections: {pool.connects} connects, {pool.model_reads} model reads")
 
 
 if __name__ == '__main__':
     # argmunets parser
     parser = argparse.ArgumentParser()
-    parser.add_argument("address", help='bluetooth address of 2JCIE-BU01 "xx:xx:xx:xx:xx:xx"')
+    parser.add_argument("address", nargs='*', help='bluetooth address of 2JCIE-BU01 "xx:xx:xx:xx:xx:xx" (複数指定可)')
     parser.add_argument("-m", "--mode", type=int, nargs=1, help='Mode {MODE: 0=normal mode, 1=acceleration logger mode}')
     parser.add_argument("-a", "--adv", type=int, nargs=1, help='Advertising mode {ADV: 1=sensor, 2=calcuration, 3=sensor&calcuration, 4=flags, 5=serial No.}' )
+    parser.add_argument("--file", help='アドレスを 1 行に 1 つ書いたファイル (# 以降はコメント)')
+    parser.add_argument("--concurrency", type=int, default=4, help='同時に接続する環境センサの数 (フリートモード)')
+    parser.add_argument("--scan-timeout", type=float, default=10.0, help='環境センサを探すスキャンの秒数 (フリートモード)')
+    parser.add_argument("--timeout", type=float, default=10.0, help='接続のタイムアウト (秒)')
+    parser.add_argument("--retries", type=int, default=1, help='接続に失敗した場合に接続しなおす回数 (フリートモード)')
     args = parser.parse_args()
 
-    #
-    asyncio.run(run())
+    if args.file is not None:
+        with open(args.file) as f:
+            args.address += [line.split('#')[0].strip() for line in f if line.split('#')[0].strip() != '']
+    if len(args.address) == 0:
+        parser.error("address or --file is required")
+
+    # 接続する前に設定する値を確認
+    adv = None
+    if args.adv != None:
+        if args.adv[0] not in (1, 2, 3, 4, 5):  # 6 - 8 are for future use
+            print( "error: advertising mode needs 1 to 5." )
+            sys.exit()
+        adv = args.adv[0]
+    mode = None
+    if args.mode != None:
+        if args.mode[0] not in (0, 1):
+            print( "error: mode needs 0(=sensor mode) or 1(=acceleration logger mode)" )
+            sys.exit()
+        mode = args.mode[0]
 
+    #
+    if len(args.address) == 1:
+        if mode == None and adv == None:
+            print("Address: " + args.address[0] )
+        asyncio.run(run())
+    else:
+        asyncio.run(run_fleet(args.address))
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# 2JCIE-BU01 environment sensor Bluetooth I/F sample
+# * This program connects to 2JCIE-BU01 and saves latest data notifications to CSV files
+# * intil press Ctrl-C
+#
+# This sample needs bleak module.
+#  'python -m pip install break'
+#
+# 使い方: python ble_2jcie-bu_notify2csv.py CA:43:F0:B6:24:95 [F9:E9:A4:FB:96:C9 ...]
+#         python ble_2jcie-bu_notify2csv.py --file addresses.txt
+#         python ble_2jcie-bu_notify2csv.py --file addresses.txt --poll 60 [--max-connections 5]
+#   環境センサに接続したままにして、最新データ (0x5012, 0x5013) の notification を受信する (jciebu_gatt.py)
+#   advertising packet と違って取りこぼしがなく、測定のたびに受信できる (取りこぼした数は lost に表示)
+#   CSVファイルは ble_2jcie-bu_adv2csv.py のデータモード 3 と同じ形式 (21_csv2stat.py などでそのまま読み込める)
+#   --poll: notification の代わりに、指定した秒数ごとに最新データを読み込む (接続したままにできる数より多い環境センサ用)
+#           接続は GattConnectionPool で --max-connections 台まで再利用し、上限の場合は最も長い間使っていない接続を切断
+#           環境センサが --max-connections 台より多い場合は、--max-connections 台ずつのグループで順に読み込む
+#           (前回の最後のグループを次の回の最初に読み込んで接続を再利用する。すべての接続を再利用するには
+#            --max-connections を環境センサの数以上にする)
+#   受信したデータは一旦スプール (jciebu_spool.py) に追記し、CSVファイルへの出力は別スレッドで行う
+#
+
+import sys
+import os
+import asyncio
+import argparse
+from datetime import datetime
+from jciebu_csv import CsvWriter
+from jciebu_gatt import GattConnectionPool, LatestPoller, NotificationCollector
+from jciebu_record import adv_csv_timestamp
+from jciebu_spool import Spool, SpoolDrainer
+
+# 受信したデータをCSV形式でユニットごとに出力するフォルダ
+output_folder = 'csv_files_notify'
+if not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+
+# CSVファイルへの書き出しの設定 (ble_2jcie-bu_adv2csv.py と同じ)
+CSV_FLUSH_ROWS = 10
+CSV_FLUSH_INTERVAL = 300
+CSV_FSYNC = False
+CSV_PARTITION = 'daily'
+csv_writer = CsvWriter(flush_rows=CSV_FLUSH_ROWS, flush_interval=CSV_FLUSH_INTERVAL, fsync=CSV_FSYNC,
+                       partition=CSV_PARTITION)
+
+# スプールのフォルダ
+SPOOL_FOLDER = os.path.join('spool_files', 'notify')
+spool = Spool(SPOOL_FOLDER)
+# スプールの送り終わった位置は、この秒数ごとにCSVファイルをすべて書き出してから保存する
+SPOOL_COMMIT_INTERVAL = 60
+
+# 接続が切れた場合などに接続しなおす設定
+CONNECT_TIMEOUT = 10.0
+STALL_TIMEOUT = 60.0
+# --poll で使っていない接続を切断するまでの秒数
+IDLE_TIMEOUT = 300.0
+
+def csv_row(record):
+    """
+    レコードの CSV のヘッダーと行 (受信時刻、data_mode、レコードの値) を返す関数
+    """
+    _header = ('datetime', 'timestamp', 'data_mode') + record.schema.fields
+    # timestamp は ble_2jcie-bu_adv2csv.py と同じ (adv_csv_timestamp)
+    _output = [datetime.fromtimestamp(record.time).strftime('%Y-%m-%d %H:%M:%S'),
+               str(adv_csv_timestamp(record.time)), str(record.schema.mode)]
+    _output.extend(record.csv_values())
+    return _header, _output
+
+def write_csv(records):
+    """
+    スプールから読み込んだレコードをCSVファイルに出力する関数 (SpoolDrainer のスレッドで実行)
+    """
+    for record in records:
+        _output_file = os.path.join(output_folder + '/' + record.device + '.csv')
+        _header, _output = csv_row(record)
+        csv_writer.write(_output_file, _header, _output, record.time, record.device)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('address', nargs='*', help='接続する環境センサのアドレス "xx:xx:xx:xx:xx:xx" (複数指定可)')
+    parser.add_argument('--file', help='アドレスを 1 行に 1 つ書いたファイル (# 以降はコメント)')
+    parser.add_argument('--poll', type=float, help='notification の代わりに、この秒数ごとに最新データを読み込む')
+    parser.add_argument('--max-connections', type=int, default=5, help='--poll で接続したままにする環境センサの数 (環境センサの数以上にすると、すべての接続を再利用する)')
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file) as f:
+            args.address += [line.split('#')[0].strip() for line in f if line.split('#')[0].strip() != '']
+    if len(args.address) == 0:
+        parser.error('address or --file is required')
+
+    # 前回の実行で出力していないデータがあれば、そこから出力
+    drainer = SpoolDrainer(spool, write_csv, idle=csv_writer.flush_due, flush=csv_writer.flush,
+                           commit_interval=SPOOL_COMMIT_INTERVAL)
+    drainer.start()
+
+    # レコードはスプールに追記するだけ (CSVファイルへの出力は SpoolDrainer のスレッドで行う)
+    if args.poll is None:
+        print('環境センサ(2JCIE-BU01)に接続して notification の受信を開始... (終了は Ctrl-C を押下)')
+        collector = NotificationCollector(args.address, spool.append_record, timeout=CONNECT_TIMEOUT,
+                                          stall_timeout=STALL_TIMEOUT)
+    else:
+        print(f'環境センサ(2JCIE-BU01)の最新データを {args.poll} 秒ごとに読み込み... (終了は Ctrl-C を押下)')
+        pool = GattConnectionPool(args.max_connections, timeout=CONNECT_TIMEOUT, idle_timeout=IDLE_TIMEOUT)
+        collector = LatestPoller(args.address, spool.append_record, pool, interval=args.poll)
+    try:
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(collector.run())
+    except KeyboardInterrupt:
+        if args.poll is None:
+            collector.report()
+        # スプールに残っているデータをCSVファイルに出力してクローズ
+        drainer.stop()
+        spool.close()
+        csv_writer.close()
+        sys.exit()
@@ -0,0 +1,192 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) USB シリアル通信 共通モジュール
+#
+# jciebu_acc.py: 加速度メモリのデータ (0x503F のレスポンス) を NumPy の配列に変換するモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_acc import AccDownloader, decode_acc_pages
+#
+# 0x503F のレスポンスは 1 ページ 237 バイトのフレームの並び
+#   [ページヘッダ 43 バイト][x, y, z (Int16, リトルエンディアン) x 32 サンプル = 192 バイト][CRC-16 2 バイト]
+# サンプリング間隔は 0.01 秒 (100Hz)
+#
+
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from jciebu_protocol import ACC_PAGE_SIZE
+from jciebu_serial import serial_read_frames
+
+# ページヘッダ (フレームのヘッダを含む) のバイト数
+ACC_PAGE_HEADER = 43
+# 1 ページのサンプル数
+ACC_PAGE_SAMPLES = 32
+# サンプリング間隔 (秒)
+ACC_SAMPLE_INTERVAL = 0.01
+# 加速度の単位 (gal)
+ACC_UNIT = 0.1
+# AccDownloader が 1 回のコマンドで要求するページ数
+CHUNK_PAGES = 32
+# 読み込みに失敗した場合の再試行までの待ち時間 (秒)、失敗が続くごとに倍 (ACC_MAX_RETRY_WAIT まで)
+ACC_RETRY_WAIT = 0.5
+ACC_MAX_RETRY_WAIT = 5.0
+
+# 1 ページを表す構造化データ型 (加速度はページヘッダと CRC-16 を除いた部分を Int16 で参照)
+ACC_PAGE_DTYPE = np.dtype([('header', 'V%d' % ACC_PAGE_HEADER),
+                           ('acc', '<i2', (ACC_PAGE_SAMPLES, 3)),
+                           ('crc', 'V2')])
+
+def decode_acc_pages(_pages, _time, _first_page=0):
+    """
+    0x503F のレスポンスを加速度の配列に変換する関数
+    _pages にはレスポンス全体 (bytes / bytearray / memoryview) またはページごとのフレームのリストを指定
+    _time は記録開始時刻 (UNIX 時間)、_first_page は _pages の先頭ページの番号 (0 始まり)
+    時刻は _time + (ページ番号 * 32 + サンプル番号) * 0.01 秒 (ローカル時刻の datetime64[us])
+    {'time_measured': 時刻, 'acc_x': x, 'acc_y': y, 'acc_z': z} の辞書で返す (各値は連続した配列)
+    """
+    if isinstance(_pages, (list, tuple)):
+        _pages = b''.join(_pages)
+    count = len(_pages) // ACC_PAGE_SIZE
+    # ページヘッダと CRC-16 を飛ばして Int16 として参照 (コピーなし)
+    acc = np.frombuffer(_pages, dtype=ACC_PAGE_DTYPE, count=count)['acc'].reshape(-1, 3)
+
+    # 時刻はまとめて計算し、ローカル時刻の datetime64 に変換
+    seconds = _time + (_first_page * ACC_PAGE_SAMPLES + np.arange(len(acc))) * ACC_SAMPLE_INTERVAL
+    offset = datetime.fromtimestamp(_time).astimezone().utcoffset()
+    time_measured = (np.round(seconds * 1e6).astype('int64').astype('datetime64[us]')
+                     + np.timedelta64(offset))
+
+    return {'time_measured': time_measured,
+            'acc_x': acc[:, 0] * ACC_UNIT,
+            'acc_y': acc[:, 1] * ACC_UNIT,
+            'acc_z': acc[:, 2] * ACC_UNIT}
+
+def acc_rows(_acc):
+    """
+    decode_acc_pages の結果をCSVの行 (時刻, x, y, z) のリストに変換する関数
+    時刻は datetime の文字列と同じ 'YYYY-MM-DD HH:MM:SS.ffffff' 形式
+    """
+    times = np.datetime_as_string(_acc['time_measured'], unit='us')
+    times = np.char.replace(times, 'T', ' ')
+    return list(zip(times.tolist(), _acc['acc_x'].tolist(), _acc['acc_y'].tolist(), _acc['acc_z'].tolist()))
+
+class AccDownloader:
+    """
+    加速度メモリのデータ (0x503F) をページ範囲ごとに分けて読み込むクラス
+    chunk_pages ページずつ要求し、変換したデータをそのつど sink に渡す (全ページをメモリに保持しない)
+    読み込みが終わったページ番号を checkpoint_file (JSON) に保存し、途中で失敗した場合は
+    次の run() またはプログラムの再起動後の resume() で、続きのページから読み込む
+
+    使い方:
+        downloader = AccDownloader(ser, 0x00, end_page, start_time, checkpoint_file='acc.json')
+        if downloader.run(lambda acc: acc2csv(acc, output_file)):
+            print(downloader.throughput())
+    """
+
+    def __init__(self, _ser, data_type, end_page, start_time, start_page=1,
+                 chunk_pages=CHUNK_PAGES, checkpoint_file=None, timecounter=0, output_file=None):
+        self._ser = _ser
+        self.data_type = data_type          # 0x00: Earthquake data 0x01: Vibration data
+        self.start_page = start_page        # 最初のページ番号 (1 始まり)
+        self.end_page = end_page            # 最後のページ番号
+        self.start_time = start_time        # 最初のページの記録開始時刻 (UNIX 時間)
+        self.chunk_pages = chunk_pages
+        self.checkpoint_file = checkpoint_file
+        self.timecounter = timecounter      # 加速度メモリのヘッダの timecounter (記録の識別用)
+        self.output_file = output_file      # 再開時に同じファイルに追記するための出力先
+        self.last_page = start_page - 1     # 読み込みが終わった最後のページ番号
+        self.pages = 0                      # 今回読み込んだページ数
+        self.elapsed = 0.0                  # 今回の読み込みにかかった時間 (秒)
+
+    @classmethod
+    def resume(cls, _ser, checkpoint_file, chunk_pages=CHUNK_PAGES):
+        """
+        checkpoint_file から途中の読み込みを再開する AccDownloader を作成する関数
+        checkpoint_file がない場合は None を返す
+        """
+        if not os.path.exists(checkpoint_file):
+            return None
+        with open(checkpoint_file) as f:
+            state = json.load(f)
+        downloader = cls(_ser, state['data_type'], state['end_page'], state['start_time'],
+                         start_page=state['start_page'], chunk_pages=chunk_pages,
+                         checkpoint_file=checkpoint_file, timecounter=state['timecounter'],
+                         output_file=state['output_file'])
+        downloader.last_page = state['last_page']
+        return downloader
+
+    def done(self):
+        return self.last_page >= self.end_page
+
+    def save_checkpoint(self):
+        """
+        読み込みが終わったページ番号を checkpoint_file に保存する関数 (一時ファイルに書いてから置き換え)
+        """
+        if self.checkpoint_file is None:
+            return
+        state = {'data_type': self.data_type, 'start_page': self.start_page, 'end_page': self.end_page,
+                 'start_time': self.start_time, 'timecounter': self.timecounter,
+                 'output_file': self.output_file, 'last_page': self.last_page}
+        with open(self.checkpoint_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def run(self, sink, retries=3, retry_wait=ACC_RETRY_WAIT):
+        """
+        残りのページを chunk_pages ページずつ読み込み、変換したデータを sink に渡す関数
+        途中でタイムアウトした場合は受信できたページまで sink に渡し、残りのページから読み込み直す
+        読み込みに失敗した場合は retry_wait 秒 (失敗が続くごとに倍) 待ってから再試行し、
+        1 ページも読み込めないことが retries 回続いた場合は中断して False を返す
+        全ページの読み込みが終わったら checkpoint_file を削除して True を返す
+        """
+        failures = 0
+        wait = retry_wait
+        while not self.done():
+            first = self.last_page + 1
+            last = min(first + self.chunk_pages - 1, self.end_page)
+            _payload = bytearray([0x01, # Read 0x01, Write 0x02
+                                  0x3F, 0x50, # Acceleration memory data [Data] (Address: 0x503F)
+                                  self.data_type, # Acceleration data type (0x00: Earthquake data 0x01: Vibration data)
+                                  0x01, # Request acceleration memory index UInt8 0x01: Fixed value
+                                  first & 0xFF, first >> 8, # Request page (Start page)
+                                  last & 0xFF, last >> 8]) # Request page (End page)
+            t = time.monotonic()
+            frames = serial_read_frames(self._ser, _payload, last - first + 1, partial=True)
+            self.elapsed += time.monotonic() - t
+
+            if len(frames) > 0:
+                # 受信できたページまで変換して出力し、チェックポイントを進める
+                failures = 0
+                sink(decode_acc_pages(frames, self.start_time, first - 1))
+                self.pages += len(frames)
+                self.last_page = first + len(frames) - 1
+                self.save_checkpoint()
+                if len(frames) == last - first + 1:
+                    wait = retry_wait
+                    continue
+            else:
+                failures += 1
+                if failures >= retries:
+                    print('acceleration download interrupted', f'(page {first}-{last}/{self.end_page})')
+                    self.save_checkpoint()
+                    return False
+
+            # 環境センサが処理中・リセット直後の場合に備えて、少し待ってから残りのページを要求
+            time.sleep(wait)
+            wait = min(wait * 2, ACC_MAX_RETRY_WAIT)
+
+        if self.checkpoint_file is not None and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        return True
+
+    def throughput(self):
+        """
+        今回の読み込みの転送速度 (ページ/秒, バイト/秒) を返す関数
+        """
+        if self.elapsed <= 0:
+            return 0.0, 0.0
+        return self.pages / self.elapsed, self.pages * ACC_PAGE_SIZE / self.elapsed
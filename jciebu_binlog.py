@@ -0,0 +1,320 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_binlog.py: センサデータを固定長のバイナリ形式 (セグメントファイル) に追記・読み込みするモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_binlog import BinlogWriter, read_segment
+#   writer = BinlogWriter('bin_files')
+#   writer.write(record)     # SensorRecord を追記 (スキーマごとに 1 つのセグメントファイル)
+#   writer.close()
+#   header, rows = read_segment('bin_files/latest.jbl')   # NumPy の構造化配列 (np.memmap) で読み込み
+#
+#   BinlogWriter('bin_files', partition='daily') の場合は日ごとのセグメントファイル (latest_20240701.jbl) に分け、
+#   フォルダのカタログ (catalog.json) にデバイスごとの期間と行数を記録する
+#
+# セグメントファイル (.jbl) の形式 (リトルエンディアン)
+#   [ヘッダ SEGMENT_HEADER_SIZE バイト][行 ...]
+#   ヘッダ: MAGIC (8 バイト) + JSON の長さ (UInt32) + JSON (スキーマとデバイスの一覧) + 0 埋め
+#   行: time (Int64, UNIX 時間のナノ秒) + device (UInt16, ヘッダのデバイスの一覧の番号) + 各フィールドの整数
+# 行は固定長なので、読み込み時は文字列の解析をせずに np.memmap でそのまま配列として参照できる
+# (書き込みの途中で終了した場合の末尾の不完全な行は無視する)
+#
+
+import json
+import os
+import time
+from datetime import datetime
+from struct import Struct, pack, unpack
+
+import numpy as np
+
+from jciebu_partition import PartitionCatalog, partition_path
+from jciebu_record import RecordSchema, adv_csv_timestamp
+
+# セグメントファイルの先頭の識別子
+SEGMENT_MAGIC = b'JCIEBU\x00\x01'
+# ヘッダのバイト数 (行はこの位置から始まる。デバイスの一覧が増えてもこの範囲で書き換える)
+SEGMENT_HEADER_SIZE = 16384
+# セグメントファイルの拡張子
+SEGMENT_EXT = '.jbl'
+
+# struct の型と NumPy の型の対応
+_NUMPY_TYPES = {'B': 'u1', 'b': 'i1', 'H': '<u2', 'h': '<i2', 'L': '<u4', 'l': '<i4', 'q': '<i8', 'Q': '<u8'}
+
+def row_format(_types):
+    """
+    フィールドの型のリストから、1 行の struct の書式を返す関数
+    """
+    return '<qH' + ''.join(_types)
+
+def row_dtype(_fields, _types):
+    """
+    フィールド名と型のリストから、1 行の NumPy の構造化データ型を返す関数 (struct の書式と同じ配置)
+    bytes のフィールド (10s など) は、末尾の 0 を取り除かないように 'S' ではなく 'V' (そのままのバイト列) にする
+    """
+    dtype = [('time', '<i8'), ('device', '<u2')]
+    for field, t in zip(_fields, _types):
+        dtype.append((field, 'V' + t[:-1] if t.endswith('s') else _NUMPY_TYPES[t]))
+    return np.dtype(dtype)
+
+def _read_header(f):
+    f.seek(0)
+    head = f.read(SEGMENT_HEADER_SIZE)
+    if len(head) < SEGMENT_HEADER_SIZE or head[:8] != SEGMENT_MAGIC:
+        raise ValueError('not a segment file')
+    length = unpack('<L', head[8:12])[0]
+    return json.loads(head[12:12 + length].decode())
+
+def _header_bytes(header):
+    text = json.dumps(header, separators=(',', ':')).encode()
+    if 12 + len(text) > SEGMENT_HEADER_SIZE:
+        raise ValueError('segment header is full (too many devices)')
+    return (SEGMENT_MAGIC + pack('<L', len(text)) + text).ljust(SEGMENT_HEADER_SIZE, b'\x00')
+
+def header_schema(header):
+    """
+    セグメントファイルのヘッダから RecordSchema を作成する関数
+    """
+    return RecordSchema(header['schema'], header['fields'], header['scales'], header['types'],
+                        header['formats'], header['mode'])
+
+class SegmentWriter:
+    """
+    1 つのスキーマの SensorRecord を 1 つのセグメントファイルに追記するクラス
+    既存のファイルの場合はヘッダを読み込み、スキーマが同じことを確認して末尾に追記する
+    新しいデバイスのレコードを書き込むときは、ヘッダのデバイスの一覧を書き換える
+    flush_rows 行ごと、または flush_interval 秒ごとにまとめて書き出す (fsync は CsvWriter と同じ)
+    """
+
+    def __init__(self, path, schema, flush_rows=100, flush_interval=10.0, fsync=False):
+        self.path = path
+        self.schema = schema
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._row = Struct(row_format(schema.types))
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+        if os.path.exists(path) and os.path.getsize(path) >= SEGMENT_HEADER_SIZE:
+            self._f = open(path, 'r+b')
+            self.header = _read_header(self._f)
+            if self.header['fields'] != list(schema.fields) or self.header['types'] != list(schema.types):
+                self._f.close()
+                raise ValueError(f'schema mismatch: {path}')
+            # 末尾の不完全な行を取り除いて追記
+            rows = (os.path.getsize(path) - SEGMENT_HEADER_SIZE) // self._row.size
+            self._f.truncate(SEGMENT_HEADER_SIZE + rows * self._row.size)
+        else:
+            self._f = open(path, 'w+b')
+            self.header = {'schema': schema.name, 'mode': schema.mode, 'fields': list(schema.fields),
+                           'scales': list(schema.scales), 'types': list(schema.types),
+                           'formats': list(schema.formats), 'devices': []}
+            self._f.write(_header_bytes(self.header))
+        self._f.seek(0, os.SEEK_END)
+        self._devices = {d: i for i, d in enumerate(self.header['devices'])}
+
+    def device_id(self, device):
+        """
+        デバイス名 (シリアルポート名、BLE のアドレス) のヘッダ内の番号を返す関数 (新しいデバイスはヘッダに追加)
+        """
+        i = self._devices.get(device)
+        if i is None:
+            devices = self.header['devices'] + [device]
+            data = _header_bytes(dict(self.header, devices=devices))
+            self._f.seek(0)
+            self._f.write(data)
+            self._f.seek(0, os.SEEK_END)
+            self.header['devices'] = devices
+            i = self._devices[device] = len(devices) - 1
+        return i
+
+    def write(self, record):
+        """
+        SensorRecord を 1 行追記する関数
+        """
+        self._f.write(self._row.pack(round(record.time * 1e9), self.device_id(record.device), *record.values))
+        self._pending += 1
+        if self.flush_rows > 0 and self._pending >= self.flush_rows:
+            self.flush()
+        elif self.flush_interval > 0 and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._f.flush()
+        if self.fsync:
+            os.fsync(self._f.fileno())
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if not self._f.closed:
+            self.flush()
+            self._f.close()
+
+class BinlogWriter:
+    """
+    SensorRecord をスキーマごとのセグメントファイル (folder/スキーマ名.jbl) に追記するクラス
+    partition に 'daily' または 'hourly' を指定した場合は、レコードの時刻で日ごと・時間ごとのファイルに分け、
+    カタログに記録する (前のパーティションのファイルは閉じる)
+    """
+
+    def __init__(self, folder, partition=None, **options):
+        self.folder = folder
+        self.partition = partition
+        self.options = options      # SegmentWriter の flush_rows, flush_interval, fsync
+        self._segments = {}         # スキーマ名 -> 書き込み中の SegmentWriter
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.catalog = PartitionCatalog(folder) if partition is not None else None
+
+    def segment_path(self, record):
+        path = os.path.join(self.folder, record.schema.name + SEGMENT_EXT)
+        return partition_path(path, record.time, self.partition)
+
+    def write(self, record):
+        path = self.segment_path(record)
+        segment = self._segments.get(record.schema.name)
+        if segment is None or segment.path != path:
+            if segment is not None:
+                segment.close()
+                if self.catalog is not None:
+                    self.catalog.save()
+            segment = self._segments[record.schema.name] = SegmentWriter(path, record.schema, **self.options)
+        segment.write(record)
+        if self.catalog is not None:
+            self.catalog.add(path, record.device, record.time)
+            if segment._pending == 0:
+                # 書き出した行をカタログにも保存 (CATALOG_SAVE_INTERVAL 秒ごと)
+                self.catalog.save_due()
+
+    def flush_due(self):
+        """
+        flush_interval 秒以上書き出していないセグメントを書き出す関数
+        """
+        now = time.monotonic()
+        for segment in self._segments.values():
+            if segment._pending > 0 and segment.flush_interval > 0 and now - segment._last_flush >= segment.flush_interval:
+                segment.flush()
+                if self.catalog is not None:
+                    self.catalog.save_due()
+
+    def flush(self):
+        """
+        すべてのセグメントの未書き出しの行を書き出す関数 (SpoolDrainer の flush から呼び出す)
+        """
+        for segment in self._segments.values():
+            if segment._pending > 0:
+                segment.flush()
+        if self.catalog is not None:
+            self.catalog.save_due()
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+        if self.catalog is not None:
+            self.catalog.save()
+
+def read_segment(path):
+    """
+    セグメントファイルを読み込み、(ヘッダの辞書, 行の構造化配列) を返す関数
+    行は np.memmap でファイルをそのまま参照する (読み込み専用、文字列の解析なし)
+    """
+    with open(path, 'rb') as f:
+        header = _read_header(f)
+    dtype = row_dtype(header['fields'], header['types'])
+    rows = (os.path.getsize(path) - SEGMENT_HEADER_SIZE) // dtype.itemsize
+    if rows == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=SEGMENT_HEADER_SIZE, shape=(rows,))
+
+def segment_arrays(header, rows):
+    """
+    read_segment の結果を、フィールド名と実際の値の配列の辞書に変換する関数
+    time は datetime64[ns] (UTC)、device はデバイス名の配列、各フィールドは除数で割った値
+    """
+    arrays = {'time': rows['time'].astype('datetime64[ns]'),
+              'device': np.array(header['devices'], dtype=object)[rows['device']]}
+    for field, scale, t in zip(header['fields'], header['scales'], header['types']):
+        if t.endswith('s'):
+            arrays[field] = np.array(rows[field].tolist(), dtype=object)    # bytes の配列
+        else:
+            arrays[field] = rows[field] if scale == 1 else rows[field] / scale
+    return arrays
+
+def segment_timestamps(rows):
+    """
+    セグメントファイルの行の time を、ble_2jcie-bu_adv2csv.py の CSV の timestamp 列の値 (adv_csv_timestamp) の
+    配列に変換する関数 (segment_dataframe と segment_to_csv で同じ値にする)
+    """
+    return np.array([adv_csv_timestamp(t) for t in (rows['time'] / 1e9).tolist()], dtype=float)
+
+def segment_dataframe(path):
+    """
+    セグメントファイルを pandas の DataFrame (インデックスはローカル時刻の datetime) に変換する関数
+    21_csv2stat.py, 22_csv2graph.py で CSV ファイルの代わりに読み込む
+    列は segment_to_csv と同じ (最新データ(0x5021) は time_measured, port, 各フィールド、
+    advertising packet は datetime, timestamp, device, data_mode, 各フィールド)
+    """
+    import pandas as pd     # 収集プログラムでは使わないので、ここで読み込む
+
+    header, rows = read_segment(path)
+    arrays = segment_arrays(header, rows)
+    arrays.pop('time')
+    devices = arrays.pop('device')
+    times = pd.to_datetime(rows['time'], unit='ns', utc=True).tz_convert(
+        datetime.now().astimezone().tzinfo).tz_localize(None)
+    if header['mode'] == 0:
+        # 06_multi_latest2csv.py の CSV ファイルと同じ列
+        index = pd.DatetimeIndex(times, name='time_measured')
+        columns = {'port': devices}
+    else:
+        # ble_2jcie-bu_adv2csv.py の CSV ファイルと同じ列 (timestamp は adv_csv_timestamp の値)
+        index = pd.DatetimeIndex(times, name='datetime')
+        columns = {'timestamp': segment_timestamps(rows), 'device': devices,
+                   'data_mode': np.full(len(rows), header['mode'])}
+    columns.update(arrays)
+    return pd.DataFrame(columns, index=index)
+
+def segment_to_csv(path, output_file, device=None):
+    """
+    セグメントファイルを CSV ファイルに変換する関数 (書き込み済みの行数を返す)
+    列はスキーマで選ぶ
+      最新データ(0x5021): time_measured (ローカル時刻), port, 各フィールド
+        (06_multi_latest2csv.py の CSV ファイルと同じ列と値)
+      advertising packet: datetime (ローカル時刻), timestamp, device, data_mode, 各フィールド
+        (ble_2jcie-bu_adv2csv.py のデバイスごとの CSV ファイルと同じ列と値。timestamp も adv2csv と同じく
+        adv_csv_timestamp の値で、UTC 以外のタイムゾーンでは実際の UNIX 時間とずれる)
+    device を指定した場合はそのデバイスの行だけを出力 (advertising packet は device 列なし)
+    """
+    header, rows = read_segment(path)
+    schema = header_schema(header)
+    devices = header['devices']
+    if device is not None:
+        if device not in devices:
+            rows = rows[:0]
+        else:
+            rows = rows[rows['device'] == devices.index(device)]
+
+    with open(output_file, 'w') as f:
+        if schema.mode == 0:
+            f.write(','.join(['time_measured', 'port'] + list(schema.fields)) + '\n')
+            for row in rows.tolist():
+                line = [str(datetime.fromtimestamp(row[0] / 1e9)), devices[row[1]]]
+                line.extend(schema.format(row[2:]))
+                f.write(','.join(line) + '\n')
+            return len(rows)
+
+        columns = ['datetime', 'timestamp'] + (['device'] if device is None else []) + ['data_mode']
+        f.write(','.join(columns + list(schema.fields)) + '\n')
+        mode = str(schema.mode)
+        for row, timestamp in zip(rows.tolist(), segment_timestamps(rows).tolist()):
+            line = [datetime.fromtimestamp(row[0] / 1e9).strftime('%Y-%m-%d %H:%M:%S'), str(timestamp)]
+            if device is None:
+                line.append(devices[row[1]])
+            line.append(mode)
+            line.extend(schema.format(row[2:]))
+            f.write(','.join(line) + '\n')
+    return len(rows)
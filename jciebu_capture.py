@@ -0,0 +1,132 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_capture.py: 受信した advertising packet をそのままファイルに記録し、後で再生するモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_capture import CaptureWriter, replay
+#   capture = CaptureWriter('capture.jcap')
+#   capture.write(time.time(), dev.address, dev.name, advdata.manufacturer_data[0x02D5])
+#   capture.close()
+#
+#   packets, seconds = replay('capture.jcap', advcallback, speed=1.0)  # 受信した間隔で advcallback を呼び出す
+#   packets, seconds = replay('capture.jcap', advcallback, speed=0)    # 待たずに呼び出す (処理速度の計測)
+#
+# ファイルはマジックナンバー (8 バイト) の後に、1 パケットごとに
+#   [受信時刻 double][アドレスの長さ][名前の長さ][データの長さ][アドレス][名前][manufacturer_data[0x02D5]]
+# を並べる。アドレスが 'CA:43:F0:B6:24:95' の形式の場合は 6 バイト (長さは 0) で保存する
+#
+
+import re
+import time
+from struct import Struct
+
+# ファイルの先頭のマジックナンバー
+CAPTURE_MAGIC = b'JCIEBUC\x01'
+# ファイルの拡張子
+CAPTURE_EXT = '.jcap'
+# OMRON の company ID
+COMPANY_ID = 0x02D5
+
+# 1 パケットの先頭 (受信時刻, アドレスの長さ, 名前の長さ, データの長さ)
+_PACKET_HEAD = Struct('<dBBB')
+_MAC_ADDRESS = re.compile(r'^[0-9A-Fa-f]{2}(:[0-9A-Fa-f]{2}){5}$')
+
+class CapturedDevice:
+    """
+    再生時に advcallback に渡す BLEDevice の代わり (address, name)
+    """
+    __slots__ = ('address', 'name')
+
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+
+class CapturedAdvertisement:
+    """
+    再生時に advcallback に渡す AdvertisementData の代わり (manufacturer_data)
+    """
+    __slots__ = ('manufacturer_data',)
+
+    def __init__(self, data):
+        self.manufacturer_data = {COMPANY_ID: data}
+
+class CaptureWriter:
+    """
+    受信した advertising packet をファイルに追記するクラス
+    """
+
+    def __init__(self, path, buffering=65536):
+        self.path = path
+        self.packets = 0
+        self._f = open(path, 'ab', buffering=buffering)
+        if self._f.tell() == 0:
+            self._f.write(CAPTURE_MAGIC)
+
+    def write(self, _time, address, name, data):
+        """
+        1 パケット (受信時刻 (UNIX 時間), アドレス, 名前, manufacturer_data[0x02D5]) を追記する関数
+        """
+        if _MAC_ADDRESS.match(address):
+            address = bytes.fromhex(address.replace(':', ''))
+            address_len = 0
+        else:
+            # macOS の bleak では UUID の文字列
+            address = address.encode()
+            address_len = len(address)
+        name = (name or '').encode()
+        self._f.write(_PACKET_HEAD.pack(_time, address_len, len(name), len(data)) + address + name + bytes(data))
+        self.packets += 1
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+def read_capture(path):
+    """
+    記録したファイルから (受信時刻, アドレス, 名前, データ) を順に返すジェネレータ
+    書き込み途中で終わっている末尾のパケットは読まない
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError('not a capture file: ' + path)
+    pos = len(CAPTURE_MAGIC)
+    while pos + _PACKET_HEAD.size <= len(data):
+        _time, address_len, name_len, data_len = _PACKET_HEAD.unpack_from(data, pos)
+        pos += _PACKET_HEAD.size
+        size = (address_len or 6) + name_len + data_len
+        if pos + size > len(data):
+            break
+        if address_len == 0:
+            address = ':'.join('%02X' % b for b in data[pos:pos + 6])
+            pos += 6
+        else:
+            address = data[pos:pos + address_len].decode()
+            pos += address_len
+        name = data[pos:pos + name_len].decode()
+        pos += name_len
+        yield _time, address, name, data[pos:pos + data_len]
+        pos += data_len
+
+def replay(path, callback, speed=0):
+    """
+    記録したファイルのパケットを callback(dev, advdata, 受信時刻) に渡す関数
+    speed: 1.0 で受信した間隔どおり、2.0 で 2 倍の速さ、0 の場合は待たずに続けて渡す
+    (渡したパケットの数, かかった秒数) を返す
+    """
+    packets = 0
+    start = time.perf_counter()
+    first = None
+    for _time, address, name, data in read_capture(path):
+        if speed > 0:
+            if first is None:
+                first = _time
+            wait = (_time - first) / speed - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+        callback(CapturedDevice(address, name), CapturedAdvertisement(data), _time)
+        packets += 1
+    return packets, time.perf_counter() - start
@@ -0,0 +1,190 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_csv.py: 複数のCSVファイルへの追記をまとめて行うモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_csv import CsvWriter
+#   writer = CsvWriter(flush_rows=10, flush_interval=60)
+#   writer.write('csv_files/xxx.csv', ('time', 'temperature'), ('2024-07-01 00:00:00', '25.1'))
+#   writer.close()
+#
+#   partition='daily' (または 'hourly') を指定すると、write に _time (UNIX 時間) を指定した行は
+#   日ごと (時間ごと) のファイル (xxx_20240701.csv) に書き込み、フォルダのカタログ (catalog.json) に記録する
+#   (カタログのファイルの保存は、パーティションの切り替え、close、または CATALOG_SAVE_INTERVAL 秒ごと)
+#
+# ファイルごとにファイルを開いたままにして、ヘッダーを出力済みかどうかも覚えておく
+# 書き込んだ行は flush_rows 行ごと、または flush_interval 秒ごとにまとめてディスクに書き出す
+# (SD カードなどへの書き込み回数とシステムコールを減らす)
+#
+
+import os
+import time
+
+from jciebu_partition import PartitionCatalog, partition_path
+
+class CsvWriter:
+    """
+    CSVファイルごとに 1 つのファイルハンドルを保持して追記するクラス
+
+    flush_rows: この行数を書き込むごとに flush (0 の場合は行数では flush しない)
+    flush_interval: 前回の flush からこの秒数が経過したら flush (0 の場合は時間では flush しない)
+    fsync: True の場合は flush のたびに os.fsync でディスクへの書き込みを待つ
+    max_files: 同時に開いておくファイルの数の上限 (超えた場合は最も古く書き込んだファイルを閉じる)
+    partition: None, 'daily', 'hourly' (ファイルを日ごと・時間ごとに分ける)
+    """
+
+    def __init__(self, flush_rows=100, flush_interval=10.0, fsync=False, max_files=64, buffering=65536,
+                 partition=None):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_files = max_files
+        self.buffering = buffering
+        self.partition = partition
+        self._files = {}    # ファイル名 -> [ファイルハンドル, 未 flush の行数, 前回の flush の時刻]
+        self._current = {}  # 分ける前のファイル名 -> 書き込み中のパーティションのファイル名
+        self._catalogs = {} # フォルダ -> PartitionCatalog
+        self.rows = 0       # 書き込んだ行数
+        self.flushes = 0    # flush の回数
+
+    def _open(self, _file, header):
+        entry = self._files.pop(_file, None)
+        if entry is None:
+            if len(self._files) >= self.max_files:
+                self.close_file(next(iter(self._files)))
+            f = open(_file, 'a', buffering=self.buffering)
+            if f.tell() == 0 and header is not None:
+                # 新しいファイルの場合はヘッダーを出力
+                f.write(','.join(header) + '\n')
+            entry = [f, 0, time.monotonic()]
+        # 書き込んだ順に並べる (先頭が最も古い)
+        self._files[_file] = entry
+        return entry
+
+    def _catalog(self, path):
+        folder = os.path.dirname(path)
+        catalog = self._catalogs.get(folder)
+        if catalog is None:
+            catalog = self._catalogs[folder] = PartitionCatalog(folder)
+        return catalog
+
+    def _partition(self, _file, _time):
+        """
+        時刻 _time のパーティションのファイル名を返す関数
+        パーティションが変わった場合は前のパーティションのファイルを閉じて、カタログを保存する
+        """
+        path = partition_path(_file, _time, self.partition)
+        current = self._current.get(_file)
+        if current != path:
+            if current is not None:
+                self.close_file(current)
+                self._catalog(current).save()
+            self._current[_file] = path
+        return path
+
+    def write(self, _file, header, row, _time=None, device=''):
+        """
+        _file に 1 行追記する関数
+        header (フィールド名のリスト) は新しいファイルの場合だけ出力、row は文字列のリスト
+        partition を指定した場合は、_time (UNIX 時間) のパーティションに書き込み、device と合わせてカタログに記録
+        """
+        self.write_rows(_file, header, (row,), _time, device)
+
+    def write_rows(self, _file, header, rows, _time=None, device=''):
+        """
+        _file に複数の行をまとめて追記する関数
+        _time は行の時刻 (1 つの値の場合はすべての行の時刻、リストの場合は行ごとの時刻)
+        partition を指定した場合は、行の時刻のパーティションごとに書き込み、書き込んだ後に
+        パーティションごとの最初と最後の時刻と行数をカタログに記録する
+        """
+        if self.partition is None or _time is None:
+            self._write_rows(_file, header, rows)
+            return
+        rows = list(rows)
+        times = list(_time) if isinstance(_time, (list, tuple)) else [_time] * len(rows)
+        start = 0
+        while start < len(rows):
+            # 同じパーティションの行をまとめて書き込む
+            path = self._partition(_file, times[start])
+            end = start + 1
+            while end < len(rows) and (times[end] == times[start] or
+                                       partition_path(_file, times[end], self.partition) == path):
+                end += 1
+            n = self._write_rows(path, header, rows[start:end])
+            self._catalog(path).add(path, device, min(times[start:end]), max(times[start:end]), n)
+            start = end
+
+    def _write_rows(self, _file, header, rows):
+        """
+        _file に行を追記し、書き込んだ行数を返す関数
+        """
+        entry = self._open(_file, header)
+        n = 0
+        lines = []
+        for row in rows:
+            lines.append(','.join(row))
+            n += 1
+        if n == 0:
+            return 0
+        lines.append('')
+        entry[0].write('\n'.join(lines))
+        entry[1] += n
+        self.rows += n
+        if self.flush_rows > 0 and entry[1] >= self.flush_rows:
+            self._flush(entry)
+        elif self.flush_interval > 0 and time.monotonic() - entry[2] >= self.flush_interval:
+            self._flush(entry)
+        return n
+
+    def _flush(self, entry):
+        f = entry[0]
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+        entry[1] = 0
+        entry[2] = time.monotonic()
+        self.flushes += 1
+        # カタログは CATALOG_SAVE_INTERVAL 秒ごとに保存 (flush のたびにカタログ全体を書き直さない)
+        for catalog in self._catalogs.values():
+            catalog.save_due()
+
+    def flush(self, _file=None):
+        """
+        未 flush の行を書き出す関数 (_file を省略した場合は全ファイル)
+        """
+        for name, entry in list(self._files.items()):
+            if (_file is None or name == _file) and entry[1] > 0:
+                self._flush(entry)
+
+    def flush_due(self):
+        """
+        flush_interval 秒以上 flush していないファイルを書き出す関数
+        書き込みがない間も定期的に呼び出す
+        """
+        now = time.monotonic()
+        for entry in self._files.values():
+            if entry[1] > 0 and self.flush_interval > 0 and now - entry[2] >= self.flush_interval:
+                self._flush(entry)
+
+    def close_file(self, _file):
+        """
+        _file を書き出して閉じる関数
+        """
+        entry = self._files.pop(_file, None)
+        if entry is not None:
+            if entry[1] > 0:
+                self._flush(entry)
+            entry[0].close()
+
+    def close(self):
+        for name in list(self._files):
+            self.close_file(name)
+        for catalog in self._catalogs.values():
+            catalog.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
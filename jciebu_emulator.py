@@ -0,0 +1,418 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_emulator.py: 疑似端末 (Linux) で環境センサ(2JCIE-BU)の USB シリアル通信を模擬するモジュール #
+#
+# 使い方: python jciebu_emulator.py [--delay ミリ秒] [--drop-rate 割合] [--event-every 秒] [--link /tmp/ttyJCIEBU]
+#   表示されたデバイス名 (/dev/pts/3 など) を各プログラムのシリアルポートに指定して実行する
+#     python 06_multi_latest2csv.py /dev/pts/3
+#
+#   各プログラムから import して利用する場合
+#     from jciebu_emulator import SensorEmulator
+#     emulator = SensorEmulator(delay=0.005)
+#     port = emulator.start()     # 疑似端末のデバイス名
+#     ...
+#     emulator.stop()
+#
+# 受信したコマンドのフレーム (ヘッダ・Length・CRC-16) を FrameDecoder で切り出し、アドレスごとのレスポンスを
+# 実機と同じフレーム形式 (CRC-16 付き) で返す
+#   0x5021 最新データ, 0x5013 最新データ (計算値と加速度), 0x5201 時刻カウンタ, 0x5202 時刻設定,
+#   0x5203 記録間隔, 0x503E / 0x503F 加速度メモリ (ヘッダ / ページ), 0x5111 LED 設定, 0x5117 モード
+# 測定値は乱数で少しずつ変化させ、trigger() で地震 (振動) を発生させると、vibration_information が
+# duration 秒の間 2 (1) になり、その後、加速度メモリのヘッダに記録の終了時刻 (時刻カウンタ) が入る
+#
+# 計測・試験用に、応答の遅延 (delay, jitter)、通信速度 (baudrate)、分割送信 (chunk) と、
+# 応答なし (drop_rate)、CRC-16 の誤り (crc_rate)、エラーレスポンス (error_rate)、
+# 不要なバイトの混入 (noise_rate) を乱数 (seed) で再現できるように発生させる
+#
+
+import argparse
+import math
+import os
+import queue
+import random
+import threading
+import time
+import tty
+from struct import Struct
+
+from jciebu_protocol import LATEST_DATA_FORMAT, FrameDecoder, build_frame
+
+# コマンド (Read / Write) とエラーレスポンスのコマンド (0x80 を加える)
+READ = 0x01
+WRITE = 0x02
+ERROR = 0x80
+# エラーコード
+ERROR_CRC = 0x01
+ERROR_COMMAND = 0x02
+ERROR_ADDRESS = 0x03
+ERROR_LENGTH = 0x04
+ERROR_DATA = 0x05
+ERROR_BUSY = 0x06
+
+# レスポンスのデータ部分 (アドレスの後から CRC-16 の前まで、リトルエンディアン)
+LATEST_DATA_LONG = Struct(LATEST_DATA_FORMAT)               # 0x5021
+LATEST_CALC_DATA = Struct('<BHhBHHHhhh')                    # 0x5013 (加速度は ret[19] から)
+TIME_COUNTER = Struct('<Q')                                 # 0x5201, 0x5202
+STORAGE_INTERVAL = Struct('<H')                             # 0x5203
+ACC_MEMORY_REQUEST = Struct('<BB')                          # 0x503E のコマンド (データ種別, メモリ番号)
+ACC_MEMORY_HEADER = Struct('<HBBHQHHH')                     # 0x503E (ページ数は ret[7:9], 時刻カウンタは ret[13:21])
+ACC_PAGE_REQUEST = Struct('<BBHH')                          # 0x503F のコマンド (データ種別, メモリ番号, 開始・終了ページ)
+ACC_PAGE_HEAD = Struct('<BBHQ24x')                          # 0x503F の 1 ページのページヘッダ (36 バイト)
+ACC_PAGE_SAMPLES = Struct('<' + 'h' * 96)                   # 32 サンプル x (x, y, z)
+LED_SETTING = Struct('<HBBB')                               # 0x5111
+MODE = Struct('<B')                                         # 0x5117
+
+class SensorEmulator:
+    """
+    疑似端末で環境センサ(2JCIE-BU)の代わりに応答するクラス
+
+    delay: コマンドを受信してからレスポンスを送信するまでの時間 (秒)、jitter: delay に加える乱数の上限 (秒)
+    baudrate: 指定した場合はレスポンスをこの通信速度 (1 バイト 10 ビット) で送る時間をかけて送信
+    chunk: 指定した場合はレスポンスをこのバイト数ずつ分けて送信
+    drop_rate, crc_rate, error_rate, noise_rate: 応答なし、CRC-16 の誤り、エラーレスポンス (Busy)、
+    レスポンスの前に不要なバイトを入れる割合 (0 から 1)
+    acc_pages: 加速度メモリに記録されているページ数 (地震・振動のデータそれぞれ)
+    seed: 測定値と障害の乱数の種
+    """
+
+    def __init__(self, delay=0.0, jitter=0.0, baudrate=None, chunk=None,
+                 drop_rate=0.0, crc_rate=0.0, error_rate=0.0, noise_rate=0.0,
+                 acc_pages=128, seed=0):
+        self.delay = delay
+        self.jitter = jitter
+        self.baudrate = baudrate
+        self.chunk = chunk
+        self.drop_rate = drop_rate
+        self.crc_rate = crc_rate
+        self.error_rate = error_rate
+        self.noise_rate = noise_rate
+        self.acc_pages = acc_pages
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        # センサの状態
+        self.sequence_number = 0
+        self.values = {'temperature': 2500, 'relative_humidity': 5000, 'ambient_light': 300,
+                       'barometric_pressure': 1013250, 'sound_noise': 4500, 'eTVOC': 10, 'eCO2': 400}
+        self.storage_interval = 300
+        self.led = (0, 0, 0, 0)
+        self.mode = 0
+        self._counter_base = 0              # 時刻設定 (0x5202) で書き込んだ時刻カウンタ
+        self._counter_set = time.monotonic()
+        self._event = None                  # (データ種別, 終了時刻 (monotonic), 記録するページ数)
+        self._memory = {0: (acc_pages, 0), 1: (acc_pages, 0)}   # データ種別 -> (ページ数, 時刻カウンタ)
+
+        self._handlers = {0x5021: self._latest_data_long,
+                          0x5013: self._latest_calc_data,
+                          0x5201: self._latest_time_counter,
+                          0x5202: self._time_setting,
+                          0x5203: self._storage_interval,
+                          0x503E: self._acc_memory_header,
+                          0x503F: self._acc_memory_pages,
+                          0x5111: self._led_setting,
+                          0x5117: self._mode_change}
+
+        self.commands = 0       # 受信したコマンドの数
+        self.responses = 0      # 送信したレスポンスのフレームの数
+        self.bytes_sent = 0     # 送信したバイト数
+        self.dropped = 0        # 応答しなかったコマンドの数
+        self.corrupted = 0      # CRC-16 を誤らせたレスポンスの数
+        self.errors = 0         # エラーレスポンスの数
+        self.decoder = FrameDecoder()   # 受信したコマンドの CRC-16 の誤りは decoder.crc_errors
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._link = None
+        self._responses = queue.Queue()
+
+    def start(self, link=None):
+        """
+        疑似端末を作成して応答を開始し、デバイス名を返す関数
+        link を指定した場合は、そのパスにデバイスへのシンボリックリンクを作成する
+        """
+        self._master, self._slave = os.openpty()
+        # pyserial 以外から開いた場合もエコーや改行の変換をしないようにする
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        if link is not None:
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+            self._link = link
+        threading.Thread(target=self._receive, daemon=True).start()
+        threading.Thread(target=self._send, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        self._responses.put(None)
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if self._link is not None and os.path.islink(self._link):
+            os.remove(self._link)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def trigger(self, data_type=0, duration=5.0, pages=None):
+        """
+        地震 (data_type=0) または振動 (data_type=1) を発生させる関数
+        duration 秒の間 vibration_information を 2 (地震) または 1 (振動) にし、
+        その後、加速度メモリに pages ページ (省略時は acc_pages) の記録と終了時の時刻カウンタを保存する
+        """
+        with self._lock:
+            self._event = (data_type, time.monotonic() + duration, pages or self.acc_pages)
+
+    def time_counter(self):
+        """
+        現在の時刻カウンタ (時刻設定からの経過秒数) を返す関数
+        """
+        return self._counter_base + int(time.monotonic() - self._counter_set)
+
+    def _vibration(self):
+        """
+        現在の vibration_information (0: なし, 1: 振動, 2: 地震) を返す関数
+        地震・振動が終わった時点で加速度メモリを更新する
+        """
+        if self._event is None:
+            return 0
+        data_type, end, pages = self._event
+        if time.monotonic() < end:
+            return 2 if data_type == 0 else 1
+        self._memory[data_type] = (pages, self.time_counter())
+        self._event = None
+        return 0
+
+    # 以下、アドレスごとのレスポンス (Read / Write, コマンドのデータ) -> (コマンド, データ または None) のリスト
+
+    def _latest_data_long(self, command, data):
+        if command != READ:
+            return [(ERROR | command, bytes([ERROR_COMMAND]))]
+        self.sequence_number = (self.sequence_number + 1) & 0xFF
+        v = self.values
+        rnd = self._random
+        v['temperature'] += rnd.randint(-5, 5)
+        v['relative_humidity'] = min(max(v['relative_humidity'] + rnd.randint(-10, 10), 0), 10000)
+        v['ambient_light'] = max(v['ambient_light'] + rnd.randint(-3, 3), 0)
+        v['barometric_pressure'] += rnd.randint(-20, 20)
+        v['sound_noise'] = max(v['sound_noise'] + rnd.randint(-50, 50), 3300)
+        v['eTVOC'] = max(v['eTVOC'] + rnd.randint(-1, 1), 0)
+        v['eCO2'] = max(v['eCO2'] + rnd.randint(-5, 5), 400)
+        t = v['temperature'] / 100
+        h = v['relative_humidity'] / 100
+        discomfort_index = 0.81 * t + 0.01 * h * (0.99 * t - 14.3) + 46.3
+        vibration = self._vibration()
+        si_value, pga, seismic_intensity = (120, 850, 3200) if vibration == 2 else (0, 0, 0)
+        return [(READ, LATEST_DATA_LONG.pack(
+            self.sequence_number, v['temperature'], v['relative_humidity'], v['ambient_light'],
+            v['barometric_pressure'], v['sound_noise'], v['eTVOC'], v['eCO2'],
+            round(discomfort_index * 100), round((t - 5) * 100), vibration, si_value, pga, seismic_intensity,
+            *([0] * 12)))]
+
+    def _latest_calc_data(self, command, data):
+        if command != READ:
+            return [(ERROR | command, bytes([ERROR_COMMAND]))]
+        self.sequence_number = (self.sequence_number + 1) & 0xFF
+        vibration = self._vibration()
+        amplitude = 800 if vibration > 0 else 5
+        rnd = self._random
+        return [(READ, LATEST_CALC_DATA.pack(
+            self.sequence_number, 7000, 2000, vibration, 0, 0, 0,
+            rnd.randint(-amplitude, amplitude), rnd.randint(-amplitude, amplitude),
+            -9800 + rnd.randint(-amplitude, amplitude)))]
+
+    def _latest_time_counter(self, command, data):
+        if command != READ:
+            return [(ERROR | command, bytes([ERROR_COMMAND]))]
+        return [(READ, TIME_COUNTER.pack(self.time_counter()))]
+
+    def _time_setting(self, command, data):
+        if command == WRITE:
+            if len(data) != TIME_COUNTER.size:
+                return [(ERROR | command, bytes([ERROR_LENGTH]))]
+            self._counter_base = TIME_COUNTER.unpack(data)[0]
+            self._counter_set = time.monotonic()
+            return [(WRITE, bytes(data))]
+        return [(READ, TIME_COUNTER.pack(self.time_counter()))]
+
+    def _storage_interval(self, command, data):
+        if command == WRITE:
+            if len(data) != STORAGE_INTERVAL.size:
+                return [(ERROR | command, bytes([ERROR_LENGTH]))]
+            self.storage_interval = STORAGE_INTERVAL.unpack(data)[0]
+            return [(WRITE, bytes(data))]
+        return [(READ, STORAGE_INTERVAL.pack(self.storage_interval))]
+
+    def _acc_memory_header(self, command, data):
+        if command != READ:
+            return [(ERROR | command, bytes([ERROR_COMMAND]))]
+        if len(data) != ACC_MEMORY_REQUEST.size:
+            return [(ERROR | command, bytes([ERROR_LENGTH]))]
+        data_type, index = ACC_MEMORY_REQUEST.unpack(data)
+        if data_type not in self._memory:
+            return [(ERROR | command, bytes([ERROR_DATA]))]
+        self._vibration()
+        pages, counter = self._memory[data_type]
+        if counter == 0:
+            pages = 0
+        return [(READ, ACC_MEMORY_HEADER.pack(pages, data_type, index, 0, counter, 120, 850, 3200))]
+
+    def _acc_memory_pages(self, command, data):
+        if command != READ:
+            return [(ERROR | command, bytes([ERROR_COMMAND]))]
+        if len(data) != ACC_PAGE_REQUEST.size:
+            return [(ERROR | command, bytes([ERROR_LENGTH]))]
+        data_type, index, start_page, end_page = ACC_PAGE_REQUEST.unpack(data)
+        pages, counter = self._memory.get(data_type, (0, 0))
+        if start_page < 1 or end_page < start_page or end_page > pages:
+            return [(ERROR | command, bytes([ERROR_DATA]))]
+        return [(READ, ACC_PAGE_HEAD.pack(data_type, index, page, counter) + self.acc_page(data_type, page))
+                for page in range(start_page, end_page + 1)]
+
+    def _led_setting(self, command, data):
+        if command == WRITE:
+            if len(data) != LED_SETTING.size:
+                return [(ERROR | command, bytes([ERROR_LENGTH]))]
+            self.led = LED_SETTING.unpack(data)
+            return [(WRITE, bytes(data))]
+        return [(READ, LED_SETTING.pack(*self.led))]
+
+    def _mode_change(self, command, data):
+        if command == WRITE:
+            if len(data) != MODE.size or data[0] > 1:
+                return [(ERROR | command, bytes([ERROR_DATA]))]
+            self.mode = data[0]
+            return [(WRITE, bytes(data))]
+        return [(READ, MODE.pack(self.mode))]
+
+    def acc_page(self, data_type, page):
+        """
+        加速度メモリの 1 ページ (32 サンプルの x, y, z, 単位 0.1 gal) を返す関数
+        地震のデータは立ち上がった後に減衰する正弦波、振動のデータは小さな正弦波に、乱数のノイズを加える
+        (同じページは常に同じ値)
+        """
+        rnd = random.Random(self.seed * 100003 + data_type * 65537 + page)
+        amplitude, frequency = (3000.0, 2.5) if data_type == 0 else (300.0, 8.0)
+        samples = []
+        for i in range((page - 1) * 32, page * 32):
+            t = i * 0.01
+            envelope = amplitude * (t / 2.0) ** 2 if t < 2.0 else amplitude * math.exp(-(t - 2.0) / 5.0)
+            wave = envelope * math.sin(2 * math.pi * frequency * t)
+            samples.extend((round(wave + rnd.gauss(0, 10)),
+                            round(0.7 * wave * math.cos(2 * math.pi * frequency * t) + rnd.gauss(0, 10)),
+                            round(-9800 + 0.3 * wave + rnd.gauss(0, 10))))
+        return ACC_PAGE_SAMPLES.pack(*samples)
+
+    def respond(self, frame):
+        """
+        コマンドのフレームに対するレスポンスのフレームのリストを返す関数 (障害の発生は含まない)
+        """
+        command = frame[4]
+        address = frame[5] | (frame[6] << 8)
+        data = frame[7:-2]
+        handler = self._handlers.get(address)
+        with self._lock:
+            if command not in (READ, WRITE):
+                responses = [(ERROR | command, bytes([ERROR_COMMAND]))]
+            elif handler is None:
+                responses = [(ERROR | command, bytes([ERROR_ADDRESS]))]
+            else:
+                responses = handler(command, data)
+        return [build_frame(bytes([c, address & 0xFF, address >> 8]) + d) for c, d in responses]
+
+    def _receive(self):
+        while True:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self.decoder.feed(data)
+            for frame in self.decoder:
+                self.commands += 1
+                rnd = self._random
+                if rnd.random() < self.drop_rate:
+                    self.dropped += 1
+                    continue
+                if rnd.random() < self.error_rate:
+                    self.errors += 1
+                    response = [build_frame(bytes([ERROR | frame[4], frame[5], frame[6], ERROR_BUSY]))]
+                else:
+                    response = self.respond(frame)
+                    if response[0][4] & ERROR:
+                        self.errors += 1
+                if rnd.random() < self.crc_rate:
+                    self.corrupted += 1
+                    bad = bytearray(response[-1])
+                    bad[-1] ^= 0xFF
+                    response[-1] = bytes(bad)
+                self.responses += len(response)
+                response = b''.join(response)
+                if rnd.random() < self.noise_rate:
+                    response = rnd.randbytes(rnd.randint(1, 16)) + response
+                due = time.monotonic() + self.delay + rnd.random() * self.jitter
+                self._responses.put((due, response))
+
+    def _send(self):
+        while True:
+            item = self._responses.get()
+            if item is None:
+                return
+            due, response = item
+            time.sleep(max(due - time.monotonic(), 0))
+            size = self.chunk or len(response)
+            try:
+                for i in range(0, len(response), size):
+                    part = response[i:i + size]
+                    if self.baudrate:
+                        time.sleep(len(part) * 10 / self.baudrate)
+                    os.write(self._master, part)
+                    self.bytes_sent += len(part)
+            except OSError:
+                return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delay', type=float, default=5.0, help='応答の遅延 (ミリ秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='応答の遅延に加える乱数の上限 (ミリ秒)')
+    parser.add_argument('--baudrate', type=int, help='レスポンスの送信にかける通信速度 (省略時は待たない)')
+    parser.add_argument('--chunk', type=int, help='レスポンスを分けて送信するバイト数')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='応答しない割合')
+    parser.add_argument('--crc-rate', type=float, default=0.0, help='CRC-16 を誤らせる割合')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='エラーレスポンス (Busy) を返す割合')
+    parser.add_argument('--noise-rate', type=float, default=0.0, help='レスポンスの前に不要なバイトを入れる割合')
+    parser.add_argument('--acc-pages', type=int, default=128, help='加速度メモリのページ数')
+    parser.add_argument('--event-every', type=float, help='この秒数ごとに地震・振動を交互に発生させる')
+    parser.add_argument('--event-duration', type=float, default=5.0, help='地震・振動の継続時間 (秒)')
+    parser.add_argument('--link', help='疑似端末へのシンボリックリンクを作成するパス')
+    parser.add_argument('--seed', type=int, default=0, help='乱数の種')
+    args = parser.parse_args()
+
+    emulator = SensorEmulator(delay=args.delay / 1000, jitter=args.jitter / 1000, baudrate=args.baudrate,
+                              chunk=args.chunk, drop_rate=args.drop_rate, crc_rate=args.crc_rate,
+                              error_rate=args.error_rate, noise_rate=args.noise_rate,
+                              acc_pages=args.acc_pages, seed=args.seed)
+    port = emulator.start(args.link)
+    print('2JCIE-BU emulator:', port, '' if args.link is None else '(' + args.link + ')')
+    print('Press Ctrl+C to stop')
+    try:
+        data_type = 0
+        while True:
+            time.sleep(args.event_every or 10)
+            if args.event_every:
+                print('trigger', 'earthquake' if data_type == 0 else 'vibration')
+                emulator.trigger(data_type, args.event_duration)
+                data_type ^= 1
+            print(f'commands={emulator.commands} responses={emulator.responses} bytes={emulator.bytes_sent}'
+                  f' dropped={emulator.dropped} corrupted={emulator.corrupted} errors={emulator.errors}'
+                  f' bad_commands={emulator.decoder.crc_errors}')
+    except KeyboardInterrupt:
+        emulator.stop()
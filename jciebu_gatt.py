@@ -0,0 +1,526 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_gatt.py: BLE で環境センサに接続し (GATT)、最新データの notification の受信や定期的な読み込みを行うモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_gatt import NotificationCollector
+#   collector = NotificationCollector(['CA:43:F0:B6:24:95', ...], on_record)   # on_record(SensorRecord)
+#   loop = asyncio.new_event_loop()
+#   loop.run_until_complete(collector.run())   # collector.stop() まで受信を続ける
+#
+# advertising packet はアドバタイズの間隔でしか送信されず、受信できないパケットもあるため、
+# 特に必要な環境センサには接続したままにして、最新データ (0x5012, 0x5013) の notification を受信する
+# 2 つの notification はシーケンス番号がそろったときに、advertising packet のデータモード 3 と同じ
+# レコード (ADV_SCHEMAS[3]) にする (CSV などへの出力は advertising packet と同じ形式)
+# 環境センサごとに NotificationSupervisor が接続を監視し、切断された場合や、stall_timeout 秒以上
+# notification を受信しない場合は、待ち時間を倍にしながら接続しなおす
+#
+# GattConnectionPool は、接続したままにする環境センサの数に上限を設けて接続を再利用するクラス
+# (接続とモデル名の確認には 1 台あたり数秒かかるため、定期的に読み込む場合は接続しなおさない)
+# 上限の場合は、使用中でない接続のうち最も長い間使っていないものを切断する (LRU)
+#   pool = GattConnectionPool(max_connections=5)
+#   async with pool.connection(address) as client:
+#       data = await client.read_gatt_char(LATEST_SENSOR_DATA_UUID)
+#   poller = LatestPoller(addresses, on_record, pool, interval=60)   # interval 秒ごとに最新データを読み込む
+#
+
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict
+from struct import Struct
+
+from bleak import BleakClient
+
+from jciebu_record import ADV_SCHEMAS, AdvDeviceState, SensorRecord
+
+def gatt_uuid(short):
+    """
+    2JCIE-BU01 の 16 ビットの UUID (0x5012 など) を 128 ビットの UUID の文字列にする関数
+    """
+    return 'AB70%04X-0A3A-11E8-BA89-0ED5F89F718B' % short
+
+# 2JCIE-BU01 GATT UUIDs
+MODEL_NUMBER_UUID = '00002A24-0000-1000-8000-00805F9B34FB'
+LATEST_SENSOR_DATA_UUID = gatt_uuid(0x5012)
+LATEST_CALC_DATA_UUID = gatt_uuid(0x5013)
+ADVERTISE_SETTING_UUID = gatt_uuid(0x5115)
+MODE_CHANGE_UUID = gatt_uuid(0x5117)
+FLASH_MEMORY_STATUS_UUID = gatt_uuid(0x5403)
+# モデル名 (Model number string)
+MODEL_NUMBER = b'2JCIE-BU01'
+
+# アドバタイズの設定 (0x5115) の advertising interval (先頭の UInt16) の単位 (ミリ秒) と範囲
+# (0x00A0 = 100 ms から 0x4000 = 10240 ms)
+ADV_INTERVAL_UNIT = 0.625
+ADV_INTERVAL_MIN = 0x00A0
+ADV_INTERVAL_MAX = 0x4000
+_ADV_SETTING = Struct('<HB')
+
+# フラッシュメモリの状態 (0x5403): 0x01 書き込み中, 0x02 書き込み完了, 0x03 書き込みエラー, 0x04 消去中
+FLASH_POLL_INTERVAL = 0.5
+FLASH_WRITE_TIMEOUT = 60.0
+
+# 最新データのキャラクタリスティックのレイアウト (advertising packet の先頭のデータモードのないもの)
+# UUID -> (パケットの種類 (データモード 3 の packet type), レイアウト)
+_SENSOR_TYPES = ''.join(ADV_SCHEMAS[1].types)   # シーケンス番号と 7 つのセンサデータ
+_CALC_TYPES = ''.join(ADV_SCHEMAS[2].types)     # シーケンス番号と 9 つの計算データ
+NOTIFY_LAYOUTS = {
+    LATEST_SENSOR_DATA_UUID: (1, Struct('<' + _SENSOR_TYPES)),
+    LATEST_CALC_DATA_UUID: (2, Struct('<' + _CALC_TYPES)),
+}
+
+def unpack_notification(uuid, data):
+    """
+    最新データの notification を (パケットの種類, 値のタプル) に変換する関数 (未知の UUID や短すぎる場合は None)
+    """
+    layout = NOTIFY_LAYOUTS.get(uuid.upper())
+    if layout is None or len(data) < layout[1].size:
+        return None
+    return layout[0], layout[1].unpack_from(data)
+
+def adv_interval_value(interval_ms):
+    """
+    advertising interval (ミリ秒) を 0x5115 に書き込む値 (0.625 ms 単位) に変換する関数 (範囲外の場合は ValueError)
+    """
+    value = round(interval_ms / ADV_INTERVAL_UNIT)
+    if value < ADV_INTERVAL_MIN or value > ADV_INTERVAL_MAX:
+        raise ValueError(f'advertising interval must be {ADV_INTERVAL_MIN * ADV_INTERVAL_UNIT:.0f}'
+                         f' to {ADV_INTERVAL_MAX * ADV_INTERVAL_UNIT:.0f} ms: {interval_ms}')
+    return value
+
+async def wait_flash_write(client, interval=FLASH_POLL_INTERVAL, timeout=FLASH_WRITE_TIMEOUT):
+    """
+    フラッシュメモリへの書き込みの完了を待つ関数 (asyncio.sleep で待つので、他の環境センサの処理を止めない)
+    True: 書き込み完了、False: 書き込みエラーまたはタイムアウト
+    """
+    started = time.monotonic()
+    ret = bytearray([0x01])
+    while ret[0] == 0x01 or ret[0] == 0x04:
+        if time.monotonic() - started > timeout:
+            return False
+        await asyncio.sleep(interval)
+        ret = await client.read_gatt_char(FLASH_MEMORY_STATUS_UUID)
+    return ret[0] != 0x03
+
+async def read_advertise_setting(client):
+    """
+    アドバタイズの設定 (0x5115) を読み込み、(advertising interval (ミリ秒), advertising mode) を返す関数
+    """
+    value, mode = _ADV_SETTING.unpack_from(await client.read_gatt_char(ADVERTISE_SETTING_UUID))
+    return value * ADV_INTERVAL_UNIT, mode
+
+async def write_advertise_setting(client, interval_ms=None, mode=None):
+    """
+    アドバタイズの設定 (0x5115) の advertising interval (ミリ秒) と advertising mode を書き込み、
+    フラッシュメモリへの書き込みの完了を待つ関数 (None の値は変更しない)。書き込めた場合は True を返す
+    """
+    ret = bytearray(await client.read_gatt_char(ADVERTISE_SETTING_UUID))
+    value, current = _ADV_SETTING.unpack_from(ret)
+    _ADV_SETTING.pack_into(ret, 0, value if interval_ms is None else adv_interval_value(interval_ms),
+                           current if mode is None else mode)
+    await client.write_gatt_char(ADVERTISE_SETTING_UUID, ret)
+    return await wait_flash_write(client)
+
+class NotificationSupervisor:
+    """
+    1 台の環境センサに接続し続け、最新データの notification を on_record(SensorRecord) に渡すクラス
+
+    timeout: 接続のタイムアウト (秒)
+    stall_timeout: 接続中にこの秒数の間 notification を受信しない場合は接続しなおす (None の場合は接続しなおさない)
+    restart_delay, max_restart_delay: 切断やエラーの後、接続しなおすまでの待ち時間 (続けて失敗すると倍)
+    """
+
+    def __init__(self, address, on_record, timeout=10.0, stall_timeout=60.0, restart_delay=1.0,
+                 max_restart_delay=30.0):
+        self.address = address
+        self.on_record = on_record
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.state = AdvDeviceState(address.replace(':', ''))
+
+        self.connected = False
+        self.model_checked = False  # モデル名を確認済み (接続しなおすときは確認しない)
+        self.notifications = 0      # 受信した notification の数
+        self.records = 0            # on_record に渡したレコードの数
+        self.lost = 0               # シーケンス番号が飛んだ数 (受信できなかったレコードの数)
+        self.connects = 0           # 接続した回数
+        self.errors = 0             # 接続のエラーの回数
+        self.stalls = 0             # notification を受信しないために接続しなおした回数
+        self._last_seq = None
+        self._last_notify = 0.0
+        self._stopped = False
+        self._disconnected = None
+
+    def _notified(self, characteristic, data):
+        self.notifications += 1
+        self._last_notify = time.monotonic()
+        uuid = characteristic if isinstance(characteristic, str) else characteristic.uuid
+        unpacked = unpack_notification(uuid, data)
+        if unpacked is None:
+            return
+        values = self.state.assemble(3, unpacked[0], unpacked[1])
+        if values is None or not self.state.is_new(3, values[0]):
+            return
+        if self._last_seq is not None:
+            self.lost += (values[0] - self._last_seq - 1) % 256
+        self._last_seq = values[0]
+        self.records += 1
+        self.on_record(SensorRecord(ADV_SCHEMAS[3], values, time.time(), self.state.device))
+
+    def _on_disconnect(self, client):
+        self.connected = False
+        if self._disconnected is not None:
+            self._disconnected.set()
+
+    def stop(self):
+        self._stopped = True
+        if self._disconnected is not None:
+            self._disconnected.set()
+
+    async def _session(self):
+        """
+        1 回接続して notification を受信する関数 (切断、stop()、notification が途絶えるまで)
+        """
+        self._disconnected = asyncio.Event()
+        async with BleakClient(self.address, timeout=self.timeout,
+                               disconnected_callback=self._on_disconnect) as client:
+            if not self.model_checked:
+                model = await client.read_gatt_char(MODEL_NUMBER_UUID)
+                if bytes(model) != MODEL_NUMBER:
+                    raise ValueError(f'{self.address} is not {MODEL_NUMBER.decode()}: {bytes(model)}')
+                self.model_checked = True
+            self.connected = True
+            self.connects += 1
+            self._last_notify = time.monotonic()
+            for uuid in NOTIFY_LAYOUTS:
+                await client.start_notify(uuid, self._notified)
+            while not self._stopped and not self._disconnected.is_set():
+                try:
+                    await asyncio.wait_for(self._disconnected.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+                if self.stall_timeout is not None and time.monotonic() - self._last_notify >= self.stall_timeout:
+                    self.stalls += 1
+                    print(f'{self.address}: no notifications for {self.stall_timeout:.0f} s, reconnecting')
+                    return False
+            if self._stopped and client.is_connected:
+                for uuid in NOTIFY_LAYOUTS:
+                    try:
+                        await client.stop_notify(uuid)
+                    except Exception:
+                        pass
+            return True
+
+    async def run(self):
+        """
+        stop() が呼び出されるまで接続し続ける関数
+        """
+        self._stopped = False
+        delay = self.restart_delay
+        while not self._stopped:
+            connects = self.connects
+            try:
+                await self._session()
+            except ValueError as e:
+                # 2JCIE-BU01 ではない
+                print(e)
+                self.errors += 1
+                return
+            except Exception as e:
+                self.errors += 1
+                print(f'{self.address}: error', repr(e))
+            self.connected = False
+            if self._stopped:
+                break
+            if self.connects > connects:
+                # 接続できた後の切断は、すぐに接続しなおす
+                delay = self.restart_delay
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_restart_delay)
+
+class NotificationCollector:
+    """
+    複数の環境センサに接続し続け、notification のレコードを on_record(SensorRecord) に渡すクラス
+
+    idle: 約 tick 秒ごとに呼び出す関数
+    report_interval: 受信の状態を表示する間隔 (秒, 0 の場合は表示しない)、on_report: 表示の代わりに呼び出す関数
+    その他の引数 (timeout, stall_timeout など) は環境センサごとの NotificationSupervisor に渡す
+    """
+
+    def __init__(self, addresses, on_record, idle=None, tick=0.5, report_interval=60.0, on_report=None, **kwargs):
+        self.idle = idle
+        self.tick = tick
+        self.report_interval = report_interval
+        self.on_report = on_report
+        self.supervisors = [NotificationSupervisor(address, on_record, **kwargs) for address in addresses]
+        self._stopped = False
+        self._report_time = 0.0
+        self._report_records = {}
+
+    def stop(self):
+        self._stopped = True
+        for supervisor in self.supervisors:
+            supervisor.stop()
+
+    def report(self):
+        """
+        前回の表示からの環境センサごとのレコードの数と速さ、取りこぼした数、接続の状態を表示する関数
+        """
+        now = time.monotonic()
+        seconds = now - self._report_time
+        stats = {}
+        for s in self.supervisors:
+            records = s.records - self._report_records.get(s.address, 0)
+            self._report_records[s.address] = s.records
+            stats[s.address] = {'records': records, 'rate': records / seconds if seconds > 0 else 0.0,
+                                'lost': s.lost, 'connected': s.connected, 'connects': s.connects,
+                                'errors': s.errors, 'stalls': s.stalls}
+        self._report_time = now
+        if self.on_report is not None:
+            self.on_report(stats)
+        else:
+            print(f'notify: {sum(1 for s in self.supervisors if s.connected)}/{len(self.supervisors)} connected')
+            for address, s in stats.items():
+                print(f"  {address}: {s['records']} records ({s['rate']:.2f} records/s), lost={s['lost']}"
+                      f" connected={s['connected']} connects={s['connects']} errors={s['errors']}"
+                      f" stalls={s['stalls']}")
+        return stats
+
+    async def run(self):
+        """
+        stop() が呼び出されるまで、すべての環境センサの notification を受信し続ける関数
+        """
+        self._stopped = False
+        self._report_time = time.monotonic()
+        tasks = [asyncio.ensure_future(supervisor.run()) for supervisor in self.supervisors]
+        try:
+            while not self._stopped:
+                await asyncio.sleep(self.tick)
+                if self.idle is not None:
+                    self.idle()
+                if self.report_interval > 0 and time.monotonic() - self._report_time >= self.report_interval:
+                    self.report()
+        finally:
+            for supervisor in self.supervisors:
+                supervisor.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+class GattConnectionPool:
+    """
+    環境センサへの接続 (BleakClient) を再利用するクラス
+
+    max_connections: 接続したままにする環境センサの数の上限 (アダプタが同時に接続できる数以下にする)
+    timeout: 接続のタイムアウト (秒)
+    idle_timeout: close_idle() でこの秒数以上使っていない接続を切断する
+    モデル名 (2JCIE-BU01) の確認は最初の接続のときだけ行い、結果を覚えておく (切断した後も)
+    """
+
+    def __init__(self, max_connections=5, timeout=10.0, idle_timeout=120.0):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._clients = OrderedDict()   # アドレス -> BleakClient (最も長い間使っていないものが先頭)
+        self._used = {}                 # アドレス -> 最後に使った時刻
+        self._locks = {}                # アドレス -> asyncio.Lock (同じ接続は同時に 1 つの処理だけが使う)
+        self._models = {}               # アドレス -> モデル名
+        self._count = 0                 # 接続中と接続しようとしている数
+
+        self.hits = 0           # 接続を再利用した回数
+        self.connects = 0       # 接続した回数
+        self.evicted = 0        # 上限のために切断した回数
+        self.expired = 0        # 使っていないために切断した回数
+        self.model_reads = 0    # モデル名を読み込んだ回数
+
+    def __len__(self):
+        return len(self._clients)
+
+    async def _reserve(self):
+        # 上限の場合は、使用中でない接続のうち最も長い間使っていないものを切断する
+        while self._count >= self.max_connections:
+            victim = next((a for a in self._clients if not self._locks[a].locked()), None)
+            if victim is None:
+                # すべて使用中の場合は空くまで待つ
+                await asyncio.sleep(0.05)
+                continue
+            self.evicted += 1
+            await self._disconnect(victim)
+        self._count += 1
+
+    async def _disconnect(self, address):
+        client = self._clients.pop(address, None)
+        if client is None:
+            return
+        self._count -= 1
+        try:
+            await client.disconnect()
+        except Exception as e:
+            print(f'{address}: disconnect error', repr(e))
+
+    async def _connect(self, address, device=None):
+        await self._reserve()
+        try:
+            client = BleakClient(device if device is not None else address, timeout=self.timeout)
+            await client.connect()
+            self.connects += 1
+            if address not in self._models:
+                self._models[address] = bytes(await client.read_gatt_char(MODEL_NUMBER_UUID))
+                self.model_reads += 1
+        except Exception:
+            self._count -= 1
+            raise
+        if self._models[address] != MODEL_NUMBER:
+            self._count -= 1
+            await client.disconnect()
+            raise ValueError(f'{address} is not {MODEL_NUMBER.decode()}: {self._models[address]}')
+        self._clients[address] = client
+        self._used[address] = time.monotonic()
+        return client
+
+    @contextlib.asynccontextmanager
+    async def connection(self, address, device=None):
+        """
+        address の環境センサに接続した BleakClient を返すコンテキストマネージャ
+        接続したままの場合は再利用し、切断されている場合は接続しなおす
+        device に BleakScanner で見つけた BLEDevice を指定した場合は、接続するときにスキャンしない
+        """
+        lock = self._locks.get(address)
+        if lock is None:
+            lock = self._locks[address] = asyncio.Lock()
+        async with lock:
+            client = self._clients.get(address)
+            if client is not None and client.is_connected:
+                self.hits += 1
+                self._clients.move_to_end(address)
+            else:
+                if client is not None:
+                    await self._disconnect(address)
+                client = await self._connect(address, device)
+            try:
+                yield client
+            except Exception:
+                # 切断された場合は次回接続しなおす
+                if not client.is_connected:
+                    await self._disconnect(address)
+                raise
+            finally:
+                self._used[address] = time.monotonic()
+
+    async def read(self, address, uuid):
+        """
+        address の環境センサのキャラクタリスティックを読み込む関数
+        """
+        async with self.connection(address) as client:
+            return await client.read_gatt_char(uuid)
+
+    async def close_idle(self):
+        """
+        idle_timeout 秒以上使っていない接続を切断する関数 (使った時刻がわからない接続も切断する)
+        """
+        now = time.monotonic()
+        for address in [a for a in self._clients if not self._locks[a].locked() and
+                        (a not in self._used or now - self._used[a] >= self.idle_timeout)]:
+            self.expired += 1
+            await self._disconnect(address)
+
+    async def close(self):
+        """
+        すべての接続を切断する関数
+        """
+        for address in list(self._clients):
+            await self._disconnect(address)
+
+async def read_latest_values(client, retries=2):
+    """
+    最新データ (0x5012, 0x5013) を読み込み、データモード 3 と同じ値のタプルを返す関数
+    2 つの読み込みの間に測定が更新されてシーケンス番号が異なる場合は読み込みなおす (retries 回まで、その後は None)
+    """
+    for i in range(1 + retries):
+        sensor = unpack_notification(LATEST_SENSOR_DATA_UUID, await client.read_gatt_char(LATEST_SENSOR_DATA_UUID))
+        calc = unpack_notification(LATEST_CALC_DATA_UUID, await client.read_gatt_char(LATEST_CALC_DATA_UUID))
+        if sensor is not None and calc is not None and sensor[1][0] == calc[1][0]:
+            return sensor[1] + calc[1][1:]
+    return None
+
+class LatestPoller:
+    """
+    interval 秒ごとに、複数の環境センサの最新データを GattConnectionPool の接続で読み込み、
+    レコード (ADV_SCHEMAS[3]) を on_record(SensorRecord) に渡すクラス
+    (同時に読み込むのは pool.max_connections 台まで。接続したままの環境センサは接続の時間がかからない)
+    環境センサが pool.max_connections 台より多い場合は、max_connections 台ずつのグループに分けて順に読み込み、
+    環境センサの順番を 1 回ごとに逆にする (前回の最後に読み込んだ環境センサは接続したままなので、次の回の最初に再利用する。
+    LRU で同じ順番に読み込むと、すべての読み込みが接続しなおしになる)
+    すべての接続を再利用するには pool.max_connections を環境センサの数以上にする
+    """
+
+    def __init__(self, addresses, on_record, pool, interval=60.0, idle=None, report=True):
+        self.addresses = list(addresses)
+        self.on_record = on_record
+        self.pool = pool
+        self.interval = interval
+        self.idle = idle
+        self.report = report
+        self.rounds = 0         # 読み込んだ回数
+        self.records = 0        # on_record に渡したレコードの数
+        self.errors = 0         # 読み込みに失敗した回数
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def groups(self):
+        """
+        今回の読み込みの環境センサのグループ (pool.max_connections 台ずつ) のリストを返す関数
+        奇数回目は環境センサの順番を逆にする (前回の最後に読み込んだ max_connections 台が最初のグループになる)
+        """
+        size = max(self.pool.max_connections, 1)
+        addresses = self.addresses[::-1] if self.rounds % 2 == 1 else self.addresses
+        return [addresses[i:i + size] for i in range(0, len(addresses), size)]
+
+    async def _poll(self, address):
+        try:
+            async with self.pool.connection(address) as client:
+                values = await read_latest_values(client)
+        except Exception as e:
+            self.errors += 1
+            print(f'{address}: read error', repr(e))
+            return
+        if values is not None:
+            self.records += 1
+            self.on_record(SensorRecord(ADV_SCHEMAS[3], values, time.time(), address.replace(':', '')))
+
+    async def poll_once(self):
+        """
+        すべての環境センサの最新データを 1 回読み込み、かかった秒数を返す関数
+        """
+        started = time.monotonic()
+        connects = self.pool.connects
+        for group in self.groups():
+            await asyncio.gather(*[self._poll(address) for address in group])
+        self.rounds += 1
+        seconds = time.monotonic() - started
+        if self.report:
+            print(f'poll {self.rounds}: {len(self.addresses)} devices in {seconds:.2f} s,'
+                  f' connects={self.pool.connects - connects} reused={self.pool.hits} evicted={self.pool.evicted}'
+                  f' errors={self.errors}')
+        return seconds
+
+    async def run(self):
+        """
+        stop() が呼び出されるまで interval 秒ごとに読み込む関数
+        """
+        self._stopped = False
+        try:
+            while not self._stopped:
+                started = time.monotonic()
+                await self.poll_once()
+                await self.pool.close_idle()
+                while not self._stopped and time.monotonic() - started < self.interval:
+                    await asyncio.sleep(min(0.5, self.interval))
+                    if self.idle is not None:
+                        self.idle()
+        finally:
+            await self.pool.close()
@@ -0,0 +1,335 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_influx.py: センサデータを InfluxDB に保存するモジュール (line protocol, HTTP API v2) #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_influx import InfluxSink
+#   sink = InfluxSink('http://localhost:8086', 'bucket', org='org', token='token')
+#   sink.write(record)      # SensorRecord を 1 点追加 (まとめて送信)
+#   sink.flush()            # 送信待ちの点をすべて送信して完了を待つ (keep_failed=True の場合は失敗すると IOError)
+#   sink.close()            # 残りを送信して終了
+#
+# 追加した点は batch_size 点ごと、または batch_age 秒ごとに 1 つのリクエストにまとめ、gzip で圧縮して送信する
+# 送信は workers 個のスレッドで並行して行い、失敗した場合 (接続エラー、429、5xx) は待ち時間を倍にしながら再送する
+# write は待たない (収集のループを止めない)。送信中のリクエストが workers の 2 倍に達している場合は、
+# keep_failed=True なら保持して次の flush で送信し、それ以外は破棄して on_failure に渡す (dropped に記録)
+# keep_failed=True の場合は、再送しても送信できなかったリクエストを破棄せずに保持し、次の flush でもう一度送信する
+# (スプールの cursor を flush の成功後に進めるため、送信が完了していない点を送り終わったことにしない)
+# 外部のライブラリは使わない (urllib のみ)
+#
+# LocalInfluxServer は受信したリクエストを記録するだけの InfluxDB の代わりの HTTP サーバ (動作確認・ベンチマーク用)
+#
+
+import gzip
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+# 既定の measurement 名
+MEASUREMENT = 'iot_2jciebu'
+
+def _escape_key(text):
+    """
+    measurement, タグのキー・値, フィールドのキーのエスケープ (カンマ、等号、空白)
+    """
+    return text.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def _escape_string(text):
+    """
+    文字列のフィールドの値のエスケープ (ダブルクォート、バックスラッシュ)
+    """
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+class LineEncoder:
+    """
+    SensorRecord を line protocol の 1 行に変換するクラス
+    スキーマごとにフィールドの書式 ('temperature=%r,ambient_light=%di,...') を最初に一度だけ作成する
+    除数が 1 のフィールドは整数 (123i)、それ以外は除数で割った float、bytes は文字列として出力
+    """
+
+    def __init__(self, measurement=MEASUREMENT, tags=None):
+        self.prefix = _escape_key(measurement)
+        for k, v in sorted((tags or {}).items()):
+            self.prefix += ',' + _escape_key(k) + '=' + _escape_key(str(v))
+        self._formats = {}  # スキーマ名 -> (フィールドの書式, 除数, bytes のフィールドがあるか)
+        self._devices = {}  # デバイス名 -> 'measurement,タグ,device=... '
+
+    def _schema_format(self, schema):
+        entry = self._formats.get(schema.name)
+        if entry is None:
+            items = []
+            for k, d, t in zip(schema.fields, schema.scales, schema.types):
+                if t.endswith('s'):
+                    items.append(_escape_key(k) + '=%s')
+                elif d == 1:
+                    items.append(_escape_key(k) + '=%di')
+                else:
+                    items.append(_escape_key(k) + '=%r')
+            has_bytes = any(t.endswith('s') for t in schema.types)
+            entry = self._formats[schema.name] = (','.join(items), schema.scales, has_bytes)
+        return entry
+
+    def encode(self, record):
+        head = self._devices.get(record.device)
+        if head is None:
+            head = self._devices[record.device] = self.prefix + ',device=' + _escape_key(record.device) + ' '
+        fmt, scales, has_bytes = self._schema_format(record.schema)
+        values = [v if d == 1 else v / d for v, d in zip(record.values, scales)]
+        if has_bytes:
+            values = [_escape_string(v.rstrip(b'\x00').decode(errors='replace')) if isinstance(v, bytes) else v
+                      for v in values]
+        return head + fmt % tuple(values) + ' ' + str(round(record.time * 1e9))
+
+class InfluxSink:
+    """
+    SensorRecord を InfluxDB (HTTP API v2 の /api/v2/write) にまとめて送信するクラス
+
+    batch_size: 1 回のリクエストで送る点の数の上限
+    batch_age: 最初の点を追加してからこの秒数が経過したら batch_size に満たなくても送信
+    workers: 並行して送信するリクエストの数
+    retries: 1 つのリクエストの再送回数の上限 (超えた場合は on_failure(body) を呼び出して破棄)
+    送信中のリクエストが workers の 2 倍に達している間に送信するリクエストは、待たずに破棄する (dropped)
+    backoff: 最初の再送までの待ち時間 (秒)、再送ごとに倍 (max_backoff まで)
+    on_failure: 送信できなかったリクエストの本文 (line protocol の bytes) を受け取る関数
+    keep_failed: True の場合は送信できなかったリクエスト (破棄するリクエストも) を on_failure に渡さずに保持し、
+                 flush で再送する
+    """
+
+    def __init__(self, url, bucket, org='', token='', measurement=MEASUREMENT, tags=None,
+                 batch_size=5000, batch_age=1.0, workers=4, retries=5, backoff=0.5, max_backoff=30.0,
+                 timeout=10.0, compresslevel=6, on_failure=None, keep_failed=False):
+        self.write_url = url.rstrip('/') + '/api/v2/write?' + urlencode(
+            {'org': org, 'bucket': bucket, 'precision': 'ns'})
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8', 'Content-Encoding': 'gzip'}
+        if token:
+            self.headers['Authorization'] = 'Token ' + token
+        self.encoder = LineEncoder(measurement, tags)
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.compresslevel = compresslevel
+        self.on_failure = on_failure
+        self.keep_failed = keep_failed
+
+        self._lines = []
+        self._kept = []         # 送信できずに保持しているリクエスト (本文, 点の数) (keep_failed=True の場合)
+        self._first = 0.0       # 送信待ちの最初の点を追加した時刻
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # 送信中のリクエストは workers の 2 倍まで (超える分は write では待たずに保持または破棄、flush では待つ)
+        self._slots = threading.Semaphore(workers * 2)
+        self._futures = set()
+
+        self.points = 0         # 送信に成功した点の数
+        self.batches = 0        # 送信に成功したリクエストの数
+        self.bytes_sent = 0     # 送信した本文のバイト数 (圧縮後)
+        self.retried = 0        # 再送した回数
+        self.failed = 0         # 送信できなかったリクエストの数
+        self.dropped = 0        # 送信中のリクエストが多すぎて破棄したリクエストの数
+        self.deferred = 0       # 同、保持して flush に回したリクエストの数 (keep_failed=True の場合)
+
+    def write(self, record):
+        """
+        SensorRecord を 1 点追加する関数 (batch_size 点または batch_age 秒で送信)
+        送信の完了や空きを待たないので、asyncio のイベントループから呼び出してもよい
+        """
+        self.write_line(self.encoder.encode(record))
+
+    def write_line(self, line):
+        """
+        line protocol の 1 行を追加する関数
+        """
+        with self._lock:
+            if len(self._lines) == 0:
+                self._first = time.monotonic()
+            self._lines.append(line)
+            if len(self._lines) < self.batch_size and time.monotonic() - self._first < self.batch_age:
+                return
+            lines, self._lines = self._lines, []
+        self._submit(lines)
+
+    def flush_due(self):
+        """
+        batch_age 秒以上送信を待っている点を送信する関数 (書き込みがない間も定期的に呼び出す)
+        """
+        with self._lock:
+            if len(self._lines) == 0 or time.monotonic() - self._first < self.batch_age:
+                return
+            lines, self._lines = self._lines, []
+        self._submit(lines)
+
+    def flush(self, wait=True):
+        """
+        送信待ちの点 (keep_failed=True の場合は保持しているリクエストも) をすべて送信する関数
+        wait が True の場合は送信の完了を待ち、keep_failed=True で送信できなかったリクエストがあれば IOError を送出する
+        """
+        with self._lock:
+            lines, self._lines = self._lines, []
+            kept, self._kept = self._kept, []
+        if len(lines) > 0:
+            self._submit(lines, block=wait)
+        for body, points in kept:
+            self._submit_body(body, points, block=wait)
+        if wait:
+            for future in list(self._futures):
+                future.result()
+            with self._lock:
+                failed = len(self._kept)
+            if failed > 0:
+                raise IOError(f'{failed} InfluxDB write requests failed')
+
+    def close(self):
+        try:
+            self.flush()
+        except IOError as e:
+            # スプールから送る場合は cursor を進めていないので、次回の起動時にもう一度送る
+            print('InfluxDB', e)
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, lines, block=False):
+        self._submit_body(('\n'.join(lines) + '\n').encode(), len(lines), block)
+
+    def _submit_body(self, body, points, block=False):
+        """
+        リクエストを送信スレッドに渡す関数
+        送信中のリクエストが多すぎる場合、block が True なら空くまで待ち、False なら保持または破棄する
+        """
+        if not self._slots.acquire(blocking=block):
+            with self._lock:
+                if self.keep_failed:
+                    self.deferred += 1
+                    self._kept.append((body, points))
+                    return
+                self.dropped += 1
+            print('InfluxDB write dropped', f'({points} points, too many requests in flight)')
+            if self.on_failure is not None:
+                self.on_failure(body)
+            return
+        future = self._executor.submit(self._send, body, points)
+        self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._futures.discard(future)
+        self._slots.release()
+
+    def _send(self, body, points):
+        """
+        1 つのリクエストを送信する関数 (送信スレッドで実行)
+        """
+        data = gzip.compress(body, compresslevel=self.compresslevel)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                with urlopen(Request(self.write_url, data=data, headers=self.headers, method='POST'),
+                             timeout=self.timeout) as res:
+                    res.read()
+                with self._lock:
+                    self.points += points
+                    self.batches += 1
+                    self.bytes_sent += len(data)
+                return True
+            except HTTPError as e:
+                if e.code != 429 and e.code < 500:
+                    # 400 (line protocol の誤り)、401 (認証) などは再送しても成功しない
+                    print('InfluxDB write error', e.code, e.read()[:200])
+                    break
+                retry_after = e.headers.get('Retry-After')
+            except (URLError, OSError) as e:
+                print('InfluxDB connection error', e)
+            if attempt < self.retries:
+                with self._lock:
+                    self.retried += 1
+                wait = float(retry_after) if retry_after and retry_after.isdigit() else delay
+                # 複数のスレッドが同時に再送しないように少しずらす
+                time.sleep(wait * (0.5 + random.random() / 2))
+                delay = min(delay * 2, self.max_backoff)
+        with self._lock:
+            self.failed += 1
+            if self.keep_failed:
+                self._kept.append((body, points))
+                return False
+        if self.on_failure is not None:
+            self.on_failure(body)
+        return False
+
+class LocalInfluxServer:
+    """
+    InfluxDB の /api/v2/write の代わりに、受信したリクエストを記録する HTTP サーバ
+    別スレッドで 127.0.0.1 の空いているポートで待ち受け、url に 'http://127.0.0.1:ポート' を返す
+    fail_rate (0 から 1) の割合と最初の fail_first 回のリクエストで status (既定 503) を返し、delay 秒待ってから応答する
+    disconnect を True にした場合は、失敗させるリクエストに応答せずに接続を切る (接続エラーの確認用)
+
+    使い方:
+        server = LocalInfluxServer()
+        sink = InfluxSink(server.url, 'bucket')
+        ...
+        server.lines()      # 受信した line protocol の行のリスト
+        server.close()
+    """
+
+    def __init__(self, fail_rate=0.0, status=503, delay=0.0, seed=0, fail_first=0, disconnect=False):
+        self.fail_rate = fail_rate
+        self.status = status
+        self.delay = delay
+        self.fail_first = fail_first
+        self.disconnect = disconnect
+        self.batches = []       # 受信したリクエストの本文 (gzip を展開した bytes)
+        self.requests = 0       # 受信したリクエストの数 (失敗させたものを含む)
+        self.compressed = 0     # Content-Encoding: gzip のリクエストの数
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                gzipped = self.headers.get('Content-Encoding') == 'gzip'
+                if gzipped:
+                    body = gzip.decompress(body)
+                if server.delay > 0:
+                    time.sleep(server.delay)
+                with server._lock:
+                    server.requests += 1
+                    server.compressed += gzipped
+                    fail = server.requests <= server.fail_first or server._random.random() < server.fail_rate
+                    if not fail and self.path.startswith('/api/v2/write'):
+                        server.batches.append(body)
+                if fail and server.disconnect:
+                    self.close_connection = True
+                    return
+                if fail:
+                    self.send_response(server.status)
+                elif self.path.startswith('/api/v2/write'):
+                    self.send_response(204)
+                else:
+                    self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def lines(self):
+        with self._lock:
+            return [line for body in self.batches for line in body.decode().splitlines()]
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,192 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_partition.py: 出力ファイルを日ごと・時間ごとのファイル (パーティション) に分けるモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_partition import PartitionCatalog, partition_path
+#   partition_path('csv_files/CA43F0B62495.csv', time.time(), 'daily')  # -> csv_files/CA43F0B62495_20240504.csv
+#   catalog = PartitionCatalog('csv_files')
+#   catalog.select(start, end)      # 指定した期間のデータを含むパーティションのファイル名のリスト
+#
+# パーティションごとに、デバイスごとの最初と最後の時刻 (UNIX 時間) と行数をフォルダのカタログ (catalog.json) に記録し、
+# 期間を指定した読み込みでは、その期間と重なるパーティションのファイルだけを開く
+# カタログのファイルは全体を書き直すため、保存は新しいパーティション (デバイス) の追加、パーティションの切り替え、
+# 終了時、または CATALOG_SAVE_INTERVAL 秒ごと (save_due) に限る (SD カードへの書き込みを増やさない)
+#
+
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+# パーティションの単位と、ファイル名に付ける日時の書式 (ローカル時刻)
+PARTITION_FORMATS = {'daily': '%Y%m%d', 'hourly': '%Y%m%d%H'}
+# カタログのファイル名
+CATALOG_FILE = 'catalog.json'
+# save_due でカタログを保存する最小の間隔 (秒)
+CATALOG_SAVE_INTERVAL = 60.0
+
+def partition_path(_file, _time, partition):
+    """
+    出力ファイル名 _file に、時刻 _time (UNIX 時間) のパーティションの日時を付けたファイル名を返す関数
+    partition が None の場合は _file をそのまま返す
+    """
+    if partition is None:
+        return _file
+    head, ext = os.path.splitext(_file)
+    return head + '_' + datetime.fromtimestamp(_time).strftime(PARTITION_FORMATS[partition]) + ext
+
+def parse_datetime(text, end=False):
+    """
+    'YYYY-MM-DD', 'YYYY-MM-DD HH:MM', 'YYYY-MM-DD HH:MM:SS' (ローカル時刻) を datetime に変換する関数
+    end を True にした場合 (期間の終わり) は、日付だけの指定をその日の終わり (23:59:59.999999) とする
+    None の場合は None を返す
+    """
+    if text is None:
+        return None
+    value = datetime.fromisoformat(text)
+    if end and len(text.strip()) == 10:
+        value += timedelta(days=1, microseconds=-1)
+    return value
+
+def parse_time(text, end=False):
+    """
+    parse_datetime の結果を UNIX 時間に変換する関数 (None の場合は None を返す)
+    """
+    value = parse_datetime(text, end)
+    return None if value is None else value.timestamp()
+
+class PartitionCatalog:
+    """
+    フォルダ内のパーティションのカタログ
+    {ファイル名: {デバイス: [最初の時刻, 最後の時刻, 行数]}} を folder/catalog.json に保存する
+    同じフォルダに複数のプログラムが書き込む場合に備えて、保存時はファイルの内容に自分の更新分を上書きする
+    """
+
+    def __init__(self, folder, save_interval=CATALOG_SAVE_INTERVAL):
+        self.folder = folder
+        self.path = os.path.join(folder, CATALOG_FILE)
+        self.save_interval = save_interval
+        self.partitions = self._load()
+        self._dirty = set()     # 保存していない更新があるパーティション
+        self._saved = time.monotonic()  # 前回保存した時刻
+        self.saves = 0          # 保存した回数
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def add(self, _file, device, first, last=None, rows=1):
+        """
+        パーティション _file にデバイス device の時刻 first から last まで (省略時は first) の行を
+        rows 行書き込んだことを記録する関数
+        """
+        if last is None:
+            last = first
+        name = os.path.basename(_file)
+        entry = self.partitions.setdefault(name, {}).get(device)
+        if entry is None:
+            self.partitions[name][device] = [first, last, rows]
+            self._dirty.add(name)
+            # 新しいパーティション (またはデバイス) はすぐに保存する
+            # (異常終了した場合にも、期間を指定した読み込みでファイルが見つかるようにする)
+            self.save()
+            return
+        entry[0] = min(entry[0], first)
+        entry[1] = max(entry[1], last)
+        entry[2] += rows
+        self._dirty.add(name)
+
+    def save_due(self):
+        """
+        前回の保存から save_interval 秒以上経過している場合だけ保存する関数 (行を書き出すたびに呼び出す)
+        """
+        if len(self._dirty) > 0 and time.monotonic() - self._saved >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """
+        更新したパーティションをカタログのファイルに保存する関数 (一時ファイルに書いてから置き換え)
+        """
+        if len(self._dirty) == 0:
+            return
+        partitions = self._load()
+        for name in self._dirty:
+            partitions[name] = self.partitions[name]
+        self.partitions = partitions
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(partitions, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        self._dirty = set()
+        self._saved = time.monotonic()
+        self.saves += 1
+
+    def select(self, start=None, end=None, device=None, ext=None):
+        """
+        start から end まで (UNIX 時間、None の場合は制限なし) のデータを含むパーティションのファイル名のリストを返す関数
+        device を指定した場合はそのデバイスのデータを含むパーティション、ext を指定した場合はその拡張子のファイルだけ
+        """
+        files = []
+        for name, devices in sorted(self.partitions.items()):
+            if ext is not None and not name.endswith(ext):
+                continue
+            for dev, (first, last, rows) in devices.items():
+                if device is not None and dev != device:
+                    continue
+                if (start is None or last >= start) and (end is None or first <= end):
+                    files.append(os.path.join(self.folder, name))
+                    break
+        return files
+
+def read_dataframe(path, start=None, end=None, device=None):
+    """
+    CSVファイル、セグメントファイル (.jbl)、またはカタログのあるフォルダから、pandas の DataFrame を読み込む関数
+    フォルダの場合は start から end まで (ローカル時刻の文字列) と重なるパーティションだけを読み込んでつなげる
+    end に日付だけを指定した場合は、その日の終わりまでを含む
+    CSVファイルで期間を指定しない場合は、従来と同じく pd.read_csv(path, index_col=0) で読み込む
+    21_csv2stat.py, 22_csv2graph.py で使用
+    """
+    import pandas as pd     # 収集プログラムでは使わないので、ここで読み込む
+    from jciebu_binlog import SEGMENT_EXT, segment_dataframe
+
+    if not os.path.isdir(path) and not path.endswith(SEGMENT_EXT) and start is None and end is None:
+        # 1 つのCSVファイル全体 (日時の変換と並べ替えをしない)
+        return _select_device(pd.read_csv(path, index_col=0), device)
+
+    if os.path.isdir(path):
+        files = PartitionCatalog(path).select(parse_time(start), parse_time(end, end=True), device)
+    else:
+        files = [path]
+    start = parse_datetime(start)
+    end = parse_datetime(end, end=True)
+
+    frames = []
+    for _file in files:
+        if _file.endswith(SEGMENT_EXT):
+            df = segment_dataframe(_file)
+        else:
+            df = pd.read_csv(_file, index_col=0, parse_dates=[0])
+        frames.append(_select_device(df, device))
+    if len(frames) == 0:
+        return pd.DataFrame()
+    df = pd.concat(frames).sort_index()
+    # 期間の外の行を除く (インデックスはローカル時刻)
+    if start is not None:
+        df = df[df.index >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df.index <= pd.Timestamp(end)]
+    return df
+
+def _select_device(df, device):
+    """
+    DataFrame からデバイス device の行だけを選ぶ関数 (None の場合はそのまま返す)
+    advertising packet は device 列、最新データ(0x5021) は port 列
+    """
+    if device is not None:
+        for column in ('device', 'port'):
+            if column in df.columns:
+                df = df[df[column] == device]
+    return df
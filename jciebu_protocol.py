@@ -0,0 +1,240 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) USB シリアル通信 共通モジュール
+#
+# jciebu_protocol.py: コマンドフレームの生成、CRC-16 の計算・検証を行うモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_protocol import calc_crc, build_frame, verify_crc, decode_latest_data
+#
+# フレーム形式 (リトルエンディアン)
+#   [0x52 0x42][Length(2byte)][Payload ...][CRC-16(2byte)]
+#   Length は Payload と CRC-16 を合わせたバイト数
+#
+
+from struct import Struct, pack
+
+# フレームのヘッダ
+HEADER = b'\x52\x42'
+# ヘッダ + Length のバイト数
+HEADER_LEN = 4
+# CRC-16 のバイト数
+CRC_LEN = 2
+# 加速度データ(0x503F) の 1 ページ (1 フレーム) のバイト数
+ACC_PAGE_SIZE = 237
+
+# 最新データ(0x5021)のレスポンスのフィールド (ret[7] から ret[55] まで、リトルエンディアン)
+LATEST_DATA_FIELDS = ('sequence_number',
+                      'temperature', 'relative_humidity', 'ambient_light',
+                      'barometric_pressure', 'sound_noise', 'eTVOC', 'eCO2',
+                      'discomfort_index', 'heat_stroke', 'vibration_information',
+                      'si_value', 'pga', 'seismic_intensity',
+                      'temperature_flag', 'relative_humidity_flag', 'ambient_light_flag',
+                      'barometric_pressure_flag', 'sound_noise_flag', 'eTVOC_flag', 'eCO2_flag',
+                      'discomfort_index_flag', 'heat_stroke_flag',
+                      'si_value_flag', 'pga_flag', 'seismic_intensity_flag')
+# 各フィールドの型 (UInt8: B, SInt16: h, UInt16: H, UInt32: L)
+LATEST_DATA_FORMAT = '<B' + 'hHHLHHHHhBHHH' + 'HHHHHHHHH' + 'BBB'
+# 各フィールドを実際の値にするための除数 (1 のフィールドは整数のまま)
+LATEST_DATA_SCALE = (1,
+                     100, 100, 1, 1000, 100, 1, 1, 100, 100, 1, 10, 10, 1000,
+                     1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1)
+# レスポンスのフレーム全体 (ヘッダ・Length・コマンド・アドレスの 7 バイトと CRC-16 は読み飛ばす)
+LATEST_DATA = Struct('<7x' + LATEST_DATA_FORMAT[1:] + '2x')
+
+def _make_crc_table():
+    """
+    CRC-16 (多項式 0xA001) の 256 エントリのテーブルを作成する関数
+    """
+    table = []
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc = crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+# モジュール読み込み時に一度だけ計算
+CRC_TABLE = _make_crc_table()
+
+def crc16(buf):
+    """
+    CRC-16 を整数で返す関数
+    buf には bytes / bytearray / memoryview を指定できる
+    memoryview のスライスを渡せばコピーせずに計算する
+    """
+    crc = 0xFFFF
+    table = CRC_TABLE
+    for b in buf:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+def calc_crc(buf, length=None):
+    """
+    CRC-16 を計算する関数
+    従来の calc_crc(buf, length) と同じく [下位, 上位] の bytearray を返す
+    """
+    if length is not None and length != len(buf):
+        buf = memoryview(buf)[:length]
+    crc = crc16(buf)
+    return bytearray([crc & 0x00FF, crc >> 8])
+
+def build_frame(_payload):
+    """
+    _payload の前にヘッダと長さを付加、後に CRC-16 を付加したフレームを返す関数
+    """
+    _command = bytearray(HEADER)
+    _command += pack('<H', len(_payload) + CRC_LEN)
+    _command += _payload
+    crc = crc16(_command)
+    _command.append(crc & 0x00FF)
+    _command.append(crc >> 8)
+    return bytes(_command)
+
+def frame_length(buf):
+    """
+    ヘッダの Length からフレーム全体のバイト数を返す関数
+    """
+    return HEADER_LEN + (buf[2] | (buf[3] << 8))
+
+def verify_crc(frame):
+    """
+    受信したフレームの末尾 2 バイトの CRC-16 を検証する関数
+    フレーム全体 (ヘッダから CRC まで) を指定し、一致すれば True を返す
+    """
+    if len(frame) < HEADER_LEN + CRC_LEN:
+        return False
+    _mv = memoryview(frame)
+    crc = crc16(_mv[:-CRC_LEN])
+    return _mv[-2] == (crc & 0x00FF) and _mv[-1] == (crc >> 8)
+
+class FrameDecoder:
+    """
+    シリアルポートから受信したバイト列からフレームを切り出すクラス
+    受信データを bytearray に追記し、ヘッダ(0x52 0x42)の検索、Length の読み込み、
+    CRC-16 の検証を行って、完全なフレームを memoryview で (コピーせずに) 返す
+
+    使い方:
+        decoder = FrameDecoder()
+        decoder.feed(ser.read(n))
+        for frame in decoder:
+            ...
+
+    返した memoryview は次の feed 以降も有効 (参照中のバッファは置き換えて残す)
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0           # 未処理データの先頭位置
+        self.crc_errors = 0     # CRC-16 が一致しなかったフレーム数
+        self.skipped_bytes = 0  # ヘッダを探す途中で読み捨てたバイト数
+
+    def feed(self, data):
+        """
+        受信したバイト列をバッファに追加する関数
+        """
+        if self._pos > 0:
+            # 処理済みの部分を取り除く
+            try:
+                del self._buf[:self._pos]
+            except BufferError:
+                # 返したフレームの memoryview が残っている場合は新しいバッファに移す
+                self._buf = self._buf[self._pos:]
+            self._pos = 0
+        try:
+            self._buf += data
+        except BufferError:
+            self._buf = self._buf + data
+
+    def pending(self):
+        """
+        バッファに残っている未処理のバイト数を返す関数
+        """
+        return len(self._buf) - self._pos
+
+    def needed(self):
+        """
+        次のフレームを完成させるために必要な残りのバイト数を返す関数
+        ヘッダ(4バイト)が未受信ならヘッダの残り、受信済みなら Length から計算した残り
+        next_frame が None を返した後に呼び出す
+        """
+        rest = self.pending()
+        if rest < HEADER_LEN:
+            return HEADER_LEN - rest
+        buf = self._buf
+        length = buf[self._pos + 2] | (buf[self._pos + 3] << 8)
+        return max(HEADER_LEN + length - rest, 1)
+
+    def next_frame(self):
+        """
+        次の完全なフレームを memoryview で返す関数
+        フレームがそろっていない場合は None を返す
+        """
+        buf = self._buf
+        if self._pos == 0 and len(buf) > HEADER_LEN + CRC_LEN and buf.startswith(HEADER) \
+                and len(buf) == HEADER_LEN + (buf[2] | (buf[3] << 8)) and verify_crc(buf):
+            # バッファがちょうど 1 つの完全なフレームの場合 (1 回のコマンドのレスポンス) は、
+            # ヘッダの検索とスライスをせずにバッファ全体を返す
+            self._pos = len(buf)
+            return memoryview(buf)
+        while True:
+            start = buf.find(HEADER, self._pos)
+            if start < 0:
+                # 末尾の 0x52 はヘッダの先頭の可能性があるので残す
+                keep = 1 if len(buf) > self._pos and buf.endswith(HEADER[:1]) else 0
+                self.skipped_bytes += len(buf) - self._pos - keep
+                self._pos = len(buf) - keep
+                return None
+            self.skipped_bytes += start - self._pos
+            self._pos = start
+            if len(buf) - start < HEADER_LEN:
+                return None
+            length = buf[start + 2] | (buf[start + 3] << 8)
+            if length <= CRC_LEN:
+                # Length が不正なのでヘッダの次から探し直す
+                self._pos = start + 1
+                continue
+            end = start + HEADER_LEN + length
+            if len(buf) < end:
+                return None
+            frame = memoryview(buf)[start:end]
+            if not verify_crc(frame):
+                frame.release()
+                self.crc_errors += 1
+                self._pos = start + 1
+                continue
+            self._pos = end
+            return frame
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+def unpack_latest_data(frame):
+    """
+    最新データ(0x5021)のレスポンスのフレームを、変換前の整数のタプルに変換する関数
+    順番は LATEST_DATA_FIELDS と同じ (memoryview のままコピーせずに変換)
+    """
+    return LATEST_DATA.unpack_from(frame)
+
+def decode_latest_data(frame):
+    """
+    最新データ(0x5021)のレスポンスのフレームを、フィールド名と値の辞書に変換する関数
+    測定値は単位を合わせた float (照度、eTVOC、eCO2 などの整数のフィールドは int)、フラグは int
+    """
+    return {k: (v if d == 1 else v / d)
+            for k, v, d in zip(LATEST_DATA_FIELDS, LATEST_DATA.unpack_from(frame), LATEST_DATA_SCALE)}
+
+def unpack_latest_data_batch(frames):
+    """
+    最新データ(0x5021)のレスポンスのフレームをまとめて変換する関数
+    frames にはフレームを続けて並べたバッファ (bytes / bytearray / memoryview) またはフレームのリストを指定
+    変換前の整数のタプルのリストを返す
+    """
+    if isinstance(frames, (list, tuple)):
+        frames = b''.join(frames)
+    return list(LATEST_DATA.iter_unpack(frames))
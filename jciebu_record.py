@@ -0,0 +1,359 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_record.py: USB (シリアル通信) と BLE (advertising packet) で受信したデータを格納するレコード型 #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_record import LATEST_DATA_SCHEMA, ADV_SCHEMAS, SensorRecord
+#
+# advertising packet は unpack_adv で整数のタプルにし、環境センサごとの状態 (AdvDeviceTable) で
+# データモード 3, 4 の 2 つのパケットの組み立てと、同じシーケンス番号のレコードの確認を行う
+#   mode, part, values = unpack_adv(data)
+#   state = table.get(address) or table.add(address)
+#   values = state.assemble(mode, part, values)     # そろっていない場合は None
+#
+# レコードには、受信したままの整数 (温度なら 0.01 度単位の値) をタプルで格納し、
+# float や文字列への変換は CSV などに出力するときにだけ行う
+# (辞書や文字列で保持するよりも、1 行あたりのメモリと変換の処理時間が少ない)
+#
+
+import ast
+import csv
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import partial
+from itertools import repeat
+from operator import itemgetter
+from struct import Struct
+
+from jciebu_protocol import LATEST_DATA_FIELDS, LATEST_DATA_FORMAT, LATEST_DATA_SCALE
+
+def _parse_bytes(text):
+    """
+    format で出力した bytes の文字列 (b'...') を bytes に戻す関数
+    """
+    return ast.literal_eval(text) if text.startswith(("b'", 'b"')) else text.encode()
+
+def _field_parser(scale, fmt, _type):
+    """
+    フィールドの文字列を整数 (bytes) に戻す関数を返す関数 (format の逆変換)
+    """
+    if _type.endswith('s'):
+        return _parse_bytes
+    if scale != 1:
+        return lambda text: round(float(text) * scale)
+    # 書式を指定したフィールド (フラグの '#018b' など) は 0b などの接頭辞付き
+    return int if fmt is None else partial(int, base=0)
+
+def adv_csv_timestamp(_time):
+    """
+    ble_2jcie-bu_adv2csv.py の CSV の timestamp 列の値を、受信時刻 _time (UNIX 時間) から求める関数
+    これまでの datetime.utcnow().timestamp() と同じく、UTC の日時をローカル時刻とみなして変換した値
+    (UTC 以外のタイムゾーンでは実際の UNIX 時間とずれるが、既存の CSV ファイルと列の値をそろえる)
+    """
+    return datetime.fromtimestamp(_time, timezone.utc).replace(tzinfo=None).timestamp()
+
+class RecordSchema:
+    """
+    レコードのフィールド名と、各フィールドを実際の値にするための除数、出力形式をまとめたクラス
+    formats にはフィールドごとの format() の書式 (None の場合は str()) を指定
+    types にはフィールドごとの struct の型 (B: UInt8, h: SInt16, H: UInt16, L: UInt32, 10s: 10 バイトの bytes など)
+    """
+    __slots__ = ('name', 'mode', 'fields', 'scales', 'formats', 'types', '_index', '_parsers')
+
+    def __init__(self, name, fields, scales, types, formats=None, mode=0):
+        self.name = name
+        self.mode = mode
+        self.fields = tuple(fields)
+        self.scales = tuple(scales)
+        self.types = tuple(types)
+        self.formats = tuple(formats) if formats is not None else (None,) * len(self.fields)
+        self._index = {k: i for i, k in enumerate(self.fields)}
+        # parse で使うフィールドごとの変換 (スキーマを作るときに一度だけ決める)
+        self._parsers = tuple(_field_parser(d, f, t) for d, f, t in zip(self.scales, self.formats, self.types))
+
+    def index(self, field):
+        return self._index[field]
+
+    def scale(self, values):
+        """
+        整数のタプルを実際の値 (除数が 1 のフィールドはそのまま) のリストに変換する関数
+        """
+        return [v if d == 1 else v / d for v, d in zip(values, self.scales)]
+
+    def format(self, values):
+        """
+        整数のタプルを CSV に出力する文字列のリストに変換する関数
+        """
+        return [str(v if d == 1 else v / d) if f is None else format(v, f)
+                for v, d, f in zip(values, self.scales, self.formats)]
+
+    def parse(self, texts):
+        """
+        CSV の文字列のリストを整数のタプルに戻す関数 (format の逆変換)
+        """
+        return tuple([p(t) for p, t in zip(self._parsers, texts)])
+
+    def parse_columns(self, columns):
+        """
+        フィールドごとの文字列の列 (CSV の列) をまとめて変換し、行ごとの整数のタプルのリストを返す関数
+        除数のあるフィールドは同じ文字列が繰り返し現れることが多いので、異なる文字列が少ない列は
+        1 回ずつ変換して表引きする (気圧のように値がばらつく列はそのまま変換)
+        (保存済みのCSVファイルの読み込み用。parse を行ごとに呼び出すよりも速い)
+        """
+        values = []
+        for column, d, p in zip(columns, self.scales, self._parsers):
+            if d != 1:
+                texts = set(column)
+                if len(texts) * 4 < len(column):
+                    table = {t: p(t) for t in texts}
+                    values.append(map(table.__getitem__, column))
+                    continue
+            values.append(map(p, column))
+        return list(zip(*values))
+
+class SensorRecord:
+    """
+    1 回の受信データを格納するレコード
+    schema: RecordSchema, values: 受信したままの整数のタプル,
+    time: 受信時刻 (UNIX 時間), device: シリアルポート名または BLE のアドレス
+    """
+    __slots__ = ('schema', 'values', 'time', 'device')
+
+    def __init__(self, schema, values, time=0.0, device=''):
+        self.schema = schema
+        self.values = values
+        self.time = time
+        self.device = device
+
+    def __getitem__(self, field):
+        """
+        フィールドの実際の値を返す (record['temperature'] など)
+        """
+        i = self.schema.index(field)
+        d = self.schema.scales[i]
+        return self.values[i] if d == 1 else self.values[i] / d
+
+    def raw(self, field):
+        """
+        フィールドの受信したままの整数を返す
+        """
+        return self.values[self.schema.index(field)]
+
+    def as_dict(self):
+        return dict(zip(self.schema.fields, self.schema.scale(self.values)))
+
+    def csv_values(self):
+        return self.schema.format(self.values)
+
+    def __repr__(self):
+        return f'SensorRecord({self.schema.name}, {self.device}, {self.time}, {self.values})'
+
+# 最新データ(0x5021) (USB)
+LATEST_DATA_SCHEMA = RecordSchema('latest', LATEST_DATA_FIELDS, LATEST_DATA_SCALE, LATEST_DATA_FORMAT[1:])
+
+# advertising packet のデータモードごとのフィールド (BLE)
+# フィールド名は ble_2jcie-bu_adv2csv.py がこれまで出力してきた CSV のヘッダーと同じ
+_ADV_SENSOR_FIELDS = ('temparature', 'relative_humidity', 'ambient_light', 'barometric_pressure',
+                      'sound_noise', 'eTVOC', 'eCO2')
+_ADV_SENSOR_SCALES = (100, 100, 1, 1000, 100, 1, 1)
+_ADV_SENSOR_TYPES = ('h', 'H', 'H', 'L', 'H', 'H', 'H')
+_ADV_CALC_FIELDS = ('discomfort_index', 'heat_stroke', 'vibration_inform', 'SI_value', 'PGA',
+                    'Seismic_intensity', 'acceleration_x', 'acceleration_y', 'acceleration_z')
+_ADV_CALC_SCALES = (100, 100, 1, 10, 10, 1000, 10, 10, 10)
+_ADV_CALC_TYPES = ('H', 'h', 'B', 'H', 'H', 'H', 'h', 'h', 'h')
+_ADV_FLAG_FIELDS = ('temperature_flag', 'relative_humidity_flag', 'ambient_light_flag',
+                    'barometric_pressure_flag', 'sound_noise_flag', 'etvoc_flag', 'eco2_flag',
+                    'discomfort_index_flag', 'heat_stroke_flag',
+                    'si_value_flag', 'pga_flag', 'seismic_intensity_flag')
+_ADV_FLAG_FORMATS = ('#018b',) * 9 + ('#010b',) * 3
+_ADV_FLAG_TYPES = ('H',) * 9 + ('B',) * 3
+
+ADV_SCHEMAS = {
+    1: RecordSchema('adv1', ('sequence_number',) + _ADV_SENSOR_FIELDS,
+                    (1,) + _ADV_SENSOR_SCALES, ('B',) + _ADV_SENSOR_TYPES, mode=1),
+    2: RecordSchema('adv2', ('sequence_number',) + _ADV_CALC_FIELDS,
+                    (1,) + _ADV_CALC_SCALES, ('B',) + _ADV_CALC_TYPES, mode=2),
+    3: RecordSchema('adv3', ('sequence_number',) + _ADV_SENSOR_FIELDS + _ADV_CALC_FIELDS,
+                    (1,) + _ADV_SENSOR_SCALES + _ADV_CALC_SCALES,
+                    ('B',) + _ADV_SENSOR_TYPES + _ADV_CALC_TYPES, mode=3),
+    4: RecordSchema('adv4', ('sequence_number',) + _ADV_FLAG_FIELDS,
+                    (1,) * 13, ('B',) + _ADV_FLAG_TYPES, (None,) + _ADV_FLAG_FORMATS, mode=4),
+    5: RecordSchema('adv5', ('serial_number', 'memory_index_latest'), (1, 1), ('10s', 'L'), mode=5),
+}
+
+# スキーマ名 -> RecordSchema
+SCHEMAS = {schema.name: schema for schema in [LATEST_DATA_SCHEMA] + list(ADV_SCHEMAS.values())}
+
+# advertising packet (manufacturer_data[0x02D5]) のレイアウト
+# 先頭の 1 バイトはデータモード (x で読み飛ばす)、続く B がシーケンス番号
+ADV_SENSOR_PACKET = Struct('<xB' + ''.join(_ADV_SENSOR_TYPES))   # mode 1, mode 3 packet type 1
+ADV_CALC_PACKET = Struct('<xB' + ''.join(_ADV_CALC_TYPES))       # mode 2, mode 3 packet type 2
+ADV_FLAG_PACKET1 = Struct('<xB' + ''.join(_ADV_FLAG_TYPES[:7]))  # mode 4 packet type 1
+ADV_FLAG_PACKET2 = Struct('<xB' + ''.join(_ADV_FLAG_TYPES[7:]))  # mode 4 packet type 2
+ADV_SERIAL_PACKET = Struct('<x10sL')                              # mode 5
+
+# (データモード, パケットの長さ) -> (パケットの種類, レイアウト)
+# データモード 3, 4 は 19 バイト (packet type 1) と 27 バイト (packet type 2) の 2 つのパケットに分けて送られる
+# 1 つのパケットで送られるデータモード 1, 2, 5 は長さを None、パケットの種類を 0 とする
+ADV_LAYOUTS = {
+    (1, None): (0, ADV_SENSOR_PACKET),
+    (2, None): (0, ADV_CALC_PACKET),
+    (3, 19): (1, ADV_SENSOR_PACKET),
+    (3, 27): (2, ADV_CALC_PACKET),
+    (4, 19): (1, ADV_FLAG_PACKET1),
+    (4, 27): (2, ADV_FLAG_PACKET2),
+    (5, None): (0, ADV_SERIAL_PACKET),
+}
+
+def unpack_adv(data):
+    """
+    manufacturer_data[0x02D5] を、データモードとパケットの長さのレイアウトで整数のタプルに変換する関数
+    (データモード, パケットの種類, 値のタプル) を返す (フラグも整数のまま。未知のデータモードや長さ、短すぎる場合は None)
+    """
+    mode = data[0]
+    layout = ADV_LAYOUTS.get((mode, None)) or ADV_LAYOUTS.get((mode, len(data)))
+    if layout is None or len(data) < layout[1].size:
+        return None
+    return mode, layout[0], layout[1].unpack_from(data)
+
+class AdvDeviceState:
+    """
+    advertising packet を送信する環境センサ 1 台ごとの状態
+    (データモード 3, 4 の packet type 1, 2 の組み立てと、最後に出力したレコードのデータモード・シーケンス番号)
+    """
+    __slots__ = ('device', 'mode', 'parts', 'last_mode', 'last_seq', 'last_record_time')
+
+    def __init__(self, device):
+        self.device = device                # デバイス名 (':' を除いたアドレス)
+        self.mode = 0                       # parts に格納した値のデータモード
+        self.parts = [None, None, None]     # packet type 1, 2 の値 (添字はパケットの種類)
+        self.last_mode = 0                  # 最後に出力したレコードのデータモード
+        self.last_seq = None                # 同、シーケンス番号
+        self.last_record_time = None        # 同、受信時刻
+
+    def assemble(self, mode, part, values):
+        """
+        unpack_adv の結果からレコードの値を返す関数
+        データモード 3, 4 は packet type 1, 2 のシーケンス番号がそろうまで None を返す
+        """
+        if part == 0:
+            return values
+        if mode != self.mode:
+            self.mode = mode
+            self.parts[1] = self.parts[2] = None
+        self.parts[part] = values
+        type1, type2 = self.parts[1], self.parts[2]
+        if type1 is not None and type2 is not None and type1[0] == type2[0]:
+            return type1 + type2[1:]
+        return None
+
+    def is_new(self, mode, seq):
+        """
+        前回出力したレコードとデータモードまたはシーケンス番号が異なる場合に True を返し、記録する関数
+        """
+        if mode == self.last_mode and seq == self.last_seq:
+            return False
+        self.last_mode = mode
+        self.last_seq = seq
+        return True
+
+class AdvDeviceTable:
+    """
+    アドレス -> AdvDeviceState の表
+    maxsize を超えた場合は、最も長い間パケットを受信していない環境センサの状態を削除する (evicted に記録)
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.added = 0          # 追加した環境センサの数
+        self.evicted = 0        # 上限を超えて削除した数
+        self._states = OrderedDict()
+
+    def get(self, address):
+        """
+        アドレスの状態を返す関数 (ない場合は None)
+        """
+        state = self._states.get(address)
+        if state is not None:
+            self._states.move_to_end(address)
+        return state
+
+    def add(self, address):
+        """
+        アドレスの状態を追加して返す関数
+        """
+        state = self._states[address] = AdvDeviceState(address.replace(':', ''))
+        self.added += 1
+        if len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+            self.evicted += 1
+        return state
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, address):
+        return address in self._states
+
+_RECORD_HEAD = Struct('<dBB')
+_record_structs = {}
+
+def pack_record(record):
+    """
+    SensorRecord を bytes に変換する関数 (jciebu_spool.py などでファイルに保存するため)
+    [time (Double)][スキーマ名の長さ][デバイス名の長さ][スキーマ名][デバイス名][各フィールド (schema.types)]
+    """
+    schema = record.schema
+    row = _record_structs.get(schema.name)
+    if row is None:
+        row = _record_structs[schema.name] = Struct('<' + ''.join(schema.types))
+    name = schema.name.encode()
+    device = record.device.encode()
+    return _RECORD_HEAD.pack(record.time, len(name), len(device)) + name + device + row.pack(*record.values)
+
+def unpack_record(data):
+    """
+    pack_record で変換した bytes を SensorRecord に戻す関数 (スキーマは SCHEMAS から名前で探す)
+    """
+    t, name_len, device_len = _RECORD_HEAD.unpack_from(data)
+    pos = _RECORD_HEAD.size
+    name = bytes(data[pos:pos + name_len]).decode()
+    device = bytes(data[pos + name_len:pos + name_len + device_len]).decode()
+    schema = SCHEMAS[name]
+    row = _record_structs.get(name)
+    if row is None:
+        row = _record_structs[name] = Struct('<' + ''.join(schema.types))
+    return SensorRecord(schema, row.unpack_from(data, pos + name_len + device_len), t, device)
+
+def read_adv_csv(_file):
+    """
+    ble_2jcie-bu_adv2csv.py が出力した CSV ファイル (datetime,timestamp,data_mode,...) を
+    SensorRecord のリストとして読み込む関数
+    time には timestamp 列の値、device にはファイル名 (MAC アドレス) を格納
+    csv.reader で 1 回だけ分割し、データモードごとに列単位で変換して元の行の順に並べる
+    """
+    device = _file.replace('\\', '/').split('/')[-1].split('.')[0]
+    with open(_file, newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)     # ヘッダー
+        rows = list(filter(None, reader))     # 空行を除く
+    modes = set(map(itemgetter(2), rows))
+    if len(modes) == 1:
+        # 1 つのデータモードだけの場合 (通常の CSV ファイル) は、全体を列に入れ替えてまとめて変換
+        return _adv_csv_records(ADV_SCHEMAS[int(modes.pop())], list(zip(*rows)), device)
+    records = [None] * len(rows)
+    for mode in modes:
+        index = [i for i, row in enumerate(rows) if row[2] == mode]
+        columns = list(zip(*[rows[i] for i in index]))
+        for i, record in zip(index, _adv_csv_records(ADV_SCHEMAS[int(mode)], columns, device)):
+            records[i] = record
+    return records
+
+def _adv_csv_records(schema, columns, device):
+    """
+    同じデータモードの CSV の列 (datetime, timestamp, data_mode, 各フィールド) を、
+    列ごとにまとめて SensorRecord のリストに変換する関数
+    """
+    values = schema.parse_columns(columns[3:3 + len(schema.fields)])
+    return list(map(SensorRecord, repeat(schema), values, map(float, columns[1]), repeat(device)))
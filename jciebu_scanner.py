@@ -0,0 +1,460 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_scanner.py: BleakScanner を起動したままにして advertising packet を受信し続けるモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_scanner import ScannerService
+#   service = ScannerService(advcallback)
+#   loop = asyncio.new_event_loop()
+#   loop.run_until_complete(service.run())     # service.stop() まで受信を続ける
+#
+# BleakScanner.discover(timeout=1.0) を繰り返すと、1 秒ごとにスキャンの停止・開始の間のパケットを受信できず、
+# 開始の処理にも時間がかかるため、1 つの BleakScanner でスキャンを続ける
+# アダプタのエラーや、stall_timeout 秒以上パケットを受信しない場合は、待ち時間を倍にしながらスキャンを再開する
+# report_interval 秒ごとに受信したパケットの数と速さ (packets/s) を表示する
+# (window を指定すると、従来と同じように window 秒ごとにスキャンを止めて再開する。受信数の比較用)
+#
+# MultiScannerService は複数のアダプタ (hci0, hci1, ...) でそれぞれ BleakScanner を起動し、
+# 受信したパケットを同じ callback に渡すクラス (アダプタごとに受信数を数える。重複は callback の後で取り除く)
+#   service = MultiScannerService(advcallback, list_adapters())
+#
+# ReceptionStats は受信したパケットから、環境センサごとの受信の速さ (packets/s) とシーケンス番号の飛び
+# (受信できなかった測定の数) を数えるクラス (アドバタイズの間隔の調整などに使用)
+#
+# PacketQueue は detection_callback で受信したパケットを上限のあるキューに入れ、デコードとファイルへの出力は
+# 別のスレッドでまとめて行うクラス (イベントループのスレッドでファイルの書き込みなどを待たない)
+#   packet_queue = PacketQueue(process_packets)     # process_packets(パケットのリスト)
+#   packet_queue.start()
+#   packet_queue.put((time.time(), dev.address, dev.name, data))    # advcallback の中
+#   packet_queue.stop()                             # 残りのパケットを処理して終了
+#
+
+import asyncio
+import os
+import queue
+import re
+import threading
+import time
+
+from bleak import BleakScanner
+
+class ScannerService:
+    """
+    1 つの BleakScanner で advertising packet を受信し続けるクラス
+
+    callback: detection_callback と同じ callback(dev, advdata)
+    scanning_mode: 'active' または 'passive'、adapter: 使用するアダプタ ('hci0' など、None の場合は既定)
+    idle: 約 tick 秒ごとに呼び出す関数 (CsvWriter.flush_due など)
+    stall_timeout: この秒数の間パケットを受信しない場合はスキャンを再開 (None の場合は再開しない)
+    restart_delay, max_restart_delay: エラーの後、スキャンを再開するまでの待ち時間 (続けて失敗すると倍)
+    report_interval: 受信の速さを表示する間隔 (秒, 0 の場合は表示しない)、on_report: 表示の代わりに呼び出す関数
+    window: 指定した場合は window 秒ごとにスキャンを止めて再開 (従来の discover(timeout=1.0) の繰り返しと同じ)
+    """
+
+    def __init__(self, callback, scanning_mode='active', adapter=None, idle=None, tick=0.5,
+                 stall_timeout=60.0, restart_delay=1.0, max_restart_delay=30.0,
+                 report_interval=60.0, on_report=None, window=None):
+        self.callback = callback
+        self.scanning_mode = scanning_mode
+        self.adapter = adapter
+        self.idle = idle
+        self.tick = tick
+        self.stall_timeout = stall_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.report_interval = report_interval
+        self.on_report = on_report
+        self.window = window
+
+        self.packets = 0            # 受信したパケットの数
+        self.devices = {}           # アドレス -> 受信したパケットの数
+        self.restarts = 0           # スキャンを再開した回数
+        self.errors = 0             # アダプタのエラーの回数
+        self.stalls = 0             # パケットを受信しないために再開した回数
+        self.callback_errors = 0    # callback が例外を送出した回数
+        self.scanning = 0.0         # スキャンしていた時間の合計 (秒)
+        self._last_packet = 0.0
+        self._stopped = False
+        self._report_time = 0.0
+        self._report_packets = 0
+
+    def _detected(self, dev, advdata):
+        self.packets += 1
+        self.devices[dev.address] = self.devices.get(dev.address, 0) + 1
+        self._last_packet = time.monotonic()
+        try:
+            self.callback(dev, advdata)
+        except Exception as e:
+            # 1 つのパケットの処理の失敗でスキャンを止めない
+            self.callback_errors += 1
+            print('advcallback error', repr(e))
+
+    def stop(self):
+        """
+        受信を終了する関数 (run() は実行中のスキャンを止めてから戻る)
+        """
+        self._stopped = True
+
+    def rate(self):
+        """
+        開始してからの受信の速さ (スキャンしていた時間あたりのパケット数) を返す関数
+        """
+        return self.packets / self.scanning if self.scanning > 0 else 0.0
+
+    def _stats(self):
+        """
+        前回の表示からの受信数と速さの辞書を返し、表示した時刻を更新する関数
+        """
+        now = time.monotonic()
+        seconds = now - self._report_time
+        stats = {'packets': self.packets - self._report_packets,
+                 'rate': (self.packets - self._report_packets) / seconds if seconds > 0 else 0.0,
+                 'devices': len(self.devices), 'restarts': self.restarts, 'errors': self.errors,
+                 'stalls': self.stalls, 'callback_errors': self.callback_errors}
+        self._report_time = now
+        self._report_packets = self.packets
+        return stats
+
+    def report(self):
+        """
+        前回の表示からの受信数と速さを表示する関数 (on_report を指定した場合は統計の辞書を渡す)
+        """
+        stats = self._stats()
+        if self.on_report is not None:
+            self.on_report(stats)
+        else:
+            print(f"scanner: {stats['packets']} packets ({stats['rate']:.2f} packets/s),"
+                  f" {stats['devices']} devices, restarts={stats['restarts']} errors={stats['errors']}"
+                  f" stalls={stats['stalls']}")
+        return stats
+
+    async def _scan(self):
+        """
+        BleakScanner を 1 回起動し、stop()、window 秒の経過、パケットが途絶えるまで受信する関数
+        """
+        kwargs = {'detection_callback': self._detected, 'scanning_mode': self.scanning_mode}
+        if self.adapter is not None:
+            kwargs['adapter'] = self.adapter
+        scanner = BleakScanner(**kwargs)
+        await scanner.start()
+        started = time.monotonic()
+        self._last_packet = started
+        try:
+            while not self._stopped:
+                await asyncio.sleep(self.tick if self.window is None else min(self.tick, self.window))
+                now = time.monotonic()
+                if self.idle is not None:
+                    self.idle()
+                if self.report_interval > 0 and now - self._report_time >= self.report_interval:
+                    self.report()
+                if self.window is not None and now - started >= self.window:
+                    return True
+                if self.stall_timeout is not None and now - self._last_packet >= self.stall_timeout:
+                    self.stalls += 1
+                    print(f'scanner: no packets for {now - self._last_packet:.0f} s, restarting')
+                    return False
+            return True
+        finally:
+            self.scanning += time.monotonic() - started
+            try:
+                await scanner.stop()
+            except Exception as e:
+                print('scanner stop error', repr(e))
+
+    async def run(self):
+        """
+        stop() が呼び出されるまでスキャンを続ける関数
+        """
+        self._stopped = False
+        self._report_time = time.monotonic()
+        self._report_packets = self.packets
+        delay = self.restart_delay
+        while not self._stopped:
+            try:
+                if await self._scan():
+                    # stop() または window 秒ごとの再開
+                    delay = self.restart_delay
+                    continue
+            except Exception as e:
+                # アダプタが取り外された、BlueZ のエラーなど
+                self.errors += 1
+                print('scanner error', repr(e))
+            if self._stopped:
+                break
+            self.restarts += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_restart_delay)
+
+def list_adapters():
+    """
+    Linux (BlueZ) のローカルの Bluetooth アダプタの名前 ('hci0', 'hci1', ...) のリストを返す関数
+    (/sys/class/bluetooth がない場合は空のリスト)
+    """
+    path = '/sys/class/bluetooth'
+    if not os.path.isdir(path):
+        return []
+    return sorted((name for name in os.listdir(path) if re.fullmatch(r'hci[0-9]+', name)),
+                  key=lambda name: int(name[3:]))
+
+class MultiScannerService:
+    """
+    アダプタごとに ScannerService を起動し、受信したパケットを同じ callback に渡すクラス
+
+    adapters: 使用するアダプタのリスト ('hci0', 'hci1' など)
+    idle, tick, report_interval, on_report: ScannerService と同じ (各アダプタの分をまとめて表示)
+    その他の引数 (scanning_mode, stall_timeout, window など) はアダプタごとの ScannerService に渡す
+    1 つのアダプタのエラーや取り外しでは他のアダプタの受信は止めない (そのアダプタだけ再開を繰り返す)
+    """
+
+    def __init__(self, callback, adapters, idle=None, tick=0.5, report_interval=60.0, on_report=None, **kwargs):
+        self.adapters = list(adapters)
+        self.idle = idle
+        self.tick = tick
+        self.report_interval = report_interval
+        self.on_report = on_report
+        self.services = [ScannerService(callback, adapter=adapter, report_interval=0, **kwargs)
+                         for adapter in self.adapters]
+        self._stopped = False
+        self._report_time = 0.0
+
+    @property
+    def packets(self):
+        return sum(service.packets for service in self.services)
+
+    def stop(self):
+        """
+        すべてのアダプタの受信を終了する関数
+        """
+        self._stopped = True
+        for service in self.services:
+            service.stop()
+
+    def rate(self):
+        """
+        開始してからの受信の速さ (アダプタごとの速さの合計) を返す関数
+        """
+        return sum(service.rate() for service in self.services)
+
+    def report(self):
+        """
+        前回の表示からの受信数と速さを、合計とアダプタごとに表示する関数
+        (on_report を指定した場合は {'packets', 'rate', 'devices', 'adapters': {アダプタ: 統計の辞書}} を渡す)
+        """
+        adapters = {adapter: service._stats() for adapter, service in zip(self.adapters, self.services)}
+        devices = set()
+        for service in self.services:
+            devices.update(service.devices)
+        stats = {'packets': sum(s['packets'] for s in adapters.values()),
+                 'rate': sum(s['rate'] for s in adapters.values()),
+                 'devices': len(devices), 'adapters': adapters}
+        self._report_time = time.monotonic()
+        if self.on_report is not None:
+            self.on_report(stats)
+        else:
+            print(f"scanner: {stats['packets']} packets ({stats['rate']:.2f} packets/s),"
+                  f" {stats['devices']} devices, {len(adapters)} adapters")
+            for adapter, s in adapters.items():
+                print(f"  {adapter}: {s['packets']} packets ({s['rate']:.2f} packets/s), {s['devices']} devices,"
+                      f" restarts={s['restarts']} errors={s['errors']} stalls={s['stalls']}")
+        return stats
+
+    async def run(self):
+        """
+        stop() が呼び出されるまで、すべてのアダプタでスキャンを続ける関数
+        """
+        self._stopped = False
+        self._report_time = time.monotonic()
+        tasks = [asyncio.ensure_future(service.run()) for service in self.services]
+        try:
+            while not self._stopped:
+                await asyncio.sleep(self.tick)
+                if self.idle is not None:
+                    self.idle()
+                if self.report_interval > 0 and time.monotonic() - self._report_time >= self.report_interval:
+                    self.report()
+        finally:
+            for service in self.services:
+                service.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+class ReceptionStats:
+    """
+    環境センサごとに受信したパケットの数と、シーケンス番号の数 (受信できた測定) と飛び (受信できなかった測定) を数えるクラス
+    シーケンス番号は測定ごとに 1 つ増え (0 - 255 で繰り返す)、同じ測定の間は同じ番号のパケットが繰り返し送られる
+    データモード 3, 4 は packet type 1 のシーケンス番号、データモード 5 (シリアル番号) はパケットの数だけを数える
+    前回の番号から 128 以内の後ろの番号 (複数のアダプタで受信した遅れたパケットなど) は新しい測定として数えず、
+    飛ばした番号のパケットが遅れて届いた場合だけ、受信できた測定に数えなおす
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.packets = {}       # アドレス -> パケットの数
+        self.sequences = {}     # アドレス -> 受信できたシーケンス番号の数
+        self.expected = {}      # アドレス -> 最初から最後のシーケンス番号までの測定の数
+        self.reordered = {}     # アドレス -> 前回より後ろの番号のパケットの数 (遅れて届いたものと重複)
+        self._last_seq = {}
+        self._missing = {}      # アドレス -> 飛ばしたシーケンス番号の集合 (遅れて届いた場合に数えなおす)
+
+    def add(self, address, data):
+        """
+        受信したパケット (manufacturer_data[0x02D5]) を数える関数
+        """
+        self.packets[address] = self.packets.get(address, 0) + 1
+        if len(data) < 2 or data[0] == 5 or (data[0] in (3, 4) and len(data) != 19):
+            return
+        seq = data[1]
+        last = self._last_seq.get(address)
+        if last is None:
+            self.sequences[address] = 1
+            self.expected[address] = 1
+            self._missing[address] = set()
+            self._last_seq[address] = seq
+            return
+        step = (seq - last) % 256
+        if step == 0:
+            return
+        missing = self._missing[address]
+        if step > 128:
+            # 前回より後ろの番号: 飛ばした番号なら受信できた測定に数え、それ以外 (重複) は数えない
+            self.reordered[address] = self.reordered.get(address, 0) + 1
+            if seq in missing:
+                missing.discard(seq)
+                self.sequences[address] += 1
+            return
+        for skipped in range(last + 1, last + step):
+            missing.add(skipped % 256)
+        # 1 周前の同じ番号は、新しい測定の番号として使われる
+        missing.discard(seq)
+        self.sequences[address] += 1
+        self.expected[address] += step
+        self._last_seq[address] = seq
+
+    def summary(self, seconds=None):
+        """
+        アドレス -> {'packets', 'rate' (packets/s), 'sequences', 'lost', 'reordered',
+        'completeness' (受信できた測定の割合)} を返す関数
+        """
+        if seconds is None:
+            seconds = time.monotonic() - self.started
+        result = {}
+        for address, packets in self.packets.items():
+            sequences = self.sequences.get(address, 0)
+            expected = self.expected.get(address, 0)
+            result[address] = {'packets': packets, 'rate': packets / seconds if seconds > 0 else 0.0,
+                               'sequences': sequences, 'lost': expected - sequences,
+                               'reordered': self.reordered.get(address, 0),
+                               'completeness': sequences / expected if expected > 0 else None}
+        return result
+
+class PacketQueue(threading.Thread):
+    """
+    受信したパケットを上限のあるキューに入れ、handler(パケットのリスト) をこのスレッドで呼び出すクラス
+
+    maxsize: キューに入れておくパケットの数の上限 (超えた場合は block が False なら捨てて dropped に記録、
+    True なら空くまで待つ。記録したパケットの再生などで使用)
+    batch_size: 1 回の handler に渡すパケットの数の上限
+    idle: キューが空のときに約 interval 秒ごとに呼び出す関数 (CsvWriter.flush_due など)
+    report_interval: キューの状態を表示する間隔 (秒, 0 の場合は表示しない)
+    """
+
+    def __init__(self, handler, maxsize=10000, batch_size=256, block=False, idle=None, interval=0.5,
+                 report_interval=60.0):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.batch_size = batch_size
+        self.block = block
+        self.idle = idle
+        self.interval = interval
+        self.report_interval = report_interval
+        self._queue = queue.Queue(maxsize)
+        self._stop_event = threading.Event()
+
+        self.enqueued = 0           # キューに入れたパケットの数
+        self.dropped = 0            # キューがいっぱいで捨てたパケットの数
+        self.processed = 0          # handler に渡したパケットの数
+        self.batches = 0            # handler を呼び出した回数
+        self.errors = 0             # handler が例外を送出した回数
+        self.max_depth = 0          # キューのパケットの数の最大値
+        self.latency_total = 0.0    # put を呼び出した callback の処理時間の合計 (秒)
+        self.latency_max = 0.0      # 同、最大値 (秒)
+        self._report_time = time.monotonic()
+
+    def put(self, packet, started=None):
+        """
+        パケットをキューに入れる関数 (callback の中で呼び出す)
+        started に callback の開始時刻 (time.perf_counter()) を指定すると、callback の処理時間を記録する
+        """
+        try:
+            self._queue.put(packet, block=self.block)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if started is not None:
+            latency = time.perf_counter() - started
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+    def depth(self):
+        """
+        キューに入っているパケットの数を返す関数
+        """
+        return self._queue.qsize()
+
+    def _handle(self, batch):
+        try:
+            self.handler(batch)
+        except Exception as e:
+            self.errors += 1
+            print('packet handler error', repr(e))
+        self.processed += len(batch)
+        self.batches += 1
+
+    def _next_batch(self, timeout):
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def run(self):
+        while not self._stop_event.is_set():
+            batch = self._next_batch(self.interval)
+            if len(batch) > 0:
+                self._handle(batch)
+            elif self.idle is not None:
+                self.idle()
+            if self.report_interval > 0 and time.monotonic() - self._report_time >= self.report_interval:
+                self.report()
+
+    def stop(self):
+        """
+        スレッドを止め、キューに残っているパケットを処理する関数
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        batch = self._next_batch(0)
+        while len(batch) > 0:
+            self._handle(batch)
+            batch = self._next_batch(0)
+
+    def report(self):
+        """
+        キューの状態 (パケットの数、捨てた数、callback の処理時間) を表示する関数
+        """
+        self._report_time = time.monotonic()
+        latency_avg = self.latency_total / self.enqueued * 1e6 if self.enqueued > 0 else 0.0
+        batch_avg = self.processed / self.batches if self.batches > 0 else 0.0
+        print(f'packet queue: depth={self.depth()} max_depth={self.max_depth} enqueued={self.enqueued}'
+              f' dropped={self.dropped} batch={batch_avg:.1f} errors={self.errors}'
+              f' callback avg={latency_avg:.1f} us max={self.latency_max * 1e6:.1f} us')
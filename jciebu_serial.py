@@ -0,0 +1,233 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) USB シリアル通信 共通モジュール
+#
+# jciebu_serial.py: 環境センサにコマンドを送信し、レスポンスを受信するモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_serial import find_ports, serial_read, serial_read_frames, serial_write
+#
+# レスポンスは inWaiting() のポーリングではなく、ヘッダ(4バイト)を受信した後、
+# Length で指定されたバイト数をそのまま読み込む (受信するまでブロック)
+# 待ち時間の上限はコマンドごとのレスポンスの長さから計算する
+#
+
+import time
+
+from serial.tools import list_ports
+
+from jciebu_protocol import ACC_PAGE_SIZE, FrameDecoder, build_frame
+
+# 環境センサ(2JCIE-BU)の USB ベンダーID / プロダクトID
+USB_VID = 0x0590
+USB_PID = 0x00D4
+
+# 各コマンド (アドレス) のレスポンスのバイト数 (ヘッダから CRC-16 まで)
+RESPONSE_SIZE = {0x5021: 58,   # 最新データ (Latest data Long)
+                 0x5201: 17,   # Latest time counter
+                 0x5202: 17,   # Time setting
+                 0x5203: 11,   # Memory storage interval
+                 }
+# 上記以外のコマンドのレスポンスのバイト数 (上限の目安)
+DEFAULT_RESPONSE_SIZE = 256
+
+# センサがコマンドを処理してからレスポンスを返し始めるまでの時間の上限 (秒)
+RESPONSE_LATENCY = 0.5
+# 転送時間に対する余裕
+TRANSFER_MARGIN = 2.0
+
+def find_ports():
+    """
+    接続されている環境センサ(2JCIE-BU)のシリアルポート名のリストを返す関数
+    pyserial のポート一覧から USB のベンダーID / プロダクトID で判定
+    """
+    return sorted(p.device for p in list_ports.comports() if p.vid == USB_VID and p.pid == USB_PID)
+
+def command_address(_payload):
+    """
+    コマンドの _payload からアドレス (0x5021 など) を取り出す関数
+    """
+    return _payload[1] | (_payload[2] << 8)
+
+def response_size(_payload):
+    """
+    コマンドの _payload から、レスポンス全体のバイト数を見積もる関数
+    """
+    address = command_address(_payload)
+    if address == 0x503F and len(_payload) >= 9:
+        # 加速度データは Start page から End page まで 1 ページ 1 フレーム
+        start_page = _payload[5] | (_payload[6] << 8)
+        end_page = _payload[7] | (_payload[8] << 8)
+        return ACC_PAGE_SIZE * max(end_page - start_page + 1, 1)
+    return RESPONSE_SIZE.get(address, DEFAULT_RESPONSE_SIZE)
+
+def response_timeout(_payload, _baudrate):
+    """
+    レスポンスの受信を待つ時間の上限 (秒) を返す関数
+    レスポンスのバイト数を通信速度 (1 バイト 10 ビット) で送る時間に余裕を加えて計算
+    """
+    return RESPONSE_LATENCY + response_size(_payload) * 10 / _baudrate * TRANSFER_MARGIN
+
+def serial_write(_ser, _payload):
+    """
+    環境センサにコマンドを送信する関数
+    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
+    """
+    _ser.write(build_frame(_payload))
+    _ser.flush()
+    return
+
+def read_frame(_ser, _decoder, _deadline):
+    """
+    シリアルポートからフレームを 1 つ受信する関数
+    ヘッダ(4バイト)を読み込み、Length で指定された残りのバイト数を読み込む
+    _deadline (time.monotonic() の時刻) までに受信できなければ None を返す
+    シリアルポートの timeout は残り時間に変更するので、呼び出し側で元に戻す
+    """
+    frame = _decoder.next_frame()
+    while frame is None:
+        remaining = _deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        _ser.timeout = remaining
+        _decoder.feed(_ser.read(_decoder.needed()))
+        frame = _decoder.next_frame()
+    return frame
+
+def serial_read_frames(_ser, _payload, _count=1, timeout=None, partial=False):
+    """
+    環境センサにコマンドを送信し、レスポンスのフレームを _count 個取得する関数
+    加速度データ(0x503F)のように 1 ページが 1 フレームで返るレスポンスは、ページ数を _count に指定
+    フレームは FrameDecoder でヘッダ・長さ・CRC-16 を確認して切り出し、memoryview のリストで返す
+    timeout を省略した場合は、レスポンスの長さから待ち時間の上限を計算
+    タイムアウト、エラーレスポンスの場合は空のリストを返す
+    partial を True にした場合は、それまでに受信した完全なフレームのリストを返す (_count 個より少ない)
+    """
+    if len(_payload) == 0:
+        return []
+    if timeout is None:
+        timeout = response_timeout(_payload, _ser.baudrate)
+
+    # 前のコマンドの受信し残したデータを捨ててから送信
+    _ser.reset_input_buffer()
+    serial_write(_ser, _payload)
+
+    decoder = FrameDecoder()
+    frames = []
+    deadline = time.monotonic() + timeout
+    ser_timeout = _ser.timeout
+    try:
+        while len(frames) < _count:
+            frame = read_frame(_ser, decoder, deadline)
+            if frame is None:
+                print('serial port timeout', f'({len(frames)}/{_count} frames)')
+                return frames if partial else []
+            if frame[4] != 1 and frame[4] != 2:
+                # エラーレスポンス (0x81: Read error, 0x82: Write error など)
+                print("Error Response", hex(frame[4]), bytes(frame).hex(' '))
+                return frames if partial else []
+            frames.append(frame)
+    finally:
+        _ser.timeout = ser_timeout
+
+    if decoder.crc_errors > 0 or decoder.skipped_bytes > 0:
+        print("Invalid Frame", 'crc_errors', decoder.crc_errors, 'skipped_bytes', decoder.skipped_bytes)
+
+    return frames
+
+def serial_read(_ser, _payload, timeout=None):
+    """
+    環境センサにコマンドを送信し、レスポンスを取得する関数
+    _payload の前にヘッダと_payloadの長さを付加、後に CRC-16 を付加して送信
+    レスポンスはシリアルポートから読み込み、1 フレーム分を返す (失敗した場合は b'')
+    """
+    frames = serial_read_frames(_ser, _payload, timeout=timeout)
+    if len(frames) == 0:
+        return b''
+    return bytes(frames[0])
+
+class CommandQueue:
+    """
+    シリアルポートごとのコマンドキュー
+    複数のコマンドを続けて送信し (最大 max_in_flight 個を同時に送信済みにする)、
+    レスポンスに含まれるアドレス (ret[5:7]) で送信したコマンドと対応付ける
+    1 回の往復時間の間に、最新データ(0x5021)と時刻カウンタ(0x5201)などをまとめて取得できる
+
+    使い方:
+        queue = CommandQueue(ser)
+        ret_latest, ret_counter = queue.request(bytearray([0x01, 0x21, 0x50]),
+                                                bytearray([0x01, 0x01, 0x52]))
+
+    レスポンスが 1 フレームのコマンドが対象 (加速度データ 0x503F は serial_read_frames を使用)
+    """
+
+    def __init__(self, _ser, max_in_flight=4):
+        self._ser = _ser
+        self.max_in_flight = max_in_flight
+        self._payloads = []
+        self.unmatched = 0  # 対応するコマンドがなかったレスポンスの数
+
+    def put(self, _payload):
+        """
+        コマンドをキューに追加し、結果のリストでの位置を返す関数
+        """
+        self._payloads.append(_payload)
+        return len(self._payloads) - 1
+
+    def run(self):
+        """
+        キューのコマンドを送信し、レスポンスをキューに追加した順のリストで返す関数
+        タイムアウト、エラーレスポンスのコマンドの結果は b''
+        """
+        _payloads, self._payloads = self._payloads, []
+        results = [b''] * len(_payloads)
+        if len(_payloads) == 0:
+            return results
+
+        _ser = self._ser
+        _ser.reset_input_buffer()
+        decoder = FrameDecoder()
+        waiting = {}    # アドレス -> 送信済みで未受信のコマンドの位置 (送信順)
+        in_flight = 0
+        sent = 0
+        deadline = 0
+        ser_timeout = _ser.timeout
+        try:
+            while sent < len(_payloads) or in_flight > 0:
+                # 同時に送信済みにできる数まで送信
+                while sent < len(_payloads) and in_flight < self.max_in_flight:
+                    _payload = _payloads[sent]
+                    waiting.setdefault(command_address(_payload), []).append(sent)
+                    serial_write(_ser, _payload)
+                    deadline = max(deadline, time.monotonic() + response_timeout(_payload, _ser.baudrate))
+                    sent += 1
+                    in_flight += 1
+
+                frame = read_frame(_ser, decoder, deadline)
+                if frame is None:
+                    print('serial port timeout', f'({in_flight} commands)')
+                    break
+                address = frame[5] | (frame[6] << 8)
+                if len(waiting.get(address, [])) == 0:
+                    self.unmatched += 1
+                    continue
+                index = waiting[address].pop(0)
+                in_flight -= 1
+                if frame[4] != 1 and frame[4] != 2:
+                    print("Error Response", hex(frame[4]), bytes(frame).hex(' '))
+                    continue
+                results[index] = bytes(frame)
+                # レスポンスを受信したら、残りのコマンドの待ち時間を延長
+                deadline = time.monotonic() + max([response_timeout(_payloads[j], _ser.baudrate)
+                                                   for j in sum(waiting.values(), [])] + [0])
+        finally:
+            _ser.timeout = ser_timeout
+
+        return results
+
+    def request(self, *_payloads):
+        """
+        コマンドをまとめて送信し、レスポンスを引数の順のリストで返す関数
+        """
+        for _payload in _payloads:
+            self.put(_payload)
+        return self.run()
@@ -0,0 +1,306 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュール
+#
+# jciebu_spool.py: 受信したデータを一時的にディスクに保存し、別スレッドで出力先に送るモジュール #
+#
+# 使い方: 各プログラムから import して利用
+#   from jciebu_spool import Spool, SpoolDrainer
+#   spool = Spool('spool_files')
+#   drainer = SpoolDrainer(spool, sink, flush=flush, commit_interval=60)
+#                                           # sink(records) は SensorRecord のリストを CSV などに出力する関数
+#                                           # flush() は出力先のバッファをすべて書き出す関数 (失敗した場合は例外)
+#                                           # (sink と出力先の flush はすべて drainer のスレッドで行う)
+#   drainer.start()
+#   spool.append_record(record)             # データの受信側はファイルに追記するだけ (出力先の遅延の影響を受けない)
+#   drainer.stop()
+#
+# スプールはセグメントファイル (00000001.spool, ...) の並びで、1 件ごとに [長さ][CRC-32][データ] を追記する
+# 送り終わった位置 (セグメント番号, オフセット) は cursor.json に保存し、再起動後はその続きから送る
+# flush を指定した場合は、sink に渡した後、flush (CSV の書き出し、InfluxDB の送信の完了など) が成功してから
+# cursor.json に保存する (sink に渡しただけで出力先のメモリに残っているデータは、送り終わったことにしない)
+# (送った後、cursor.json を保存する前に終了した場合は、その分をもう一度送る)
+# 合計のサイズが max_bytes を超えた場合は、最も古いセグメントを削除する (削除したバイト数を dropped_bytes に記録)
+#
+
+import json
+import os
+import threading
+import time
+import zlib
+from struct import Struct
+
+from jciebu_record import pack_record, unpack_record
+
+# 1 件の先頭 (データの長さ, CRC-32)
+_ENTRY_HEAD = Struct('<LL')
+# セグメントファイルの拡張子
+SPOOL_EXT = '.spool'
+# 送り終わった位置を保存するファイル
+CURSOR_FILE = 'cursor.json'
+
+class Spool:
+    """
+    ディスク上の追記専用のキュー
+    segment_bytes: 1 つのセグメントファイルの大きさの目安 (超えたら次のファイルに切り替え)
+    max_bytes: スプール全体の大きさの上限 (超えた場合は最も古いセグメントを削除)
+    fsync: True の場合は追記のたびに os.fsync で書き込み完了を待つ (False でも OS には毎回渡す)
+    """
+
+    def __init__(self, folder, segment_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024, fsync=False):
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self.appended = 0       # 追記した件数
+        self.dropped_bytes = 0  # 上限を超えて削除したバイト数
+        self.corrupted = 0      # CRC-32 が一致せずに読み飛ばした件数
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self._sizes = {}        # セグメント番号 -> バイト数
+        for name in os.listdir(folder):
+            if name.endswith(SPOOL_EXT):
+                self._sizes[int(name[:-len(SPOOL_EXT)])] = os.path.getsize(os.path.join(folder, name))
+        self.cursor = self._load_cursor()
+
+        if len(self._sizes) == 0:
+            self._sizes[max(self.cursor[0], 1)] = 0
+        self._seq = max(self._sizes)
+        # 書き込みの途中で終了した末尾の不完全な 1 件を取り除く
+        self._recover(self._seq)
+        self._f = open(self._path(self._seq), 'ab')
+        if self.cursor[0] < min(self._sizes):
+            self.cursor = (min(self._sizes), 0)
+        elif self.cursor[1] > self._sizes.get(self.cursor[0], 0):
+            # セグメントが作り直された場合などは、そのセグメントの末尾から
+            self.cursor = (self.cursor[0], self._sizes.get(self.cursor[0], 0))
+
+    def _path(self, seq):
+        return os.path.join(self.folder, '%08d%s' % (seq, SPOOL_EXT))
+
+    def _load_cursor(self):
+        path = os.path.join(self.folder, CURSOR_FILE)
+        if not os.path.exists(path):
+            return (0, 0)
+        with open(path) as f:
+            state = json.load(f)
+        return (state['segment'], state['offset'])
+
+    def _recover(self, seq):
+        path = self._path(seq)
+        if not os.path.exists(path):
+            return
+        valid = 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        while valid + _ENTRY_HEAD.size <= len(data):
+            length, crc = _ENTRY_HEAD.unpack_from(data, valid)
+            end = valid + _ENTRY_HEAD.size + length
+            if end > len(data) or zlib.crc32(data[valid + _ENTRY_HEAD.size:end]) != crc:
+                break
+            valid = end
+        if valid < len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(valid)
+        self._sizes[seq] = valid
+
+    def append(self, data):
+        """
+        1 件 (bytes) を追記する関数
+        """
+        self.append_many((data,))
+
+    def append_many(self, items):
+        """
+        複数の件 (bytes のリスト) をまとめて 1 回の書き込みで追記する関数
+        """
+        entries = b''.join(_ENTRY_HEAD.pack(len(data), zlib.crc32(data)) + data for data in items)
+        if len(entries) == 0:
+            return
+        with self._lock:
+            if self._sizes[self._seq] > 0 and self._sizes[self._seq] + len(entries) > self.segment_bytes:
+                self._rotate()
+            self._f.write(entries)
+            self._f.flush()
+            if self.fsync:
+                os.fsync(self._f.fileno())
+            self._sizes[self._seq] += len(entries)
+            self.appended += len(items)
+            if sum(self._sizes.values()) > self.max_bytes and len(self._sizes) > 1:
+                self._drop_oldest()
+
+    def append_record(self, record):
+        """
+        SensorRecord を 1 件追記する関数
+        """
+        self.append(pack_record(record))
+
+    def append_records(self, records):
+        """
+        SensorRecord のリストをまとめて追記する関数
+        """
+        self.append_many([pack_record(record) for record in records])
+
+    def _rotate(self):
+        self._f.close()
+        self._seq += 1
+        self._sizes[self._seq] = 0
+        self._f = open(self._path(self._seq), 'ab')
+
+    def _drop_oldest(self):
+        seq = min(self._sizes)
+        size = self._sizes.pop(seq)
+        if self.cursor[0] <= seq:
+            self.dropped_bytes += size - (self.cursor[1] if self.cursor[0] == seq else 0)
+            self.cursor = (seq + 1, 0)
+        os.remove(self._path(seq))
+
+    def read(self, cursor, max_entries):
+        """
+        cursor (セグメント番号, オフセット) から最大 max_entries 件を読み込み、(データのリスト, 次の cursor) を返す関数
+        書き込み中の不完全な 1 件は読まない。CRC-32 が一致しない件は読み飛ばす (corrupted に記録)
+        """
+        entries = []
+        seq, offset = cursor
+        with self._lock:
+            if seq < min(self._sizes):
+                # 上限を超えて削除されたセグメントは飛ばす
+                seq, offset = min(self._sizes), 0
+            last = self._seq
+        while len(entries) < max_entries:
+            path = self._path(seq)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    while len(entries) < max_entries:
+                        head = f.read(_ENTRY_HEAD.size)
+                        if len(head) < _ENTRY_HEAD.size:
+                            break
+                        length, crc = _ENTRY_HEAD.unpack(head)
+                        data = f.read(length)
+                        if len(data) < length:
+                            break
+                        offset += _ENTRY_HEAD.size + length
+                        if zlib.crc32(data) != crc:
+                            self.corrupted += 1
+                            continue
+                        entries.append(data)
+            if len(entries) >= max_entries or seq >= last:
+                break
+            # 書き込みが終わったセグメントを読み終えたら次のセグメントへ
+            seq, offset = seq + 1, 0
+        return entries, (seq, offset)
+
+    def commit(self, cursor):
+        """
+        cursor までを送り終わったことを cursor.json に保存し、読み終えたセグメントを削除する関数
+        """
+        with self._lock:
+            self.cursor = cursor
+            path = os.path.join(self.folder, CURSOR_FILE)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'segment': cursor[0], 'offset': cursor[1]}, f)
+            os.replace(path + '.tmp', path)
+            for seq in [s for s in self._sizes if s < cursor[0]]:
+                del self._sizes[seq]
+                os.remove(self._path(seq))
+
+    def backlog(self):
+        """
+        まだ送っていないバイト数を返す関数
+        """
+        with self._lock:
+            seq, offset = self.cursor
+            return sum(size for s, size in self._sizes.items() if s >= seq) - (offset if seq in self._sizes else 0)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+class SpoolDrainer(threading.Thread):
+    """
+    スプールのデータを読み込み、sink(records) に渡すスレッド
+    sink が例外を送出した場合は、retry_interval 秒待ってから同じデータをもう一度渡す (cursor は進めない)
+    batch_size: 1 回の sink に渡す最大件数、interval: スプールが空のときに待つ秒数
+    idle: スプールが空のときに呼び出す関数 (CsvWriter.flush_due など、出力先の定期的な処理はこのスレッドで行う)
+    flush: cursor を保存する前に呼び出す、出力先のバッファをすべて書き出す関数 (None の場合は sink の後すぐに保存)
+           例外を送出した場合は cursor を保存せず、retry_interval 秒待ってから次のデータより先に flush をやり直す
+    commit_interval: flush と cursor の保存の最小の間隔 (秒)。その間に sink に渡したデータはスプールに残る
+    """
+
+    def __init__(self, spool, sink, batch_size=256, interval=0.5, retry_interval=5.0, idle=None, flush=None,
+                 commit_interval=0.0):
+        super().__init__(daemon=True)
+        self.spool = spool
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.idle = idle
+        self.flush = flush
+        self.commit_interval = commit_interval
+        self.drained = 0        # sink に渡した件数
+        self.errors = 0         # sink または flush が失敗した回数
+        self.commits = 0        # cursor を保存した回数
+        self._position = spool.cursor       # sink に渡し終えた位置 (commit するまで cursor.json には保存しない)
+        self._committed = time.monotonic()  # 前回 commit した時刻
+        self._stop_event = threading.Event()
+
+    def commit(self):
+        """
+        flush で出力先のバッファを書き出してから、sink に渡し終えた位置までを cursor.json に保存する関数
+        """
+        if self.flush is not None:
+            self.flush()
+        if self._position != self.spool.cursor:
+            self.spool.commit(self._position)
+            self.commits += 1
+        self._committed = time.monotonic()
+
+    def _commit_due(self):
+        if self._position != self.spool.cursor and time.monotonic() - self._committed >= self.commit_interval:
+            self.commit()
+
+    def drain_once(self):
+        """
+        スプールから 1 回分を読み込んで sink に渡し、渡した件数を返す関数
+        (前回の flush が失敗した場合は、次のデータを読み込む前に flush と commit をやり直す)
+        """
+        self._commit_due()
+        entries, position = self.spool.read(self._position, self.batch_size)
+        if len(entries) > 0:
+            self.sink([unpack_record(e) for e in entries])
+            self.drained += len(entries)
+        self._position = position
+        self._commit_due()
+        return len(entries)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.drain_once() < self.batch_size:
+                    if self.idle is not None:
+                        self.idle()
+                    self._stop_event.wait(self.interval)
+            except Exception as e:
+                self.errors += 1
+                print('spool sink error', e)
+                self._stop_event.wait(self.retry_interval)
+
+    def stop(self, drain=True):
+        """
+        スレッドを止める関数 (drain が True の場合は、止めた後に残りをすべて sink に渡して commit する)
+        sink や flush が失敗した場合は errors に数えて終了する (残りはスプールに残り、次回の起動時に送る)
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        if drain:
+            try:
+                while self.drain_once() > 0:
+                    pass
+                self.commit()
+            except Exception as e:
+                self.errors += 1
+                print('spool sink error', e)
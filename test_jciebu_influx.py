@@ -0,0 +1,192 @@
+# 埼玉大学データサイエンス技術研究会
+# 環境センサ(2JCIE-BU) 共通モジュールのテスト
+#
+# test_jciebu_influx.py: jciebu_influx.py (LineEncoder, InfluxSink) を LocalInfluxServer に送信して確認するテスト #
+#
+# 使い方: python -m pytest -q test_jciebu_influx.py
+#
+
+import gzip
+import time
+
+import pytest
+
+from jciebu_influx import InfluxSink, LineEncoder, LocalInfluxServer
+from jciebu_record import ADV_SCHEMAS, LATEST_DATA_SCHEMA, RecordSchema, SensorRecord
+
+# 整数 (除数 1)、float (除数 100)、bytes のフィールドを持つテスト用のスキーマ
+SCHEMA = RecordSchema('test', ('count', 'temp C', 'name'), (1, 100, 1), ('H', 'h', '6s'))
+
+
+def make_records(count, devices=1, t0=1714747763.0):
+    return [SensorRecord(LATEST_DATA_SCHEMA, tuple(range(i, i + len(LATEST_DATA_SCHEMA.fields))),
+                         t0 + i * 0.001, f'sensor{i % devices}')
+            for i in range(count)]
+
+
+def expected_lines(records):
+    encoder = LineEncoder()
+    return sorted(encoder.encode(record) for record in records)
+
+
+@pytest.fixture
+def server():
+    server = LocalInfluxServer()
+    yield server
+    server.close()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_encode_int_and_float_fields():
+    record = SensorRecord(SCHEMA, (12, -2345, b'abc\x00\x00\x00'), 1714747763.5, 'COM3')
+    line = LineEncoder().encode(record)
+    # 除数 1 は整数 (i 付き)、除数のあるフィールドは float、bytes は末尾の NUL を除いた文字列
+    assert line == 'iot_2jciebu,device=COM3 count=12i,temp\\ C=-23.45,name="abc" 1714747763500000000'
+
+
+def test_encode_escapes_tags_and_strings():
+    encoder = LineEncoder('my meas,x', tags={'site': 'a b,c=d'})
+    record = SensorRecord(SCHEMA, (1, 100, b'q"b\\s\x00'), 1.0, 'dev 1,2=3')
+    line = encoder.encode(record)
+    assert line.startswith('my\\ meas\\,x,site=a\\ b\\,c\\=d,device=dev\\ 1\\,2\\=3 ')
+    assert 'temp\\ C=1.0,' in line
+    assert line.endswith(',name="q\\"b\\\\s" 1000000000')
+
+
+def test_encode_adv_schema_types():
+    schema = ADV_SCHEMAS[1]
+    record = SensorRecord(schema, (5, 2451, 5298, 470, 1018733, 5314, 33, 620), 2.0, 'CA43F0B62495')
+    fields = LineEncoder().encode(record).split(' ')[1].split(',')
+    assert fields == ['sequence_number=5i', 'temparature=24.51', 'relative_humidity=52.98',
+                      'ambient_light=470i', 'barometric_pressure=1018.733', 'sound_noise=53.14',
+                      'eTVOC=33i', 'eCO2=620i']
+
+
+def test_gzip_body_decodes_to_lines(server):
+    records = make_records(50, devices=3)
+    sink = InfluxSink(server.url, 'bucket', batch_size=1000, batch_age=60.0)
+    for record in records:
+        sink.write(record)
+    sink.close()
+    assert server.compressed == server.requests == 1
+    assert sorted(server.lines()) == expected_lines(records)
+    # 送信した本文 (gzip) を展開すると line protocol の行になる
+    body = server.batches[0]
+    assert body.endswith(b'\n') and sorted(body.decode().splitlines()) == expected_lines(records)
+    assert sink.bytes_sent < len(gzip.compress(body, compresslevel=0))
+
+
+def test_batch_size_trigger(server):
+    records = make_records(7)
+    sink = InfluxSink(server.url, 'bucket', batch_size=3, batch_age=60.0)
+    for record in records:
+        sink.write(record)
+    # batch_size 点ごとに送信 (残りの 1 点は flush まで送らない)
+    assert wait_until(lambda: len(server.batches) == 2)
+    assert sorted(len(body.splitlines()) for body in server.batches) == [3, 3]
+    sink.close()
+    assert len(server.batches) == 3
+    assert sorted(server.lines()) == expected_lines(records)
+
+
+def test_batch_age_trigger(server):
+    records = make_records(2)
+    sink = InfluxSink(server.url, 'bucket', batch_size=1000, batch_age=0.05)
+    sink.write(records[0])
+    sink.flush_due()
+    time.sleep(0.2)
+    assert server.requests == 0
+    # batch_age 秒を過ぎたら flush_due で送信
+    time.sleep(0.1)
+    sink.flush_due()
+    assert wait_until(lambda: len(server.batches) == 1)
+    # batch_age 秒を過ぎてから追加した点は、追加したときに送信
+    sink.write(records[1])
+    time.sleep(0.1)
+    assert server.requests == 1
+    sink.write(records[1])
+    assert wait_until(lambda: len(server.batches) == 2)
+    sink.close()
+
+
+def test_retry_after_5xx_delivers_once():
+    server = LocalInfluxServer(fail_rate=0.3, status=503, seed=1)
+    records = make_records(200, devices=4)
+    sink = InfluxSink(server.url, 'bucket', batch_size=10, workers=2, retries=20, backoff=0.001,
+                      max_backoff=0.01, keep_failed=True)
+    for record in records:
+        sink.write(record)
+    sink.close()
+    server.close()
+    assert sink.retried > 0 and sink.failed == 0
+    # 失敗したリクエストだけが再送され、どの点も 1 回だけ届く
+    assert sorted(server.lines()) == expected_lines(records)
+
+
+def test_retry_after_connection_error_delivers_once():
+    server = LocalInfluxServer(fail_first=3, disconnect=True)
+    records = make_records(30)
+    sink = InfluxSink(server.url, 'bucket', batch_size=10, workers=2, retries=5, backoff=0.001)
+    for record in records:
+        sink.write(record)
+    sink.close()
+    server.close()
+    assert sink.retried == 3 and sink.failed == 0
+    assert sorted(server.lines()) == expected_lines(records)
+
+
+def test_keep_failed_keeps_batches_until_flush_succeeds():
+    server = LocalInfluxServer(fail_rate=1.0, status=500)
+    records = make_records(25)
+    failures = []
+    sink = InfluxSink(server.url, 'bucket', batch_size=10, retries=1, backoff=0.001,
+                      keep_failed=True, on_failure=failures.append)
+    for record in records:
+        sink.write(record)
+    # 再送しても送信できなかったリクエストは保持し、flush は IOError で失敗を知らせる
+    with pytest.raises(IOError):
+        sink.flush()
+    assert sink.failed == 3 and failures == [] and server.lines() == []
+    # InfluxDB が復旧したら、保持していたリクエストを次の flush で送信する
+    server.fail_rate = 0.0
+    sink.flush()
+    sink.close()
+    server.close()
+    assert sorted(server.lines()) == expected_lines(records)
+
+
+def test_write_does_not_wait_for_slow_server():
+    server = LocalInfluxServer(delay=0.5)
+    records = make_records(10)
+    failures = []
+    sink = InfluxSink(server.url, 'bucket', batch_size=1, workers=1, on_failure=failures.append)
+    t = time.monotonic()
+    for record in records:
+        sink.write(record)
+    # 送信中のリクエストが workers の 2 倍に達したら、待たずに破棄する
+    assert time.monotonic() - t < 0.3
+    assert sink.dropped == 8 and len(failures) == 8
+    sink.close()
+    server.close()
+    assert len(server.lines()) == 2
+
+
+def test_write_keeps_batches_when_busy_with_keep_failed():
+    server = LocalInfluxServer(delay=0.5)
+    records = make_records(6)
+    sink = InfluxSink(server.url, 'bucket', batch_size=1, workers=1, keep_failed=True)
+    t = time.monotonic()
+    for record in records:
+        sink.write(record)
+    assert time.monotonic() - t < 0.3
+    assert sink.deferred == 4 and sink.dropped == 0
+    # 保持したリクエストは flush で (空きを待って) 送信する
+    sink.close()
+    server.close()
+    assert sorted(server.lines()) == expected_lines(records)